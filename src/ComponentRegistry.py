@@ -0,0 +1,60 @@
+import importlib
+import threading
+from collections.abc import Mapping
+from types import MappingProxyType
+
+# options of each pipeline component, mapped to factories that build a fresh transformer from the settings of the
+# model using it. Nothing is built or imported until a model asks for it, so every model owns its transformers
+# and models in different threads never share state. Registering replaces the options of a component as a whole
+# under a lock, readers always see a complete snapshot without taking it
+class ComponentRegistry(Mapping):
+    def __init__(self, components = None):
+        self._lock       = threading.Lock()
+        self._components = {
+            component: MappingProxyType(dict(options)) for (component, options) in (components or {}).items()
+        }
+
+    # add or replace an option of a component (a new component when not seen before). The factory is called with
+    # the settings dict of each model choosing the option and must return a new sklearn-style transformer
+    def register(self, component, name, factory):
+        if not callable(factory):
+            raise ValueError(f"Factory for `{component}` option '{name}' must be callable")
+        with self._lock:
+            options = dict(self._components.get(component, {}))
+            options[name] = factory
+            self._components = {**self._components, component: MappingProxyType(options)}
+
+    # new transformer for an option of a component
+    def build(self, component, name, settings):
+        options = self[component]
+        if name not in options:
+            raise ValueError(f"Parameter `{component}` must be one of {list(options)}")
+        return options[name](settings)
+
+    def __getitem__(self, component):
+        return self._components[component]
+
+    def __iter__(self):
+        return iter(self._components)
+
+    def __len__(self):
+        return len(self._components)
+
+# factory building `module.attr(*args, **kwargs)`, importing the module on first build. Arguments given as
+# setting(name) are read from the settings of the model, e.g. lazy(module, 'Transformer', setting('eps'))
+def lazy(module, attr, *args, **kwargs):
+    def factory(settings):
+        cls = getattr(importlib.import_module(module), attr)
+        return cls(
+            *[a.read(settings) if isinstance(a, setting) else a for a in args],
+            **{key: a.read(settings) if isinstance(a, setting) else a for (key, a) in kwargs.items()},
+        )
+    return factory
+
+# placeholder for a setting of the model, for arguments of lazy factories
+class setting:
+    def __init__(self, name):
+        self.name = name
+
+    def read(self, settings):
+        return settings[self.name]
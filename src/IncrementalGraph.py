@@ -0,0 +1,240 @@
+import numpy as np
+import scipy
+from sklearn.metrics import pairwise_distances
+from sklearn.neighbors import NearestNeighbors
+
+# neighbour graph that grows as batches of points arrive, for SpectralClustering.partial_fit.
+# KD-trees cannot take insertions, so points are indexed in segments merged like a binary counter: each
+# batch becomes a new segment and equal-sized neighbours are rebuilt together, keeping O(log n) segments and
+# amortised O(log n) rebuilding per point. New points are queried against every segment, and only the
+# graph entries involving them change: their own edges, plus for k-NN the old points they displace a
+# neighbour from. Degrees are updated for the points touched only, per-point state lives in geometrically
+# grown buffers, and the adjacency is assembled in O(nnz) when asked for rather than on every batch. It
+# follows the dense refinement transformers: neighbours of i down column i
+class IncrementalGraph:
+    SUPPORTED_REFINEMENTS = ['eps', 'knn', 'mutual_knn']
+
+    def __init__(self, refinement = 'eps', eps = 0.4, k = 20, metric = 'euclidean'):
+        if refinement not in IncrementalGraph.SUPPORTED_REFINEMENTS:
+            raise ValueError(f"Incremental graphs only support `refinement` of {IncrementalGraph.SUPPORTED_REFINEMENTS}")
+        self.refinement = refinement
+        self.eps        = eps
+        self.k          = k
+        self.metric     = metric
+
+        self.n_points  = 0
+        self._points   = None
+        self._segments = []
+
+        # edges of the latest batch into the points before it, one row per new point
+        self.batch_edges = scipy.sparse.csr_matrix((0, 0))
+
+        # edge weight of every point, the column sums of the adjacency
+        self._degrees = np.zeros(0)
+
+        # eps: (row, column) edges in both directions appended batch by batch, k-NN: sorted neighbour lists
+        self._edges    = np.zeros((0, 2), dtype=np.int64)
+        self._n_edges  = 0
+        self._nbr_idx  = np.zeros((0, k), dtype=np.int64)
+        self._nbr_dist = np.zeros((0, k))
+
+    @property
+    def points(self):
+        return self._points[:self.n_points]
+
+    @property
+    def degrees(self):
+        return self._degrees[:self.n_points]
+
+    # insert a batch of points, returns the indices assigned to them. Their edges into the points before them
+    # are left in batch_edges
+    def add(self, X):
+        X = np.asarray(X, dtype=np.float64)
+        if self.n_points == 0 and self.refinement != 'eps' and len(X) <= self.k:
+            raise ValueError(f'First batch must contain more than k = {self.k} points')
+
+        start = self.n_points
+        new   = np.arange(start, start + len(X))
+        self._points  = append_rows(self._points if start else np.zeros((0, X.shape[1])), start, X)
+        self._degrees = append_rows(self._degrees, start, np.zeros(len(X)))
+        self.n_points = start + len(X)
+        self._append_segment(start)
+
+        if self.refinement == 'eps':
+            self._add_eps_edges(new)
+        else:
+            self._add_knn_edges(new)
+
+        return new
+
+    # the whole graph as a sparse matrix, O(nnz)
+    def adjacency(self):
+        n = self.n_points
+        if self.refinement == 'eps':
+            rows, cols = self._edges[:self._n_edges].T
+            return scipy.sparse.csr_matrix((np.ones(len(rows)), (rows, cols)), shape=(n, n))
+
+        neighbours = scipy.sparse.csr_matrix(
+            (np.ones(n * self.k), (np.repeat(np.arange(n), self.k), self._nbr_idx[:n].ravel())), shape=(n, n)
+        )
+        res = neighbours.T.tocsr()
+        if self.refinement == 'mutual_knn':
+            res = res.multiply(neighbours).tocsr()
+        return res
+
+    # initial vectors for a warm-started eigensolve, V over the points before the latest batch extended to it:
+    # new points take the mean over their edges into the earlier points (zero when they have none)
+    def warm_start(self, V):
+        edges  = self.batch_edges
+        degree = np.asarray(edges.sum(axis=1)).reshape(-1, 1)
+        rows   = np.zeros((edges.shape[0], V.shape[1]))
+        np.divide(edges @ V, degree, out=rows, where=degree > 0)
+        return np.vstack((V, rows))
+
+    def _append_segment(self, start):
+        self._segments.append((start, self.n_points, None))
+
+        # merge while the newest segment is at least as large as the one before it, then index what changed
+        while len(self._segments) > 1:
+            (a_start, a_end, _), (b_start, b_end, _) = self._segments[-2:]
+            if b_end - b_start < a_end - a_start:
+                break
+            self._segments[-2:] = [(a_start, b_end, None)]
+
+        self._segments = [
+            (start, end, index if index is not None else self._build(start, end))
+            for (start, end, index) in self._segments
+        ]
+
+    def _build(self, start, end):
+        return NearestNeighbors(algorithm='kd_tree', metric=self.metric).fit(self._points[start:end].copy())
+
+    # radius query against every segment, as (query row, global point index, distance) triples
+    def _radius(self, X, radius):
+        rows, cols, dist = [np.zeros(0, dtype=np.int64)], [np.zeros(0, dtype=np.int64)], [np.zeros(0)]
+        for (start, end, index) in self._segments:
+            seg_dist, seg_idx = index.radius_neighbors(X, radius=radius)
+            rows.append(np.repeat(np.arange(len(X)), [len(i) for i in seg_idx]))
+            cols.append(np.concatenate(seg_idx).astype(np.int64) + start)
+            dist.append(np.concatenate(seg_dist))
+
+        return np.concatenate(rows), np.concatenate(cols), np.concatenate(dist)
+
+    # k nearest points over all segments, sorted by distance
+    def _kneighbors(self, X, k):
+        dist, idx = [], []
+        for (start, end, index) in self._segments:
+            seg_dist, seg_idx = index.kneighbors(X, n_neighbors=min(k, end - start))
+            dist.append(seg_dist)
+            idx.append(seg_idx + start)
+
+        dist, idx = np.hstack(dist), np.hstack(idx)
+        order = np.argsort(dist, axis=1, kind='stable')[:, :k]
+        return np.take_along_axis(dist, order, axis=1), np.take_along_axis(idx, order, axis=1)
+
+    def _add_eps_edges(self, new):
+        rows, cols, dist = self._radius(self.points[new], self.eps)
+        rows = new[rows]
+
+        # strict threshold and no self loops as EpsilonNNTransformer, edges to old points are added both ways
+        keep = (dist < self.eps) & (rows != cols)
+        rows, cols = rows[keep], cols[keep]
+        old  = cols < new[0]
+        self.batch_edges = scipy.sparse.csr_matrix(
+            (np.ones(old.sum()), (rows[old] - new[0], cols[old])), shape=(len(new), new[0])
+        )
+        rows, cols = np.concatenate((rows, cols[old])), np.concatenate((cols, rows[old]))
+
+        self._degrees[:self.n_points] += np.bincount(cols, minlength=self.n_points)
+        self._edges   = append_rows(self._edges, self._n_edges, np.column_stack((rows, cols)))
+        self._n_edges += len(rows)
+
+    def _add_knn_edges(self, new):
+        k = self.k
+        n_prev = new[0]
+
+        # neighbours of the new points among everything, dropping each point itself
+        dist, idx = self._kneighbors(self.points[new], k + 1)
+        not_self  = idx != new[:, None]
+        not_self[np.all(not_self, axis=1), -1] = False
+        dist = dist[not_self].reshape(len(new), k)
+        idx  = idx [not_self].reshape(len(new), k)
+
+        changed = np.zeros(0, dtype=np.int64)
+        if n_prev > 0:
+            changed = self._displace_neighbours(new)
+
+        self._nbr_idx  = append_rows(self._nbr_idx , n_prev, idx )
+        self._nbr_dist = append_rows(self._nbr_dist, n_prev, dist)
+
+        # column i holds the neighbours of i: a k-NN column always sums to k, a mutual k-NN one counts the
+        # neighbours holding i in return, which only changes for the new points and the lists they entered or left
+        if self.refinement == 'knn':
+            self._degrees[new] = k
+            old = idx < n_prev
+        else:
+            touched = np.unique(np.concatenate((new, changed)))
+            self._degrees[touched] = self._mutual(touched).sum(axis=1)
+            old = self._mutual(new) & (idx < n_prev)
+
+        rows = np.repeat(np.arange(len(new)), old.sum(axis=1))
+        self.batch_edges = scipy.sparse.csr_matrix((np.ones(len(rows)), (rows, idx[old])), shape=(len(new), n_prev))
+
+    # for each neighbour of the given points, whether it holds the point among its own neighbours
+    def _mutual(self, points):
+        return (self._nbr_idx[self._nbr_idx[points]] == points[:, None, None]).any(axis=2)
+
+    # old points whose k-th neighbour is further than a new point replace it. A radius query out to the largest
+    # k-th distance of any old point would reach further as the graph grows, a few outlying lists span much
+    # more than the rest, so the len(new) longest lists are compared with the batch directly and the query only
+    # reaches as far as the longest of the others. Returns the old points whose lists changed and the
+    # neighbours they held before
+    def _displace_neighbours(self, new):
+        n_prev = new[0]
+        kth    = self._nbr_dist[:n_prev, -1]
+        far    = np.argpartition(kth, -len(new))[-len(new):] if len(new) < n_prev else np.arange(n_prev)
+        near   = np.ones(n_prev, dtype=bool)
+        near[far] = False
+
+        rows, cols, dist = self._radius(self.points[new], kth[near].max(initial=0))
+        keep = cols < n_prev
+        keep[keep] = near[cols[keep]]
+        rows, cols, dist = new[rows[keep]], cols[keep], dist[keep]
+
+        far_dist = pairwise_distances(self.points[new], self.points[far], metric=self.metric)
+        far_rows, far_cols = np.nonzero(far_dist < kth[far])
+        rows = np.concatenate((rows, new[far_rows]))
+        cols = np.concatenate((cols, far[far_cols]))
+        dist = np.concatenate((dist, far_dist[far_rows, far_cols]))
+
+        closer = dist < kth[cols]
+        rows, cols, dist = rows[closer], cols[closer], dist[closer]
+
+        # each list the candidates displace into, merged with them by distance and cut back to k, in one sort
+        # grouping them by the old point
+        k      = self.k
+        points = np.unique(cols)
+        before = self._nbr_idx[points].ravel()
+        owner  = np.concatenate((np.repeat(points, k), cols))
+        dist   = np.concatenate((self._nbr_dist[points].ravel(), dist))
+        idx    = np.concatenate((before, rows))
+        order  = np.lexsort((dist, owner))
+        owner, dist, idx = owner[order], dist[order], idx[order]
+
+        rank = np.arange(len(owner)) - np.searchsorted(owner, owner)
+        best = rank < k
+        self._nbr_dist[points] = dist[best].reshape(-1, k)
+        self._nbr_idx [points] = idx [best].reshape(-1, k)
+        return np.concatenate((points, before))
+
+
+# rows appended after the first n rows of a buffer, which is grown geometrically so each append copies amortised
+# O(1) per row. Arrays taken from the old buffer (e.g. by built segments) keep their own storage
+def append_rows(buffer, n, rows):
+    needed = n + len(rows)
+    if needed > len(buffer):
+        grown = np.empty((max(needed, 2 * n),) + buffer.shape[1:], dtype=buffer.dtype)
+        grown[:n] = buffer[:n]
+        buffer = grown
+    buffer[n:needed] = rows
+    return buffer
@@ -1,84 +1,145 @@
-from sklearn.base import ClusterMixin
-from sklearn.pipeline import Pipeline
+import os
+import time
+import numpy as np
 
-from sklearn.preprocessing import StandardScaler, MinMaxScaler
+from src.ComponentRegistry import ComponentRegistry, lazy, setting
 
-from src.pipeline_transformers import (
-    NullTransformer                     ,
-    affinity        as affinity_lib     ,
-    refinement      as refinement_lib   ,
-    laplacian       as laplacian_lib    ,
-    decomposition   as decomposition_lib,
-    embedding       as embedding_lib    ,
-    clustering      as clustering_lib   ,
-    confidence      as confidence_lib   ,
-)
+# transformer modules are imported by the factories on first use, keeping sklearn and scipy out of the import
+TRANSFORMERS = 'src.pipeline_transformers.'
 
-class SpectralClustering(ClusterMixin):
+# clustering follows the cluster count chosen by an 'auto' embedding
+def _clustering(method):
+    def factory(settings):
+        num_clusters = 'auto' if settings['embedding'] == 'auto' else settings['num_clusters']
+        return lazy(TRANSFORMERS + 'clustering', 'ClusteringTransformer', method, num_clusters, setting('random_state'))(settings)
+    return factory
 
-    DEFAULT_EPS = 0.4
-    DEFAULT_K   = 20
+class SpectralClustering:
+    _estimator_type = 'clusterer'
 
-    # TODO: add support for providing k/eps for NN graph generation, checking that they are provided when selecting appropriate methods
+    DEFAULT_EPS       = 0.4
+    DEFAULT_K         = 20
+    DEFAULT_LANDMARKS = 500
+    SUPPORTED_DTYPES  = ['float64', 'float32']
 
-    # supported options for each pipeline component, note declared private to prevent mutation
+    # out-of-core fits spill these stage outputs to the scratch directory, and need an eigensolver that only
+    # takes products with the matrix-free laplacian
+    SCRATCH_STEPS          = ['affinity', 'refinement', 'laplacian']
+    SCRATCH_DECOMPOSITIONS = ['sparse', 'sparse_eigh', 'lobpcg', 'auto']
+
+    # fit_many stacks equally sized inputs into batches of about this many bytes per n x n stage output
+    BATCH_BYTES            = 2**27
+    BATCHED_DECOMPOSITIONS = ['dense', 'dense_eigh']
+
+    # partial_fit re-solves and re-clusters once the graph has grown by this fraction since it last did, from the
+    # previous eigenvectors within this many iterations (when the decomposition sets no max_iter of its own)
+    PARTIAL_REFRESH_GROWTH = 0.5
+    PARTIAL_MAX_ITER       = 20
+
+    # supported options for each pipeline component, each a factory building a new transformer for every model
+    # from its settings (component choices, eps, k, num_clusters, random_state, n_jobs, n_landmarks,
+    # landmark_sampling, metric). Further options are added with register_component
     # TODO: add in supported methods for each part of pipeline
-    COMPONENT_OPTIONS = {
+    COMPONENT_OPTIONS = ComponentRegistry({
         # data preprocessing: none, standard, min-max
         'standardisation': {
-            'none'    : NullTransformer.NullTransformer(),
-            'standard': StandardScaler(),
-            'min-max' : MinMaxScaler(),
+            'none'    : lazy(TRANSFORMERS + 'NullTransformer', 'NullTransformer'),
+            'standard': lazy('sklearn.preprocessing', 'StandardScaler'),
+            'min-max' : lazy('sklearn.preprocessing', 'MinMaxScaler'),
         },
         # similarity metrics to generate affinity matrix: euclidean, manhattan, Gaussian kernel
+        # tree variants build a neighbour index, refinement then produces a sparse graph without n x n distances
         'affinity': {
-            'euclidean': affinity_lib.AffinityTransformer('euclidean'),
-            'manhattan': affinity_lib.AffinityTransformer('manhattan'),
+            'euclidean'     : lazy(TRANSFORMERS + 'affinity', 'AffinityTransformer', 'euclidean'),
+            'manhattan'     : lazy(TRANSFORMERS + 'affinity', 'AffinityTransformer', 'manhattan'),
+            'euclidean_tree': lazy(TRANSFORMERS + 'affinity', 'AffinityTransformer', 'euclidean', algorithm = 'kd_tree'),
+            'manhattan_tree': lazy(TRANSFORMERS + 'affinity', 'AffinityTransformer', 'manhattan', algorithm = 'kd_tree'),
+            # chunked variants compute distances in blocks of rows refined straight to a sparse graph, for
+            # high-dimensional data where trees stop helping
+            'euclidean_chunked': lazy(TRANSFORMERS + 'affinity', 'AffinityTransformer', 'euclidean', algorithm = 'chunked'),
+            'manhattan_chunked': lazy(TRANSFORMERS + 'affinity', 'AffinityTransformer', 'manhattan', algorithm = 'chunked'),
         },
         # graph refinement/connecting: complete, eps-radius, k-NN, mutual k-NN
         'refinement': {
-            'eps'        : refinement_lib.EpsilonNNTransformer(DEFAULT_EPS),
-            'knn'        : refinement_lib.kNNTransformer(DEFAULT_K),
-            'mutual_knn' : refinement_lib.MutualKNNTransformer(DEFAULT_K),
-            'none'       : refinement_lib.CompleteTransformer(),
+            'eps'        : lazy(TRANSFORMERS + 'refinement', 'EpsilonNNTransformer', setting('eps')),
+            'knn'        : lazy(TRANSFORMERS + 'refinement', 'kNNTransformer'      , setting('k')),
+            'mutual_knn' : lazy(TRANSFORMERS + 'refinement', 'MutualKNNTransformer', setting('k')),
+            'none'       : lazy(TRANSFORMERS + 'refinement', 'CompleteTransformer'),
         },
         # type of laplacian generated: standard, normalised 
         'laplacian': {
-            'standard'  : laplacian_lib.LaplacianTransformer(normalize = False),
-            'normalised': laplacian_lib.LaplacianTransformer(normalize = True ),
+            'standard'  : lazy(TRANSFORMERS + 'laplacian', 'LaplacianTransformer', normalize = False),
+            'normalised': lazy(TRANSFORMERS + 'laplacian', 'LaplacianTransformer', normalize = True ),
         },
         # method of eigendcomposition: standard dense, sparse improvements, specialised for Fiedler, Fourier transformations
         'decomposition': {
-            'dense'      : decomposition_lib.DecompositionTransformer(method = 'dense'),
-            'dense_eigh' : decomposition_lib.DecompositionTransformer(method = 'dense_eigh'),
-            'sparse'     : decomposition_lib.DecompositionTransformer(method = 'sparse'),
-            'sparse_eigh': decomposition_lib.DecompositionTransformer(method = 'sparse_eigh'),
+            'dense'      : lazy(TRANSFORMERS + 'decomposition', 'DecompositionTransformer', method = 'dense'),
+            'dense_eigh' : lazy(TRANSFORMERS + 'decomposition', 'DecompositionTransformer', method = 'dense_eigh'),
+            'sparse'     : lazy(TRANSFORMERS + 'decomposition', 'DecompositionTransformer', method = 'sparse'),
+            'sparse_eigh': lazy(TRANSFORMERS + 'decomposition', 'DecompositionTransformer', method = 'sparse_eigh'),
+            # partial solvers, only the few smallest eigenpairs the embedding needs
+            'shift_invert': lazy(TRANSFORMERS + 'decomposition', 'DecompositionTransformer', method = 'shift_invert'),
+            'lobpcg'      : lazy(TRANSFORMERS + 'decomposition', 'DecompositionTransformer', method = 'lobpcg'),
+            'dense_subset': lazy(TRANSFORMERS + 'decomposition', 'DecompositionTransformer', method = 'dense_subset'),
+            # chosen per laplacian from its size, density and symmetry, see decomposition.plan
+            'auto'        : lazy(TRANSFORMERS + 'decomposition', 'DecompositionTransformer', method = 'auto', random_state = setting('random_state')),
         },
         # dimensionality of spectral embedding: single, more than one vec, dynamic selection of num_clusters
         'embedding': {
-            'single': embedding_lib.EmbeddingTransformer(method = 'single'),
+            'single': lazy(TRANSFORMERS + 'embedding', 'EmbeddingTransformer', 'single'),
+            'multi' : lazy(TRANSFORMERS + 'embedding', 'EmbeddingTransformer', 'multi', setting('num_clusters')),
+            'njw'   : lazy(TRANSFORMERS + 'embedding', 'EmbeddingTransformer', 'multi', setting('num_clusters'), normalize_rows = True),
+            # cluster count from the largest eigengap, replaces num_clusters
+            'auto'  : lazy(TRANSFORMERS + 'embedding', 'EmbeddingTransformer', 'auto' , normalize_rows = True),
         },
         # method for post-clustering: k-means, agglomerative, DBScan etc.
         'clustering': {
-            'k-means': clustering_lib.ClusteringTransformer(method = 'k-means', num_clusters = 2),
+            'k-means'  : _clustering('k-means'),
+            # seeded mini-batch k-means for large embeddings, 1-D embeddings split at their widest gaps
+            'minibatch': _clustering('minibatch'),
+            'gap'      : _clustering('gap'),
         },
         # whether to provide measure of confidence: True, False
+        # bootstrap re-runs the clustering over subsamples of the embedding for per-point confidence
         'confidence': {
-            'false': NullTransformer.NullTransformer(),
-        }
-    }
+            'false'    : lazy(TRANSFORMERS + 'NullTransformer', 'NullTransformer'),
+            'bootstrap': lazy(TRANSFORMERS + 'confidence', 'ConfidenceTransformer', 'bootstrap',
+                              n_jobs = setting('n_jobs'), random_state = setting('random_state')),
+        },
+        # exact pipeline, or Nystrom landmark approximation replacing affinity through decomposition.
+        # nystrom replaces the eps graph with a gaussian kernel of the chosen metric scaled by eps
+        'approximation': {
+            'none'   : lazy(TRANSFORMERS + 'NullTransformer', 'NullTransformer'),
+            'nystrom': lazy(TRANSFORMERS + 'approximation', 'NystromTransformer',
+                            setting('n_landmarks'), setting('landmark_sampling'), setting('metric'), setting('eps'),
+                            random_state = setting('random_state')),
+        },
+    })
+
+    # add an option to a component of every model created afterwards, e.g. a third-party clustering. The factory
+    # takes the settings dict of the model and returns a new transformer following the sklearn transformer API.
+    # Embedding options expose the number of eigenpairs they use as an `n_components` attribute, decomposition and
+    # approximation options expose theirs the same way and accept it through set_params
+    @classmethod
+    def register_component(cls, component, name, factory):
+        cls.COMPONENT_OPTIONS.register(component, name, factory)
 
-    # TODO: add random state intialisation
+    # TODO: add random state intialisation for remaining stages, currently only seeds landmark sampling and clustering
     def __init__(
         self                         , num_clusters,
         standardisation = 'none'     , affinity   = 'euclidean',
         refinement      = 'eps'      , laplacian  = 'standard',
         decomposition   = 'dense'    , embedding  = 'single',
         clustering      = 'k-means'  , confidence = 'false',
-        eps             = DEFAULT_EPS, k          = DEFAULT_K
+        eps             = DEFAULT_EPS, k          = DEFAULT_K,
+        approximation   = 'none'     , n_landmarks       = DEFAULT_LANDMARKS,
+        random_state    = None       , landmark_sampling = 'uniform',
+        cache           = None       , profile_memory    = False,
+        profile_callback = None      , dtype             = 'float64',
+        working_memory  = None       , scratch_dir       = None,
+        split_components = False     , n_jobs            = None,
+        memory_budget   = None       , keep_affinity     = False,
     ):
-        super().__init__()
-
         # check valid parameters are provided
         varname_display_pairs = [
             ('standardisation', standardisation),
@@ -89,6 +150,7 @@ class SpectralClustering(ClusterMixin):
             ('embedding'      , embedding      ),
             ('clustering'     , clustering     ),
             ('confidence'     , confidence     ),
+            ('approximation'  , approximation  ),
         ]
         for (var, val) in varname_display_pairs:
             val_options = SpectralClustering.COMPONENT_OPTIONS[var].keys()
@@ -99,24 +161,104 @@ class SpectralClustering(ClusterMixin):
         # TODO: check combination of parameters provided is valid
         # check if using eps refinement, eps param is valid
         # check if using k refinement, k is good
-        self.COMPONENT_OPTIONS['refinement']['eps']        = refinement_lib.EpsilonNNTransformer(eps)
-        self.COMPONENT_OPTIONS['refinement']['knn']        = refinement_lib.kNNTransformer(k)
-        self.COMPONENT_OPTIONS['refinement']['mutual_knn'] = refinement_lib.MutualKNNTransformer(k)
+        self.eps = eps
+        self.k   = k
+
+        # multi-vector embeddings take num_clusters eigenvectors, 'auto' chooses the count and clustering follows it
+        self.num_clusters = num_clusters
 
-        self.COMPONENT_OPTIONS['clustering']['k-means'] = clustering_lib.ClusteringTransformer('k-means', num_clusters)
+        # nystrom approximates the eigenvectors of the normalised laplacian of an eps-scaled kernel with its own
+        # m x m eigensolve, other laplacians or decomposition methods cannot apply to it
+        if approximation == 'nystrom' and refinement != 'eps':
+            raise ValueError("Nystrom approximation only supports `refinement` of 'eps'")
+        if approximation == 'nystrom' and laplacian != 'normalised':
+            raise ValueError("Nystrom approximation requires `laplacian` of 'normalised'")
+        if approximation == 'nystrom' and decomposition != 'dense':
+            raise ValueError("Nystrom approximation solves its own landmark eigenproblem, `decomposition` cannot be set")
+        self.random_state = random_state
 
+        # optional StageCache, shared between instances to reuse stage outputs across fits
+        self.cache = cache
+
+        # keep the affinity stage's output (e.g. the distance matrix) on the fitted model as affinity_, for
+        # evaluation to reuse without a cache, at the cost of holding it past the stages that consume it
+        self.keep_affinity = keep_affinity
+
+        # per-stage profiling of fit: peak memory tracing is opt-in, callback receives each stage record as it finishes
+        self.profile_memory   = profile_memory
+        self.profile_callback = profile_callback
+
+        # every step built fresh for this model, the approximation last as it takes the metric of the affinity
+        settings = {
+            **dict(varname_display_pairs),
+            'eps'         : eps        , 'k'                : k,
+            'num_clusters': num_clusters, 'random_state'    : random_state,
+            'n_jobs'      : n_jobs     , 'n_landmarks'      : n_landmarks,
+            'landmark_sampling': landmark_sampling,
+        }
+        steps = {}
+        for (name, option) in varname_display_pairs:
+            steps[name] = SpectralClustering.COMPONENT_OPTIONS.build(name, option, settings)
+            settings['metric'] = getattr(steps.get('affinity'), 'method', 'euclidean')
 
         # TODO: build out pipeline (instead of if/else statements in fit)
-        pipeline_steps = [
-            ('standardisation', self.COMPONENT_OPTIONS['standardisation'][standardisation]),
-            ('affinity'       , self.COMPONENT_OPTIONS['affinity'       ][affinity       ]),
-            ('refinement'     , self.COMPONENT_OPTIONS['refinement'     ][refinement     ]),
-            ('laplacian'      , self.COMPONENT_OPTIONS['laplacian'      ][laplacian      ]),
-            ('decomposition'  , self.COMPONENT_OPTIONS['decomposition'  ][decomposition  ]),
-            ('embedding'      , self.COMPONENT_OPTIONS['embedding'      ][embedding      ]),
-            ('clustering'     , self.COMPONENT_OPTIONS['clustering'     ][clustering     ]),
-            ('confidence'     , self.COMPONENT_OPTIONS['confidence'     ][confidence     ]),
-        ]
+        if approximation == 'nystrom':
+            names = ['standardisation', 'approximation', 'embedding', 'clustering', 'confidence']
+        else:
+            names = ['standardisation', 'affinity', 'refinement', 'laplacian', 'decomposition', 'embedding', 'clustering', 'confidence']
+        pipeline_steps = [(name, steps[name]) for name in names]
+
+        # partial solvers return only n_components eigenpairs, ask for at least as many as the embedding uses
+        n_components = steps['embedding'].n_components
+        for name in ['decomposition', 'approximation']:
+            if name in names and steps[name].n_components < n_components:
+                steps[name].set_params(n_components=n_components)
+
+        # reduced precision: float32 distances and laplacian, unweighted graphs held as booleans
+        if dtype not in SpectralClustering.SUPPORTED_DTYPES:
+            raise ValueError(f"Parameter `dtype` must be one of {SpectralClustering.SUPPORTED_DTYPES}")
+        self.dtype = dtype
+        if dtype != 'float64':
+            step_dtypes = {'affinity': np.float32, 'refinement': bool, 'laplacian': np.float32}
+            for name in step_dtypes:
+                if name in names:
+                    steps[name].set_params(dtype=step_dtypes[name])
+
+        # memory budget in MiB for each block of distances of the chunked affinities
+        self.working_memory = working_memory
+        if working_memory is not None and 'affinity' in names:
+            steps['affinity'].set_params(working_memory=working_memory)
+
+        # bytes an 'auto' decomposition lets its solver hold when choosing one, the transformer's default when None
+        self.memory_budget = memory_budget
+        if memory_budget is not None and 'decomposition' in names:
+            steps['decomposition'].set_params(memory_budget=memory_budget)
+
+        # out-of-core: graphs are written to files in the scratch directory and read through memory maps, the
+        # laplacian is left matrix-free over the mapped graph so only the eigensolver's vectors are held in memory
+        self.scratch_dir = scratch_dir
+        if scratch_dir is not None:
+            if decomposition not in SpectralClustering.SCRATCH_DECOMPOSITIONS:
+                raise ValueError(f"Parameter `scratch_dir` requires `decomposition` to be one of {SpectralClustering.SCRATCH_DECOMPOSITIONS}")
+            if cache is not None:
+                raise ValueError("Parameter `scratch_dir` cannot be combined with a `cache`")
+            # refinement of a full distance matrix builds the dense n x n graph in memory before it could be spilled
+            if getattr(steps.get('affinity'), 'algorithm', None) == 'brute':
+                raise ValueError("Parameter `scratch_dir` requires a chunked or tree `affinity`, not a full distance matrix")
+            os.makedirs(scratch_dir, exist_ok=True)
+            scratch_params = {'affinity': {'scratch_dir': scratch_dir}, 'laplacian': {'operator': True}}
+            for (name, params) in scratch_params.items():
+                if name in names:
+                    steps[name].set_params(**params)
+
+        # connected components of the graph found before the eigensolve: at least num_clusters components are
+        # the clusters themselves, fewer are decomposed block by block with n_jobs threads
+        self.split_components = split_components
+        self.n_jobs           = n_jobs
+        if split_components and (approximation != 'none' or scratch_dir is not None):
+            raise ValueError("Parameter `split_components` requires an explicit laplacian, without approximation or `scratch_dir`")
+
+        from sklearn.pipeline import Pipeline
         self.pipeline = Pipeline(pipeline_steps)
 
     # TODO: provide 
@@ -124,19 +266,322 @@ class SpectralClustering(ClusterMixin):
         # TODO: check X type, shape of X, save expected shape for future
         shape = X.shape
 
-        self.labels_ = self.pipeline.fit_transform(X)
+        self.graph_  = None
+        self.labels_ = self._fit_steps(X)
+        self.num_clusters_ = self.num_clusters if self.from_components_ else self.pipeline.named_steps['clustering'].num_clusters_
+
+        # solver chosen by an 'auto' decomposition and why, None when the stage did not run on the whole graph
+        whole_graph = not self.from_components_ and (self.n_components_ or 1) == 1
+        self.decomposition_plan_ = None
+        if self.decomposition == 'auto' and self.approximation == 'none' and whole_graph:
+            self.decomposition_plan_ = self.pipeline.named_steps['decomposition'].plan_
+
+        # per-point confidence and the co-association between clusters, when measured. Labels taken from the graph
+        # components depend on no resampling, every point is certain and points of different clusters never meet
+        if self.confidence != 'false' and self.from_components_:
+            sizes = np.bincount(self.labels_, minlength=self.num_clusters)
+            self.confidence_    = np.ones(len(self.labels_))
+            self.coassociation_ = np.diag((sizes > 1).astype(float))
+        elif self.confidence != 'false':
+            self.confidence_    = self.pipeline.named_steps['confidence'].confidence_
+            self.coassociation_ = self.pipeline.named_steps['confidence'].coassociation_
+        self._fit_extension(X)
         return self.labels_
 
+    # as sklearn's ClusterMixin, which is not inherited so importing the model does not import sklearn
+    def fit_predict(self, X, y=None):
+        return self.fit(X)
+
+    # fit many small independent inputs, returning the labels of each. Equally sized inputs are stacked so their
+    # distances, graphs, laplacians and dense eigendecompositions are each computed as one batch of 3-D arrays,
+    # leaving only standardisation, embedding and clustering to run per input. Labels match those of fitting
+    # each input on its own, which configurations without batched stages fall back to
+    def fit_many(self, Xs):
+        steps = self.pipeline.named_steps
+        if not self._batchable():
+            return [self.fit(X) for X in Xs]
+
+        Xs     = [np.asarray(steps['standardisation'].fit_transform(X), dtype=np.float64) for X in Xs]
+        groups = {}
+        for (i, X) in enumerate(Xs):
+            groups.setdefault(X.shape, []).append(i)
+
+        labels = [None] * len(Xs)
+        for (shape, members) in groups.items():
+            batch_size = max(1, SpectralClustering.BATCH_BYTES // (8 * shape[0] ** 2))
+            for start in range(0, len(members), batch_size):
+                batch = members[start:start + batch_size]
+                X = np.stack([Xs[i] for i in batch])
+                for name in ['affinity', 'refinement', 'laplacian', 'decomposition']:
+                    X = steps[name].transform_many(X)
+
+                for (i, result) in zip(batch, X):
+                    labels[i] = self._cluster(steps['embedding'].transform(result))
+
+        return labels
+
+    # whether fit_many can stack inputs: exact dense pipelines in double precision, without cache or scratch files
+    def _batchable(self):
+        steps = self.pipeline.named_steps
+        return (
+            self.approximation == 'none' and self.dtype == 'float64' and self.cache is None and self.scratch_dir is None
+            and not self.split_components
+            and steps['affinity'].algorithm == 'brute' and self.decomposition in SpectralClustering.BATCHED_DECOMPOSITIONS
+        )
+
+    # run each pipeline step in turn, taking the output and fitted step from the cache where it was seen before.
+    # every step is profiled into `profile_`, one record per step in pipeline order
+    def _fit_steps(self, X):
+        from src.StageCache import StageCache
+        from src.StageProfiler import StageProfiler
+        from src.pipeline_transformers import decomposition as decomposition_lib
+
+        key      = None if self.cache is None else self.cache.key(X)
+        profiler = StageProfiler(self.profile_memory, self.profile_callback)
+        self.profile_ = profiler.records
+        self.n_components_, self.component_labels_, self.from_components_ = None, None, False
+
+        # cache key of each cached step's output, for reading intermediates back (e.g. distances for evaluation)
+        self.cache_keys_ = {}
+        self.affinity_   = None
+
+        for (i, (name, step)) in enumerate(self.pipeline.steps):
+            # the affinity output is the input of the step after it
+            if self.keep_affinity and i > 0 and self.pipeline.steps[i - 1][0] == 'affinity':
+                self.affinity_ = X
+
+            # components of the graph handed on by refinement, recorded as a stage of their own
+            if self.split_components and name == 'laplacian':
+                labels = profiler.run('components', self._find_components, X)
+                if self.from_components_:
+                    return labels
+            if self.split_components and name == 'decomposition' and self.n_components_ > 1:
+                X = profiler.run(name, decomposition_lib.decompose_components, step, X, self.component_labels_, self.n_jobs)
+                continue
+
+            # confidence re-runs the clustering over the embedding it was given
+            if name == 'clustering':
+                embedding = X
+            if name == 'confidence':
+                X = profiler.run(name, self._fit_confidence, X, embedding)
+                continue
+
+            if self.scratch_dir is not None and name in SpectralClustering.SCRATCH_STEPS:
+                X = profiler.run(name, self._fit_scratch_step, step, X)
+                continue
+            if self.cache is None or name not in StageCache.CACHED_STEPS:
+                X = profiler.run(name, step.fit_transform, X)
+                continue
+
+            wall, cpu = time.perf_counter(), time.process_time()
+            key = self.cache.key(key, name, step)
+            self.cache_keys_[name] = key
+            hit = self.cache.get(key)
+            if hit is not None:
+                X, step = hit
+                self.pipeline.steps[i] = (name, step)
+                profiler.record(name, time.perf_counter() - wall, time.process_time() - cpu, None, X, cached=True)
+                continue
+
+            X = profiler.run(name, step.fit_transform, X)
+            self.cache.put(key, X, step)
+
+        return X
+
+    # cluster an embedding and measure the confidence of the clusters found
+    def _cluster(self, Z):
+        return self._fit_confidence(self.pipeline.named_steps['clustering'].fit_transform(Z), Z)
+
+    def _fit_confidence(self, labels, Z):
+        steps = self.pipeline.named_steps
+        if self.confidence == 'false':
+            return steps['confidence'].fit_transform(labels)
+        return steps['confidence'].fit_transform(labels, embedding=Z, clustering=steps['clustering'])
+
+    # connected components of the graph, labels straight from them when there are enough to be the clusters:
+    # the largest num_clusters - 1 components are clusters of their own and the rest share the last cluster
+    def _find_components(self, A):
+        import scipy
+        self.n_components_, self.component_labels_ = scipy.sparse.csgraph.connected_components(A, directed=False)
+        self.from_components_ = self.embedding != 'auto' and self.n_components_ >= self.num_clusters
+        if not self.from_components_:
+            return self.component_labels_
+
+        sizes = np.bincount(self.component_labels_)
+        rank  = np.empty(len(sizes), dtype=int)
+        rank[np.argsort(-sizes, kind='stable')] = np.arange(len(sizes))
+        return np.minimum(rank[self.component_labels_], self.num_clusters - 1)
+
+    # fit a step and move its output to the scratch directory, unless it was already written there
+    def _fit_scratch_step(self, step, X):
+        from src.pipeline_transformers import scratch as scratch_lib
+        return scratch_lib.spill(step.fit_transform(X), self.scratch_dir)
+
+    # keep the state predict needs: the embedding extension, and the training points for the neighbour index,
+    # which is only built (or taken from a tree affinity) on the first predict
+    def _fit_extension(self, X):
+        steps = self.pipeline.named_steps
+        self.index_  = None
+        self._fit_X  = None
+        if self.approximation == 'nystrom':
+            return
+
+        self._fit_X = X
+        if not self.from_components_:
+            steps['embedding' ].fit_extension(steps['laplacian'].degrees_, steps['laplacian'].normalize)
+
+    # neighbour index over the training points (those streamed so far after partial_fit) and the refinement's
+    # extension state over it, tree affinities already built the index during fit
+    def _fit_index(self):
+        steps = self.pipeline.named_steps
+        if self.graph_ is not None:
+            self.index_ = steps['affinity'].neighbour_index(self.graph_.points)
+        elif hasattr(steps['affinity'], 'index_'):
+            self.index_ = steps['affinity'].index_
+        else:
+            self.index_ = steps['affinity'].neighbour_index(steps['standardisation'].transform(self._fit_X))
+        steps['refinement'].fit_extension(self.index_)
+
+    # fit the model over a sweep of eps (eps refinement) or k (k-NN refinements) values, sharing the work between
+    # them: neighbours are found and sorted once, the graph grows as the parameter rises and each eigensolve is
+    # warm-started from the eigenvectors of the previous value (for the iterative decomposition methods)
+    def fit_path(self, X, eps = None, k = None):
+        if (eps is None) == (k is None):
+            raise ValueError('Exactly one of `eps` or `k` must be provided to fit a path over')
+        if eps is not None and self.refinement != 'eps':
+            raise ValueError("Fitting a path over `eps` requires `refinement` of 'eps'")
+        if k is not None and self.refinement not in ['knn', 'mutual_knn']:
+            raise ValueError("Fitting a path over `k` requires `refinement` of 'knn' or 'mutual_knn'")
+        if self.approximation != 'none':
+            raise ValueError('Fitting a path is not supported with an approximation')
+        from sklearn.base import clone
+        from src.pipeline_transformers import refinement as refinement_lib
+
+        steps = self.pipeline.named_steps
+        X     = steps['standardisation'].fit_transform(X)
+        index = steps['affinity'].neighbour_index(X)
+
+        values = eps if eps is not None else k
+        if eps is not None:
+            graphs = refinement_lib.eps_path_graphs(index, values)
+        else:
+            graphs = refinement_lib.knn_path_graphs(index, values, mutual = self.refinement == 'mutual_knn')
+
+        # a private copy of the decomposition, warm starts must not leak into other models
+        decomposition = clone(steps['decomposition'])
+
+        path = {}
+        for (value, A) in graphs:
+            start = time.perf_counter()
+            L      = steps['laplacian'    ].transform(A)
+            result = decomposition.transform(L)
+            labels = self._cluster(steps['embedding'].transform(result))
+            decomposition.set_params(initial_vectors = result.eigenvectors())
+
+            path[value] = (labels, {
+                'value'      : value,
+                'n_edges'    : A.nnz,
+                'eigenvalues': result.eigenvalues.tolist(),
+                'convergence': result.convergence,
+                'time'       : time.perf_counter() - start,
+            })
+
+        # report in the order the values were given
+        self.path_labels_      = np.array([path[v][0] for v in values])
+        self.path_diagnostics_ = [path[v][1] for v in values]
+        return self.path_labels_, self.path_diagnostics_
+
+    # streaming fit: insert a batch into a persistent neighbour graph and label its points by out-of-sample
+    # extension from their edges into the points before them, leaving earlier labels as they were, so a batch
+    # neither rebuilds the graph nor re-solves it. Every point is re-solved and re-clustered on the first batch,
+    # once the graph has grown by PARTIAL_REFRESH_GROWTH since the last refresh (amortised O(nnz) per point), when
+    # `refresh` is set or when the clustering cannot predict; `refresh=False` extends even past that growth. A
+    # refresh warm-starts from the previous eigenvectors extended to the new points, within a capped iteration
+    # budget. Standardisation is fitted on the first batch only, use an iterative decomposition ('lobpcg',
+    # 'shift_invert') for the warm start to help
+    def partial_fit(self, X, refresh = None):
+        if self.approximation != 'none':
+            raise ValueError('Partial fitting is not supported with an approximation')
+        from sklearn.base import clone
+        from src.IncrementalGraph import IncrementalGraph
+
+        steps = self.pipeline.named_steps
+        if getattr(self, 'graph_', None) is None:
+            if self.refinement not in IncrementalGraph.SUPPORTED_REFINEMENTS:
+                raise ValueError(f"Partial fitting requires `refinement` to be one of {IncrementalGraph.SUPPORTED_REFINEMENTS}")
+            steps['standardisation'].fit(X)
+            self.graph_ = IncrementalGraph(self.refinement, self.eps, self.k, steps['affinity'].method)
+            # a private copy of the decomposition, warm starts must not leak into other models
+            self._partial_decomposition = clone(steps['decomposition'])
+            self._partial_vectors       = None
+            self.n_refreshed_           = 0
+
+        new = self.graph_.add(steps['standardisation'].transform(X))
+        if self._partial_vectors is not None:
+            self._partial_vectors = self.graph_.warm_start(self._partial_vectors)
+
+        grown = self.graph_.n_points >= (1 + SpectralClustering.PARTIAL_REFRESH_GROWTH) * self.n_refreshed_
+        if self.n_refreshed_ == 0 or refresh or (refresh is None and grown) or not hasattr(steps['clustering'], 'predict'):
+            self._refresh_partial()
+        else:
+            Z = steps['embedding'].add_extension(self.graph_.batch_edges, self.graph_.degrees[new])
+            self.labels_ = np.concatenate((self.labels_, steps['clustering'].predict(Z)))
+
+        # predict builds its neighbour index over the streamed points on demand
+        self.index_ = None
+        return self
+
+    # eigensolve and clustering over every streamed point, warm-started after the first
+    def _refresh_partial(self):
+        steps = self.pipeline.named_steps
+        L = steps['laplacian'].transform(self.graph_.adjacency())
+
+        decomposition = self._partial_decomposition
+        if self._partial_vectors is not None:
+            max_iter = steps['decomposition'].max_iter or SpectralClustering.PARTIAL_MAX_ITER
+            decomposition.set_params(initial_vectors=self._partial_vectors, max_iter=max_iter)
+        result = decomposition.transform(L)
+        self._partial_vectors = result.eigenvectors()
+
+        self.labels_ = self._cluster(steps['embedding'].transform(result))
+        steps['embedding'].fit_extension(steps['laplacian'].degrees_, steps['laplacian'].normalize)
+        self.n_refreshed_ = self.graph_.n_points
+
     def predict(self, X):
-        if self.confidence != 'k-means':
-            raise ValueError('Cannot predict unseen points on model not trained with k-means post-clustering')
-        
-        raise ValueError('Predict method has not yet been implemented')
-    
-        # check X fits expected shape
+        if not hasattr(self.pipeline.named_steps['clustering'], 'predict'):
+            raise ValueError('Cannot predict unseen points, clustering step does not support predict')
+        if not hasattr(self, 'labels_'):
+            raise ValueError('Cannot predict unseen points before the model has been fit')
 
-        # map new points to same low dimensional space as fitted data
+        # TODO: check X fits expected shape
+        steps = self.pipeline.named_steps
+        if self.approximation == 'none' and self.index_ is None:
+            self._fit_index()
+        X = steps['standardisation'].transform(X)
+
+        # map new points to same low dimensional space as fitted data: nystrom extends over the landmarks,
+        # otherwise from the new points' edges to their neighbours in the training graph
+        if getattr(self, 'from_components_', False):
+            return self._predict_components(X)
+        if self.approximation == 'nystrom':
+            Z = steps['embedding'].scale_rows(steps['approximation'].extend(X)[:, steps['embedding'].components_])
+        else:
+            W = steps['refinement'].extend(self.index_, X)
+            Z = steps['embedding'].extend(W)
 
         # use post-clustering model to predict new classes in that space
+        return steps['clustering'].predict(Z)
+
+    # clusters taken straight from graph components: unseen points join the cluster they have the most edge weight
+    # to, or that of their nearest training point when they have no edges into the graph
+    def _predict_components(self, X):
+        import scipy
+        W      = scipy.sparse.csr_matrix(self.pipeline.named_steps['refinement'].extend(self.index_, X))
+        votes  = W @ np.eye(self.num_clusters)[self.labels_]
+        labels = np.argmax(votes, axis=1)
 
-        return X
\ No newline at end of file
+        isolated = np.asarray(W.sum(axis=1)).ravel() == 0
+        if isolated.any():
+            nearest = self.index_.kneighbors(X[isolated], n_neighbors=1, return_distance=False)[:, 0]
+            labels[isolated] = self.labels_[nearest]
+        return labels
@@ -0,0 +1,172 @@
+import os
+import copy
+import pickle
+import threading
+import tempfile
+from collections import OrderedDict
+
+import joblib
+import numpy as np
+import scipy.sparse as sp
+
+# content-addressed cache of pipeline stage outputs, shared between SpectralClustering instances so parameter
+# sweeps only recompute the stages downstream of the parameter that changed.
+# each stage is keyed on the key of its input (ultimately a hash of the data) plus the stage's class and
+# parameters, entries hold the stage output and the fitted stage; a small in-memory LRU tier, bounded by both
+# entry count and the bytes of the arrays it holds, sits in front of an optional on-disk tier which evicts least
+# recently used files once over its size budget
+class StageCache:
+    # stages whose output is determined by their input and parameters, clustering and confidence are random
+    CACHED_STEPS = ['standardisation', 'affinity', 'refinement', 'laplacian', 'decomposition', 'embedding', 'approximation']
+
+    def __init__(self, max_memory_items = 32, directory = None, max_disk_bytes = 2**30, max_memory_bytes = 2**30):
+        self.max_memory_items = max_memory_items
+        self.directory        = directory
+        self.max_disk_bytes   = max_disk_bytes
+        self.max_memory_bytes = max_memory_bytes
+
+        self.hits          = 0
+        self.misses        = 0
+        self.memory_bytes  = 0
+        self._memory       = OrderedDict()
+        self._lock         = threading.Lock()
+
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+
+    # key of the data itself, or of a stage given the key of its input
+    def key(self, parent, name = None, step = None):
+        if name is None:
+            return joblib.hash(parent)
+        return joblib.hash((parent, name, type(step).__module__, type(step).__qualname__, step.get_params()))
+
+    # cached (output, fitted stage) pair, or None on a miss
+    def get(self, key):
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                self._memory.move_to_end(key)
+                entry = entry[0]
+
+        if entry is None:
+            entry = self._disk_get(key)
+            if entry is not None:
+                self._memory_put(key, entry)
+
+        with self._lock:
+            if entry is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        if entry is None:
+            return None
+
+        # callers go on to mutate fitted stages, hand out a copy so the cached one stays as stored
+        output, step = entry
+        return output, copy.deepcopy(step)
+
+    def put(self, key, output, step):
+        entry = (output, copy.deepcopy(step))
+        self._memory_put(key, entry)
+        self._disk_put(key, entry)
+
+    def clear(self):
+        with self._lock:
+            self._memory.clear()
+            self.memory_bytes = 0
+        for path in self._disk_files():
+            os.remove(path)
+
+    # entries larger than the whole memory budget are only kept on disk
+    def _memory_put(self, key, entry):
+        size = nbytes(entry)
+        with self._lock:
+            if key in self._memory:
+                self.memory_bytes -= self._memory.pop(key)[1]
+            if size > self.max_memory_bytes:
+                return
+            self._memory[key] = (entry, size)
+            self.memory_bytes += size
+            while len(self._memory) > self.max_memory_items or self.memory_bytes > self.max_memory_bytes:
+                self.memory_bytes -= self._memory.popitem(last=False)[1][1]
+
+    def _disk_path(self, key):
+        return os.path.join(self.directory, f'{key}.pkl')
+
+    def _disk_files(self):
+        if self.directory is None:
+            return []
+        return [os.path.join(self.directory, f) for f in os.listdir(self.directory) if f.endswith('.pkl')]
+
+    def _disk_get(self, key):
+        if self.directory is None:
+            return None
+
+        path = self._disk_path(key)
+        try:
+            with open(path, 'rb') as f:
+                entry = pickle.load(f)
+        except (FileNotFoundError, EOFError, pickle.UnpicklingError):
+            return None
+
+        # touch the file so eviction sees it as recently used
+        os.utime(path)
+        return entry
+
+    def _disk_put(self, key, entry):
+        if self.directory is None:
+            return
+
+        # write to a temporary file and rename, so concurrent readers never see a partial entry
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump(entry, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, self._disk_path(key))
+
+        self._evict_disk()
+
+    # remove least recently used files until the directory is back under its size budget
+    def _evict_disk(self):
+        files = []
+        for path in self._disk_files():
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, path))
+
+        total = sum(size for (_, size, _) in files)
+        for (_, size, path) in sorted(files):
+            if total <= self.max_disk_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+
+# bytes of the arrays held by a stage output or fitted stage, found through containers and object attributes.
+# Memory-mapped arrays live on disk and count for nothing
+def nbytes(obj, seen = None):
+    seen = set() if seen is None else seen
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+
+    if isinstance(obj, np.memmap):
+        return 0
+    if isinstance(obj, np.ndarray):
+        return nbytes(obj.base, seen) if isinstance(obj.base, np.ndarray) else obj.nbytes
+    if sp.issparse(obj):
+        return sum(nbytes(a, seen) for a in vars(obj).values() if isinstance(a, np.ndarray))
+    # sklearn's KDTree and BallTree keep their arrays out of reach of vars()
+    if hasattr(obj, 'get_arrays'):
+        return nbytes(obj.get_arrays(), seen)
+    if isinstance(obj, (list, tuple, set)):
+        return sum(nbytes(o, seen) for o in obj)
+    if isinstance(obj, dict):
+        return sum(nbytes(o, seen) for o in obj.values())
+    if hasattr(obj, '__dict__'):
+        return nbytes(vars(obj), seen)
+    return 0
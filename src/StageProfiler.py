@@ -0,0 +1,78 @@
+import time
+import tracemalloc
+
+import numpy as np
+import scipy
+from sklearn.neighbors import NearestNeighbors
+
+from src.pipeline_transformers.decomposition import SpectralDecomposition
+
+# per-stage profile of a SpectralClustering fit: wall and CPU time of each pipeline step, the peak memory traced
+# while it ran (optional, tracemalloc slows allocation heavy stages) and a summary of the output it handed on.
+# each record is passed to the callback as soon as its stage finishes, so long fits can be watched as they run
+class StageProfiler:
+    def __init__(self, memory = False, callback = None):
+        self.memory   = memory
+        self.callback = callback
+        self.records  = []
+
+    # time fn(*args) as the named stage, returning its output
+    def run(self, name, fn, *args):
+        started_tracing = self.memory and not tracemalloc.is_tracing()
+        if started_tracing:
+            tracemalloc.start()
+        if self.memory:
+            tracemalloc.reset_peak()
+            baseline = tracemalloc.get_traced_memory()[0]
+
+        wall, cpu = time.perf_counter(), time.process_time()
+        output    = fn(*args)
+        wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+
+        peak = None
+        if self.memory:
+            peak = tracemalloc.get_traced_memory()[1] - baseline
+        if started_tracing:
+            tracemalloc.stop()
+
+        self.record(name, wall, cpu, peak, output, cached=False)
+        return output
+
+    def record(self, name, wall_time, cpu_time, peak_memory, output, **extra):
+        entry = {
+            'stage'      : name,
+            'wall_time'  : wall_time,
+            'cpu_time'   : cpu_time,
+            'peak_memory': peak_memory,
+            **describe_output(output),
+            **extra,
+        }
+        self.records.append(entry)
+        if self.callback is not None:
+            self.callback(entry)
+        return entry
+
+
+# type, shape and dtype of a stage output, with the number of stored entries and density for square matrices
+def describe_output(X):
+    if isinstance(X, SpectralDecomposition):
+        return {'output_type': 'SpectralDecomposition', 'shape': list(X.shape), 'dtype': str(X.eigenvalues.dtype)}
+    if isinstance(X, NearestNeighbors):
+        return {'output_type': 'NearestNeighbors', 'shape': [X.n_samples_fit_, X.n_features_in_], 'dtype': None}
+
+    res = {'output_type': type(X).__name__, 'shape': list(np.shape(X)) if hasattr(X, 'shape') else None, 'dtype': None}
+    if hasattr(X, 'dtype'):
+        res['dtype'] = str(X.dtype)
+
+    shape = getattr(X, 'shape', None)
+    if shape is not None and len(shape) == 2 and shape[0] == shape[1] and shape[0] > 0:
+        if scipy.sparse.issparse(X):
+            nnz = X.nnz
+        elif isinstance(X, np.ndarray):
+            nnz = int(np.count_nonzero(X))
+        else:
+            return res
+        res['nnz']     = nnz
+        res['density'] = nnz / (shape[0] * shape[1])
+
+    return res
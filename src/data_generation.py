@@ -1,6 +1,8 @@
 import sklearn.datasets
 import numpy as np
-import math
+
+# points generated at once by the chunked generators, about 32MiB of float64 coordinates
+CHUNK_POINTS = 2**21
 
 def sklearn_make_moons(n_points, sigma, rand_state = None):
     X, labels = sklearn.datasets.make_moons(n_points, shuffle=True, noise=sigma, random_state=rand_state)
@@ -12,29 +14,49 @@ def make_many_moons(n_points, n_moons, sigma, y_shift = 0.5, rand_state = None):
     # seed if set
     rng = np.random.default_rng(rand_state)
 
-    # calculate number of points per moon
-    n_points_per_moon = math.ceil(n_points / n_moons)
-    moons = []
-
-    for y in range(n_moons):
-        # generate random values over pi range, factor to flip if an odd indexed moon
-        q = rng.uniform(0,np.pi,size=n_points_per_moon)
-        factor = -1 if y % 2 else 1
-        
-        # calculate x and y positions based on circle transformations, and cluster ground_truth
-        moon = np.zeros((n_points_per_moon, 3))
-        moon[:,0] = np.cos(q) + y + 0.3*y
-        moon[:,1] = (np.sin(q) * factor) + (factor == -1) * y_shift
-        moon[:,2] = y
-        moons.append(moon)
-
-        # apply random noise to x and y points
-        noise = rng.normal(0, sigma, size=moon[:,:2].shape)
-        moon[:,:2] += noise
-
-    # join into np_array, randomise order and trim additional points
-    moons = np.concatenate(moons)
-    rng.shuffle(moons)
-    moons = moons[:n_points, :]
-
-    return moons[:,:2], moons[:,2]
+    # moons of equal size (to within a point) in random order, all generated in one pass
+    labels = rng.permutation(n_points) % n_moons
+    return _moon_points(rng, labels, sigma, y_shift), labels
+
+# the points of make_many_moons in blocks of chunk_size, never holding more than one block. Block i is seeded
+# from the seed and i alone, so blocks can be regenerated (or generated in parallel) independently of each other;
+# each block holds every moon equally, shuffled within the block
+def iter_many_moons(n_points, n_moons, sigma, y_shift = 0.5, rand_state = None, chunk_size = CHUNK_POINTS):
+    entropy = np.random.SeedSequence(rand_state).entropy
+    for (i, start) in enumerate(range(0, n_points, chunk_size)):
+        rng    = np.random.default_rng(np.random.SeedSequence(entropy, spawn_key=(i,)))
+        labels = rng.permutation(np.arange(start, min(start + chunk_size, n_points)) % n_moons)
+        yield _moon_points(rng, labels, sigma, y_shift), labels
+
+# write the blocks of iter_many_moons straight to .npy files, points to `path` and labels to `labels_path` when
+# given, returning them memory-mapped read-only. Inputs larger than memory can then be built and fitted out-of-core
+def write_many_moons(path, n_points, n_moons, sigma, y_shift = 0.5, rand_state = None, chunk_size = CHUNK_POINTS, labels_path = None, dtype = 'float64'):
+    X      = np.lib.format.open_memmap(path, mode='w+', dtype=dtype, shape=(n_points, 2))
+    labels = None if labels_path is None else np.lib.format.open_memmap(labels_path, mode='w+', dtype=np.int64, shape=(n_points,))
+
+    start = 0
+    for (X_chunk, labels_chunk) in iter_many_moons(n_points, n_moons, sigma, y_shift, rand_state, chunk_size):
+        X[start:start + len(X_chunk)] = X_chunk
+        if labels is not None:
+            labels[start:start + len(X_chunk)] = labels_chunk
+        start += len(X_chunk)
+
+    X.flush()
+    del X
+    if labels is not None:
+        labels.flush()
+        del labels
+        labels = np.load(labels_path, mmap_mode='r')
+    return np.load(path, mmap_mode='r'), labels
+
+# noisy points on the moon of each label: moons sit side by side, every other one flipped and shifted up by y_shift
+def _moon_points(rng, labels, sigma, y_shift):
+    q    = rng.uniform(0, np.pi, size=len(labels))
+    flip = labels % 2 == 1
+
+    # calculate x and y positions based on circle transformations, then apply random noise
+    X = np.empty((len(labels), 2))
+    X[:, 0] = np.cos(q) + 1.3 * labels
+    X[:, 1] = np.where(flip, -np.sin(q) + y_shift, np.sin(q))
+    X += rng.normal(0, sigma, size=X.shape)
+    return X
@@ -0,0 +1,180 @@
+import numpy as np
+from scipy.special import gammaln
+from sklearn import metrics
+from sklearn.metrics.cluster import contingency_matrix, mutual_info_score
+from sklearn.metrics.pairwise import pairwise_distances
+
+# clustering metrics of a fitted SpectralClustering. Silhouettes are computed from the distances the affinity
+# stage already produced when the model kept them (keep_affinity) or its StageCache still holds them, exactly
+# below SAMPLE_THRESHOLD points and estimated from a uniform sample of SAMPLE_SIZE points (with its standard
+# error) above it. The label comparison scores all come from one contingency table of the ground truth against
+# the predicted labels
+
+
+SAMPLE_THRESHOLD = 5000
+SAMPLE_SIZE      = 2000
+
+# rows of distances computed at once for the silhouette
+CHUNK_BYTES = 2**26
+
+
+# every metric of conftest's results entries (plus the silhouette's standard error), labels default to those the
+# model was fitted to. Label comparison scores need the ground truth
+def evaluate(model, X, ground_truth = None, labels = None, sample_threshold = SAMPLE_THRESHOLD, sample_size = SAMPLE_SIZE, random_state = None):
+    labels = model.labels_ if labels is None else labels
+    X      = np.asarray(X)
+
+    scores = {} if ground_truth is None else label_scores(ground_truth, labels)
+    size   = None if len(X) <= sample_threshold else sample_size
+    scores['silhouette_score'], scores['silhouette_stderr'] = silhouette(
+        labels, X, model_distances(model, X), sample_size=size, random_state=random_state,
+    )
+    scores['calinski_harabasz_score'] = metrics.calinski_harabasz_score(X, labels)
+    scores['davies_bouldin_score'   ] = metrics.davies_bouldin_score   (X, labels)
+    return scores
+
+
+# the euclidean distances between the points of X output by the model's affinity stage, kept on the model or in
+# its cache. Only valid when the stage saw X unchanged (no standardisation) and computed them exactly, otherwise None
+def model_distances(model, X, metric = 'euclidean'):
+    if model is None or model.approximation != 'none' or model.standardisation != 'none':
+        return None
+    step = model.pipeline.named_steps['affinity']
+    if step.method != metric or step.algorithm != 'brute' or step.dtype != np.float64 or model.scratch_dir is not None:
+        return None
+
+    D = getattr(model, 'affinity_', None)
+    if D is None and model.cache is not None:
+        key = getattr(model, 'cache_keys_', {}).get('affinity')
+        hit = None if key is None else model.cache.get(key)
+        D   = None if hit is None else hit[0]
+    if not isinstance(D, np.ndarray) or D.shape != (len(X), len(X)):
+        return None
+    return D
+
+
+# mean silhouette and its standard error: exact over every point (error 0), or estimated from sample_size points
+# drawn without replacement, each scored against all points. Distances are rows of the precomputed matrix when
+# given, otherwise computed from X a block of rows at a time
+def silhouette(labels, X = None, distances = None, metric = 'euclidean', sample_size = None, random_state = None):
+    _, labels = np.unique(labels, return_inverse=True)
+    n, k      = len(labels), labels.max() + 1
+    if not 2 <= k <= n - 1:
+        raise ValueError(f'Number of labels is {k}. Valid values are 2 to n_samples - 1 (inclusive)')
+
+    rows = np.arange(n)
+    if sample_size is not None and sample_size < n:
+        rows = np.sort(np.random.default_rng(random_state).choice(n, size=sample_size, replace=False))
+
+    sizes  = np.bincount(labels, minlength=k)
+    onehot = np.eye(k)[labels]
+    step   = max(1, CHUNK_BYTES // (8 * n))
+    s      = np.empty(len(rows))
+    for start in range(0, len(rows), step):
+        block = rows[start:start + step]
+        D     = distances[block] if distances is not None else pairwise_distances(X[block], X, metric)
+        s[start:start + step] = _silhouette_rows(D @ onehot, labels[block], sizes)
+
+    if len(rows) == n:
+        return float(s.mean()), 0.0
+    # finite population correction for sampling without replacement
+    stderr = s.std(ddof=1) / np.sqrt(len(rows)) * np.sqrt(1 - len(rows) / n)
+    return float(s.mean()), float(stderr)
+
+
+# silhouettes of points from their summed distances to each cluster, 0 for points alone in their cluster
+def _silhouette_rows(sums, own, sizes):
+    index = np.arange(len(own))
+    a     = sums[index, own] / np.maximum(sizes[own] - 1, 1)
+    means = sums / sizes
+    means[index, own] = np.inf
+    b     = means.min(axis=1)
+
+    s = np.zeros(len(own))
+    np.divide(b - a, np.maximum(a, b), out=s, where=(sizes[own] > 1) & (np.maximum(a, b) > 0))
+    return s
+
+
+# adjusted rand, (adjusted, normalised) mutual information, homogeneity, completeness, v-measure and
+# Fowlkes-Mallows, all from one sparse contingency table, matching the sklearn scores of the same names
+def label_scores(ground_truth, pred_labels):
+    C = contingency_matrix(ground_truth, pred_labels, sparse=True).astype(np.int64)
+    n = int(C.sum())
+    n_true, n_pred = C.shape
+    rows = np.ravel(C.sum(axis=1))
+    cols = np.ravel(C.sum(axis=0))
+
+    # pairs of points together in both labelings, and in each of them
+    sum_squares = int((C.data.astype(np.int64) ** 2).sum())
+    both = sum_squares - n
+    true = int((rows ** 2).sum()) - n
+    pred = int((cols ** 2).sum()) - n
+
+    # pair confusion counts for the adjusted rand score, as Python integers so they do not overflow
+    tp, fn, fp = both, true - both, pred - both
+    tn = n * n - n - tp - fn - fp
+    ari = 1.0 if fn == 0 and fp == 0 else 2.0 * (tp * tn - fn * fp) / ((tp + fn) * (fn + tn) + (tp + fp) * (fp + tn))
+
+    mi     = mutual_info_score(None, None, contingency=C)
+    h_true = _entropy(rows)
+    h_pred = _entropy(cols)
+    homogeneity  = mi / h_true if h_true else 1.0
+    completeness = mi / h_pred if h_pred else 1.0
+    v_measure    = 0.0 if homogeneity + completeness == 0 else 2 * homogeneity * completeness / (homogeneity + completeness)
+
+    # one cluster in both is a perfect match, in only one of them nothing is shared
+    mean_h = (h_true + h_pred) / 2
+    if n_true == n_pred == 1:
+        ami = nmi = 1.0
+    else:
+        nmi = 0.0 if mi == 0 else mi / mean_h
+        ami = 0.0 if n_true == 1 or n_pred == 1 else _adjusted_mi(mi, _expected_mi(rows, cols, n), mean_h)
+
+    return {
+        'adjusted_rand_score'         : float(ari),
+        'adjusted_mutual_info_score'  : float(ami),
+        'normalized_mutual_info_score': float(nmi),
+        'homogeneity_score'           : float(homogeneity),
+        'completeness_score'          : float(completeness),
+        'v_measure_score'             : float(v_measure),
+        'fowlkes_mallows_score'       : float(np.sqrt(both / true) * np.sqrt(both / pred)) if both != 0 else 0.0,
+    }
+
+
+def _entropy(counts):
+    counts = counts[counts > 0]
+    if len(counts) <= 1:
+        return 0.0
+    p = counts / counts.sum()
+    return float(-(p * np.log(p)).sum())
+
+
+# mutual information expected of labelings with these cluster sizes under the hypergeometric model of random
+# labels: each cell count n_ij runs from max(1, a_i + b_j - n) to min(a_i, b_j), and its log probability is taken
+# from log-gamma values, one row of the table at a time over all its columns and counts
+def _expected_mi(rows, cols, n):
+    a    = rows.astype(np.float64)
+    b    = cols.astype(np.float64)
+    lg_b = gammaln(b + 1) + gammaln(n - b + 1) - gammaln(n + 1)
+
+    emi = 0.0
+    for a_i in a:
+        n_ij  = np.arange(1, min(a_i, b.max()) + 1)[:, None]
+        valid = (n_ij >= a_i + b - n) & (n_ij <= b)
+        n_ij, b_j, lg_j = np.broadcast_arrays(n_ij, b, lg_b)
+        n_ij, b_j, lg_j = n_ij[valid], b_j[valid], lg_j[valid]
+
+        log_p = (gammaln(a_i + 1) + gammaln(n - a_i + 1) + lg_j
+                 - gammaln(n_ij + 1) - gammaln(a_i - n_ij + 1) - gammaln(b_j - n_ij + 1) - gammaln(n - a_i - b_j + n_ij + 1))
+        emi  += float((n_ij / n * (np.log(n * n_ij) - np.log(a_i * b_j)) * np.exp(log_p)).sum())
+    return emi
+
+
+# (mi - emi) / (mean entropy - emi), kept away from 0 / 0 with the sign of each side as sklearn does
+def _adjusted_mi(mi, emi, mean_h):
+    eps = np.finfo(np.float64).eps
+    denominator = mean_h - emi
+    denominator = min(denominator, -eps) if denominator < 0 else max(denominator, eps)
+    numerator   = mi - emi
+    numerator   = min(numerator, -eps) if numerator < 0 else max(numerator, eps)
+    return numerator / denominator
@@ -1,19 +1,108 @@
+from sklearn import get_config
 from sklearn.base import BaseEstimator, TransformerMixin
-from sklearn.metrics.pairwise import pairwise_distances
+from sklearn.metrics.pairwise import pairwise_distances, pairwise_distances_chunked
+from sklearn.utils import gen_batches
+from sklearn.neighbors import NearestNeighbors
+import numpy as np
+
+from src.pipeline_transformers import scratch
 
 # TODO: add error checking
 # TODO: implement guassian kernel distance
 
 class AffinityTransformer(BaseEstimator, TransformerMixin):
     SUPPORTED_DISTANCE_METRICS = ['euclidean', 'manhattan']
+    SUPPORTED_ALGORITHMS       = ['brute', 'kd_tree', 'ball_tree', 'chunked']
+    CHUNK_BYTES                = 2**20
 
-    def __init__(self, method = 'euclidean'):
+    def __init__(self, method = 'euclidean', algorithm = 'brute', dtype = np.float64, working_memory = None, scratch_dir = None):
         if method not in AffinityTransformer.SUPPORTED_DISTANCE_METRICS:
             raise ValueError(f"Required module parameter has not yet been implemented")
-        self.method = method
-    
+        if algorithm not in AffinityTransformer.SUPPORTED_ALGORITHMS:
+            raise ValueError(f"Required module parameter has not yet been implemented")
+        self.method    = method
+        self.algorithm = algorithm
+        self.dtype     = dtype
+
+        # budget in MiB for a block of chunked distances, defaults to sklearn's working_memory setting
+        self.working_memory = working_memory
+
+        # out-of-core: distances, or the sparse graph rows reduced from them, are written to files in this directory
+        self.scratch_dir = scratch_dir
+
     def fit(self, X, y=None):
         return self
 
     def transform(self, X, y=None):
-        return pairwise_distances(X, X, self.method)
\ No newline at end of file
+        if self.algorithm == 'brute' and self.dtype == np.float64 and self.scratch_dir is None:
+            return pairwise_distances(X, X, self.method)
+        if self.algorithm == 'brute':
+            return self._distances(X)
+
+        # chunked: refinement reduces blocks of rows straight to sparse graph rows, distances are never all held
+        if self.algorithm == 'chunked':
+            return ChunkedDistances(X, self.method, self.working_memory, self.scratch_dir)
+
+        # tree based: hand a fitted neighbour index to refinement instead of the dense n x n distances,
+        # refinement then only queries the neighbours it needs and builds a sparse graph
+        self.index_ = NearestNeighbors(algorithm=self.algorithm, metric=self.method).fit(X)
+        return self.index_
+
+    # distances of a stack of equally sized inputs, shape (batch, n, d), as one (batch, n, n) array. Brute force
+    # only, computed as pairwise_distances does so each slice matches transform of that input
+    def transform_many(self, X):
+        if self.method == 'euclidean':
+            XX = np.einsum('bij,bij->bi', X, X)
+            D  = -2 * (X @ X.transpose(0, 2, 1))
+            D += XX[:, :, None]
+            D += XX[:, None, :]
+            np.maximum(D, 0, out=D)
+            D[:, np.arange(X.shape[1]), np.arange(X.shape[1])] = 0
+            return np.sqrt(D, out=D)
+
+        D = np.zeros((X.shape[0], X.shape[1], X.shape[1]))
+        for f in range(X.shape[2]):
+            D += np.abs(X[:, :, None, f] - X[:, None, :, f])
+        return D
+
+    # neighbour index over X for queries outside the pipeline, brute force affinities use a KD-tree, chunked
+    # affinities stay brute force as they are chosen where trees stop helping
+    def neighbour_index(self, X):
+        algorithm = {'brute': 'kd_tree', 'chunked': 'brute'}.get(self.algorithm, self.algorithm)
+        return NearestNeighbors(algorithm=algorithm, metric=self.method).fit(X)
+
+    # distances stored at reduced precision or on disk, computed in float64 row chunks so a float64 n x n matrix
+    # is never held in memory
+    def _distances(self, X):
+        n = len(X)
+        D = scratch.empty((n, n), self.dtype, self.scratch_dir)
+        for rows in gen_batches(n, max(1, AffinityTransformer.CHUNK_BYTES // (8 * n))):
+            D[rows] = pairwise_distances(X[rows], X, self.method)
+        return D
+
+# lazy n x n distance matrix, handed from affinity to refinement in place of the full matrix. Blocks of rows are
+# computed within the working memory budget and reduced as they go, only one block of distances is held at once
+class ChunkedDistances:
+    def __init__(self, X, metric, working_memory = None, scratch_dir = None):
+        self.X              = X
+        self.metric         = metric
+        self.working_memory = working_memory
+        self.scratch_dir    = scratch_dir
+        self.shape          = (len(X), len(X))
+        self.dtype          = np.dtype(np.float64)
+
+    def __len__(self):
+        return len(self.X)
+
+    # reduce_func(D_chunk, start) over blocks of rows, yielding each reduced block in turn. Working memory also
+    # covers the extra bytes per distance the reduction allocates, e.g. 8 for an argpartition of the block
+    def reduce_rows(self, reduce_func, extra_bytes = 0):
+        working_memory = self.working_memory or get_config()['working_memory']
+        working_memory = working_memory * 8 / (8 + extra_bytes)
+        return pairwise_distances_chunked(
+            self.X, metric=self.metric, reduce_func=reduce_func, working_memory=working_memory,
+        )
+
+    # sparse graph from blocks of graph rows, written to the scratch directory as they arrive when there is one
+    def stack_rows(self, blocks, dtype):
+        return scratch.stack_rows(blocks, len(self), dtype, self.scratch_dir)
@@ -0,0 +1,115 @@
+from sklearn.base import BaseEstimator, TransformerMixin
+from sklearn.cluster import kmeans_plusplus
+from sklearn.metrics.pairwise import pairwise_distances
+from sklearn.utils import gen_batches
+import numpy as np
+
+from src.pipeline_transformers.decomposition import SpectralDecomposition
+
+# TODO: add error checking
+
+# Nystrom approximation of the normalised spectral decomposition (Fowlkes et al.), replacing the affinity,
+# refinement, laplacian and decomposition stages: only the n x m affinity between all points and m sampled
+# landmarks is formed, the m x m eigenproblem is solved and extended to every point.
+# The hard eps threshold is not a positive semi-definite kernel, which makes the extension unstable, so a
+# Gaussian kernel of width eps / 2 is used instead: points inside the eps radius keep most of their weight
+class NystromTransformer(BaseEstimator, TransformerMixin):
+    SUPPORTED_SAMPLING = ['uniform', 'k-means++']
+    CHUNK_ROWS         = 4096
+
+    def __init__(self, n_landmarks = 500, sampling = 'uniform', metric = 'euclidean', eps = 0.4, n_components = 6, random_state = None):
+        if sampling not in NystromTransformer.SUPPORTED_SAMPLING:
+            raise ValueError(f"Required module parameter has not yet been implemented")
+        self.n_landmarks  = n_landmarks
+        self.sampling     = sampling
+        self.metric       = metric
+        self.eps          = eps
+        self.n_components = n_components
+        self.random_state = random_state
+
+    def fit(self, X, y=None):
+        return self
+
+    def transform(self, X, y=None):
+        n = len(X)
+        m = min(self.n_landmarks, n)
+
+        # affinity restricted to edges with a landmark, the n x m float32 matrix is the only O(n) matrix
+        landmarks = self._sample_landmarks(X, m)
+        others    = np.ones(n, dtype=bool)
+        others[landmarks] = False
+        W = self._landmark_affinity(X, X[landmarks])
+        A = np.array(W[landmarks], dtype=np.float64)
+
+        # estimate degrees: landmarks see every point, for the rest the unseen block between non-landmarks
+        # is approximated through the landmarks as B^T A^-1 B
+        A_pinv   = np.linalg.pinv(A, hermitian=True)
+        b_degree = W.sum(axis=0) - A.sum(axis=0)
+        a_inv_b  = A_pinv @ b_degree
+        d = np.empty(n)
+        for rows in gen_batches(n, NystromTransformer.CHUNK_ROWS):
+            d[rows] = W[rows].sum(axis=1) + W[rows] @ a_inv_b
+        d[landmarks] = A.sum(axis=1) + b_degree
+        s = np.zeros(n)
+        np.divide(1, np.sqrt(np.maximum(d, 0)), out=s, where=d > 0)
+
+        # symmetric normalisation D^-1/2 W D^-1/2 of the landmark block and of B B^T, built up in row chunks
+        s_m = s[landmarks]
+        A   = A * np.outer(s_m, s_m)
+        BBt = np.zeros((m, m))
+        for rows in gen_batches(n, NystromTransformer.CHUNK_ROWS):
+            W_c = W[rows][others[rows]]
+            s_c = s[rows][others[rows]]
+            BBt += (W_c * s_c[:, None] ** 2).T @ W_c
+        BBt *= np.outer(s_m, s_m)
+
+        # one-shot orthogonalisation: eigendecompose Q = A + A^-1/2 B B^T A^-1/2, only m x m work
+        A_val, A_vec = np.linalg.eigh(A)
+        keep  = A_val > 1e-10
+        A_isq = (A_vec[:, keep] / np.sqrt(A_val[keep])) @ A_vec[:, keep].T
+        Q     = A + A_isq @ BBt @ A_isq
+
+        Q_val, Q_vec = np.linalg.eigh(Q)
+        top   = np.argsort(Q_val)[::-1][:self.n_components]
+        top   = top[Q_val[top] > 1e-10]
+        Q_val = Q_val[top]
+
+        # extension to all points, eigenvectors of the normalised affinity are those of the normalised laplacian
+        projection = A_isq @ (Q_vec[:, top] / np.sqrt(Q_val))
+        eig_vec    = np.empty((n, len(top)))
+        for rows in gen_batches(n, NystromTransformer.CHUNK_ROWS):
+            eig_vec[rows] = s[rows, None] * ((W[rows] * s_m) @ projection)
+
+        # keep what is needed to extend the embedding to unseen points
+        self.landmarks_        = landmarks
+        self.landmark_points_  = X[landmarks]
+        self.landmark_scaling_ = s_m
+        self.degree_extension_ = a_inv_b
+        self.projection_       = projection
+
+        return SpectralDecomposition(1 - Q_val, eig_vec, 'nystrom')
+
+    # nystrom extension of unseen points, the same as for non-landmarks during fit
+    def extend(self, X):
+        W = self._landmark_affinity(X, self.landmark_points_)
+        d = W.sum(axis=1) + W @ self.degree_extension_
+        s = np.zeros(len(X))
+        np.divide(1, np.sqrt(np.maximum(d, 0)), out=s, where=d > 0)
+
+        return s[:, None] * ((W * self.landmark_scaling_) @ self.projection_)
+
+    def _sample_landmarks(self, X, m):
+        if self.sampling == 'k-means++':
+            _, landmarks = kmeans_plusplus(X, n_clusters=m, random_state=self.random_state)
+            return landmarks
+
+        rng = np.random.default_rng(self.random_state)
+        return rng.choice(len(X), size=m, replace=False)
+
+    # gaussian affinity between points and landmarks, computed in chunks to bound the distance matrices held
+    def _landmark_affinity(self, X, landmark_points):
+        W = np.empty((len(X), len(landmark_points)), dtype=np.float32)
+        for rows in gen_batches(len(X), NystromTransformer.CHUNK_ROWS):
+            D = pairwise_distances(X[rows], landmark_points, metric=self.metric)
+            W[rows] = np.exp(-2 * (D / self.eps) ** 2)
+        return W
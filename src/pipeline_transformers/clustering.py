@@ -1,21 +1,133 @@
 from sklearn.base import BaseEstimator, TransformerMixin
-from sklearn.cluster import KMeans
+from sklearn.cluster import KMeans, MiniBatchKMeans
+import numpy as np
 
 # TODO: add error checking
 
 class ClusteringTransformer(BaseEstimator, TransformerMixin):
-    def __init__(self, method = 'k-means', num_clusters = 2):
-        if method != 'k-means':
+    SUPPORTED_METHODS = ['k-means', 'minibatch', 'gap']
+
+    def __init__(self, method = 'k-means', num_clusters = 2, random_state = None):
+        if method not in ClusteringTransformer.SUPPORTED_METHODS:
             raise ValueError(f"Required module parameter has not yet been implemented")
 
         self.method = method
+
+        # 'auto' takes one cluster per embedding dimension, as chosen by the eigengap of the embedding stage
         self.num_clusters = num_clusters
-    
+        self.random_state = random_state
+
     def fit(self, X, y=None):
         return self
 
     def transform(self, X, y=None):
         # TODO: add normalisation??
 
-        kmeans_model = KMeans(n_clusters=self.num_clusters).fit(X)
-        return kmeans_model.labels_
\ No newline at end of file
+        self.num_clusters_ = X.shape[1] if self.num_clusters == 'auto' else self.num_clusters
+        if len(X) < self.num_clusters_:
+            raise ValueError(f"Cannot form {self.num_clusters_} clusters from {len(X)} points")
+
+        # 1-D embeddings are clustered exactly on the sorted values: optimal k-means or a split at the largest gaps,
+        # both deterministic and cut at boundaries between neighbouring values, which predict reuses
+        self.model_ = None
+        if X.shape[1] == 1 and self.method in ['k-means', 'gap']:
+            values = np.asarray(X[:, 0], dtype=np.float64)
+            if self.method == 'k-means':
+                self.boundaries_ = kmeans_1d_boundaries(values, self.num_clusters_)
+            else:
+                self.boundaries_ = gap_boundaries(values, self.num_clusters_)
+            return np.searchsorted(self.boundaries_, values)
+
+        if self.method == 'gap':
+            raise ValueError('Gap split clustering requires a 1-D embedding')
+        if self.method == 'minibatch':
+            self.model_ = MiniBatchKMeans(n_clusters=self.num_clusters_, random_state=self.random_state).fit(X)
+        else:
+            self.model_ = KMeans(n_clusters=self.num_clusters_, random_state=self.random_state).fit(X)
+        return self.model_.labels_
+
+    # assign unseen points, already mapped into the embedding, to the fitted clusters, in the precision fitted at
+    def predict(self, X):
+        if self.model_ is None:
+            return np.searchsorted(self.boundaries_, np.asarray(X[:, 0], dtype=np.float64))
+        return self.model_.predict(X.astype(self.model_.cluster_centers_.dtype, copy=False))
+
+# split points of the k clusters of sorted 1-D values at the k - 1 widest gaps between neighbouring values
+def gap_boundaries(values, k):
+    values = np.sort(values)
+    gaps   = np.diff(values)
+    cuts   = np.sort(np.argsort(gaps, kind='stable')[len(gaps) - (k - 1):]) if k > 1 else np.zeros(0, dtype=int)
+    return (values[cuts] + values[cuts + 1]) / 2
+
+# split points of the optimal k-means clustering of 1-D values, midway between neighbouring cluster means.
+# Optimal clusters are contiguous runs of the sorted values, found by dynamic programming over the number of
+# clusters: cost[m][i] is the least within-cluster sum of squares of the first i values in m clusters. The best
+# start of the last cluster never decreases with i, so each layer is solved by divide and conquer in O(n log n)
+def kmeans_1d_boundaries(values, k):
+    # centred for accurate sums of squares from the prefix sums
+    values = np.sort(values)
+    mean   = values.mean()
+    values = values - mean
+    n      = len(values)
+
+    # within-cluster sum of squares of values[j:i]
+    s1 = np.concatenate([[0], np.cumsum(values)])
+    s2 = np.concatenate([[0], np.cumsum(values ** 2)])
+    def sse(j, i):
+        return np.maximum(0, s2[i] - s2[j] - (s1[i] - s1[j]) ** 2 / (i - j))
+
+    cost   = np.concatenate([[0], sse(0, np.arange(1, n + 1))])
+    starts = []
+    for m in range(2, k + 1):
+        # the last layer is only needed for all n values, a single scan over the start of the last cluster
+        if m == k:
+            j     = np.arange(m - 1, n)
+            start = np.zeros(n + 1, dtype=int)
+            start[n] = j[np.argmin(cost[j] + sse(j, n))]
+        else:
+            cost, start = _kmeans_1d_layer(cost, sse, m, n)
+        starts.append(start)
+
+    # walk back through the layers for the start of each cluster
+    cuts, i = [], n
+    for start in reversed(starts):
+        i = start[i]
+        cuts.append(i)
+
+    bounds = np.concatenate([[0], cuts[::-1], [n]]).astype(int)
+    means  = np.array([values[a:b].mean() for (a, b) in zip(bounds[:-1], bounds[1:])])
+    return (means[:-1] + means[1:]) / 2 + mean
+
+# one layer of the 1-D k-means programme, the best cost of the first i values in m clusters for every i along
+# with the start of the last cluster. Divide and conquer runs breadth first: every range of i at one depth
+# evaluates its middle i against all its candidate starts at once, then splits around the best start found
+def _kmeans_1d_layer(prev, sse, m, n):
+    cost  = np.full(n + 1, np.inf)
+    start = np.zeros(n + 1, dtype=int)
+
+    i_lo, i_hi = np.array([m]), np.array([n])
+    j_lo, j_hi = np.array([m - 1]), np.array([n - 1])
+    while len(i_lo):
+        mid     = (i_lo + i_hi) // 2
+        lengths = np.minimum(j_hi, mid - 1) - j_lo + 1
+        offsets = np.concatenate([[0], np.cumsum(lengths)[:-1]])
+
+        # flattened (i, j) candidate pairs of every range
+        segment = np.repeat(np.arange(len(mid)), lengths)
+        j       = j_lo[segment] + np.arange(lengths.sum()) - offsets[segment]
+        vals    = prev[j] + sse(j, mid[segment])
+
+        # first best candidate of each range
+        best  = np.flatnonzero(vals <= np.repeat(np.minimum.reduceat(vals, offsets), lengths))
+        best  = best[np.searchsorted(best, offsets)]
+        opt   = j[best]
+        cost [mid] = vals[best]
+        start[mid] = opt
+
+        # later i never start their last cluster before an earlier i does
+        left  = mid - 1 >= i_lo
+        right = mid + 1 <= i_hi
+        i_lo, i_hi = np.concatenate([i_lo[left], mid[right] + 1]), np.concatenate([mid[left] - 1, i_hi[right]])
+        j_lo, j_hi = np.concatenate([j_lo[left], opt[right]]), np.concatenate([opt[left], j_hi[right]])
+
+    return cost, start
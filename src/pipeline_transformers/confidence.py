@@ -1,13 +1,74 @@
-from sklearn.base import BaseEstimator, TransformerMixin
+from sklearn.base import BaseEstimator, TransformerMixin, clone
+import numpy as np
+import scipy
+import joblib
 
 # TODO: add error checking
 
+# consensus confidence of a clustering: the clustering stage is re-run over seeded subsamples of the embedding it
+# was fitted on, each replicate assigns every point and is aligned to the fitted labels. The decomposition is
+# never repeated, replicates run in parallel threads so their cost is close to that of the clustering runs alone
 class ConfidenceTransformer(BaseEstimator, TransformerMixin):
-    def __init__(self, method = None):
-        pass
-    
-    def fit(self, X, y=None):
+    SUPPORTED_METHODS = ['bootstrap']
+
+    def __init__(self, method = 'bootstrap', n_resamples = 50, sample_fraction = 0.8, n_jobs = None, random_state = None):
+        if method not in ConfidenceTransformer.SUPPORTED_METHODS:
+            raise ValueError(f"Required module parameter has not yet been implemented")
+        self.method          = method
+        self.n_resamples     = n_resamples
+        self.sample_fraction = sample_fraction
+        self.n_jobs          = n_jobs
+        self.random_state    = random_state
+
+    # labels from the fitted clustering step, with the embedding it clustered
+    def fit(self, X, y=None, embedding=None, clustering=None):
+        if embedding is None or clustering is None:
+            raise ValueError('Bootstrap confidence requires the embedding and fitted clustering step')
+
+        labels = np.asarray(X)
+        n, k   = len(labels), clustering.num_clusters_
+        seeds  = np.random.default_rng(self.random_state).integers(2**31, size=self.n_resamples)
+        size   = max(k, int(round(self.sample_fraction * n)))
+
+        def replicate(seed):
+            sample = np.random.default_rng(seed).choice(n, size=size, replace=False)
+            model  = clone(clustering).set_params(num_clusters=k, random_state=int(seed))
+            model.fit_transform(embedding[sample])
+            return model.predict(embedding)
+
+        replicates = joblib.Parallel(n_jobs=self.n_jobs, prefer='threads')(joblib.delayed(replicate)(s) for s in seeds)
+
+        # per-point agreement with the fitted labels once each replicate's labels are matched to them
+        agree  = np.zeros(n)
+        shared = np.zeros((k, k))
+        for rep in replicates:
+            counts = contingency(labels, rep, k)
+            agree += align(counts)[rep] == labels
+            shared += counts @ counts.T
+
+        # fraction of replicates placing a pair of points together, averaged over the pairs of each two clusters,
+        # pairs of a point with itself excluded
+        sizes = np.bincount(labels, minlength=k).astype(float)
+        pairs = np.outer(sizes, sizes) - np.diag(sizes)
+        shared -= np.diag(sizes) * self.n_resamples
+
+        self.confidence_    = agree / self.n_resamples
+        self.coassociation_ = np.zeros((k, k))
+        np.divide(shared, pairs * self.n_resamples, out=self.coassociation_, where=pairs > 0)
         return self
 
     def transform(self, X, y=None):
-        return X
\ No newline at end of file
+        return X
+
+# counts of points with each fitted label (rows) against each replicate label (columns)
+def contingency(labels, rep, k):
+    counts = np.zeros((k, max(k, rep.max() + 1)))
+    np.add.at(counts, (labels, rep), 1)
+    return counts
+
+# fitted label matched to each replicate label by the Hungarian algorithm on their overlap, -1 where unmatched
+def align(counts):
+    rows, cols = scipy.optimize.linear_sum_assignment(-counts)
+    mapping = np.full(counts.shape[1], -1)
+    mapping[cols] = rows
+    return mapping
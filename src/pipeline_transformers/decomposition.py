@@ -1,30 +1,305 @@
-from sklearn.base import BaseEstimator, TransformerMixin
+from sklearn.base import BaseEstimator, TransformerMixin, clone
 import numpy as np
+import joblib
 import scipy
+import warnings
 
 # TODO: add error checking
 
 class DecompositionTransformer(BaseEstimator, TransformerMixin):
-    def __init__(self, method = 'dense'):
-        if method not in ['dense', 'dense_eigh', 'sparse', 'sparse_eigh']:
+    SUPPORTED_METHODS       = ['dense', 'dense_eigh', 'dense_subset', 'sparse', 'sparse_eigh', 'shift_invert', 'lobpcg', 'auto']
+    PARTIAL_METHODS         = ['shift_invert', 'lobpcg']
+    DEFAULT_LOBPCG_MAX_ITER = 500
+
+    # 'auto' planning: laplacians up to DENSE_MAX_N nodes, or denser than DENSE_MIN_DENSITY, are solved densely when
+    # the dense matrix and its solver copy fit in the memory budget. Larger sparse ones are factorised for
+    # shift-invert Lanczos when the factor, estimated at LANCZOS_FILL times the laplacian's entries, fits too
+    DENSE_MAX_N           = 2000
+    DENSE_MIN_DENSITY     = 0.1
+    LANCZOS_FILL          = 20
+    DEFAULT_MEMORY_BUDGET = 2**30
+
+    def __init__(
+        self, method = 'dense', n_components = 6, tol = None, max_iter = None, sigma = -1e-3, random_state = None,
+        initial_vectors = None, memory_budget = DEFAULT_MEMORY_BUDGET,
+    ):
+        if method not in DecompositionTransformer.SUPPORTED_METHODS:
             raise ValueError(f"Required module parameter has not yet been implemented")
-        self.method = method
-    
+        self.method       = method
+        self.n_components = n_components
+        self.tol          = tol
+        self.max_iter     = max_iter
+        self.sigma        = sigma
+        self.random_state = random_state
+
+        # warm start for the iterative solvers, e.g. eigenvectors of a neighbouring graph, ignored by dense solvers
+        self.initial_vectors = initial_vectors
+
+        # bytes the 'auto' planner lets a solver hold, besides the eigenvectors
+        self.memory_budget = memory_budget
+
     def fit(self, X, y=None):
         return self
 
     def transform(self, X, y=None):
-        if self.method == 'dense':
-            eig_val, eig_vec = np.linalg.eig(X)
-        elif self.method == 'dense_eigh':
-            eig_val, eig_vec = np.linalg.eigh(X)
-        elif self.method == 'sparse':
-            eig_val, eig_vec = scipy.sparse.linalg.eigs(X, which='SM')
-        elif self.method == 'sparse_eigh':
-            eig_val, eig_vec = scipy.sparse.linalg.eigsh(X, which='SM')
-
-        eig_val = eig_val.real
-        eig_vec = eig_vec.real
-
-        # manually stack the eigenvalues below the eigenvector matrix
-        return np.vstack((eig_vec, eig_val))
\ No newline at end of file
+        # 'auto' picks a method for this laplacian and converts it to the representation that method works on
+        method = self.method
+        if method == 'auto':
+            self.plan_ = plan(X, self.memory_budget)
+            method     = self.plan_['method']
+            if method == 'shift_invert':
+                X = scipy.sparse.csc_matrix(X)
+            elif method == 'lobpcg' and isinstance(X, np.ndarray):
+                X = scipy.sparse.csr_matrix(X)
+
+        if method in ['dense', 'dense_eigh', 'dense_subset']:
+            X = to_dense(X)
+
+        # numpy solves single precision input in double precision, scipy keeps it in single precision
+        linalg = scipy.linalg if X.dtype == np.float32 else np.linalg
+
+        self.convergence_ = None
+        if method == 'dense':
+            eig_val, eig_vec = linalg.eig(X)
+        elif method == 'dense_eigh':
+            eig_val, eig_vec = linalg.eigh(X)
+        elif method == 'dense_subset':
+            # only the smallest eigenpairs of the symmetric laplacian, by LAPACK's relatively robust representations
+            eig_val, eig_vec = scipy.linalg.eigh(X, subset_by_index=[0, min(self.n_components, X.shape[0]) - 1])
+        elif method == 'sparse':
+            eig_val, eig_vec = scipy.sparse.linalg.eigs(X, k=min(self.n_components, X.shape[0] - 2), which='SM')
+        elif method == 'sparse_eigh':
+            eig_val, eig_vec = scipy.sparse.linalg.eigsh(X, k=min(self.n_components, X.shape[0] - 1), which='SM')
+        elif method == 'shift_invert':
+            eig_val, eig_vec = self._shift_invert(X)
+        elif method == 'lobpcg':
+            eig_val, eig_vec = self._lobpcg(X)
+
+        # real part of a complex array is a view, no copy of the eigenvectors is made
+        return SpectralDecomposition(eig_val.real, eig_vec.real, method, self.convergence_)
+
+    # eigenpairs of a stack of dense laplacians, shape (batch, n, n), in one batched call of the dense solvers
+    def transform_many(self, X):
+        if self.method not in ['dense', 'dense_eigh']:
+            raise ValueError('Batched decomposition requires a dense method')
+        self.convergence_ = None
+        eig_val, eig_vec = (np.linalg.eig if self.method == 'dense' else np.linalg.eigh)(X)
+        return [SpectralDecomposition(val.real, vec.real, self.method) for (val, vec) in zip(eig_val, eig_vec)]
+
+    def _shift_invert(self, L):
+        if isinstance(L, scipy.sparse.linalg.LinearOperator):
+            raise ValueError('Shift-invert decomposition requires an explicit laplacian matrix to factorise')
+        k = min(self.n_components, L.shape[0] - 1)
+
+        # laplacians are positive semi-definite, eigenvalues nearest a small negative shift are the smallest,
+        # the shift keeps the factorised L - sigma*I non-singular despite the zero eigenvalue
+        v0 = None
+        if self.initial_vectors is not None and len(self.initial_vectors) == L.shape[0]:
+            v0 = self.initial_vectors.sum(axis=1)
+
+        converged = True
+        try:
+            eig_val, eig_vec = scipy.sparse.linalg.eigsh(
+                L, k=k, sigma=self.sigma, which='LM', tol=self.tol or 0, maxiter=self.max_iter, v0=v0,
+            )
+        except scipy.sparse.linalg.ArpackNoConvergence as e:
+            converged        = False
+            eig_val, eig_vec = e.eigenvalues, e.eigenvectors
+
+        self.convergence_ = convergence_report(L, eig_val, eig_vec, 'shift_invert', converged, None)
+        return eig_val, eig_vec
+
+    def _lobpcg(self, L):
+        n = L.shape[0]
+        k = min(self.n_components, n - 1)
+        rng = np.random.default_rng(self.random_state)
+        max_iter = self.max_iter or DecompositionTransformer.DEFAULT_LOBPCG_MAX_ITER
+
+        # iterate in double precision whatever the precision of the laplacian: products with a float32 laplacian
+        # keep its memory saving, while single precision iterates stall at residuals above the small eigenvalues
+        X0 = self.initial_vectors
+        if X0 is None or X0.shape != (n, k):
+            X0 = rng.standard_normal((n, k))
+        X0 = X0.astype(np.float64, copy=False)
+
+        # residuals are measured against the scale of the spectrum, not the size of the problem
+        tol = self.tol or np.sqrt(np.finfo(np.float64).eps) * spectral_scale(L, rng)
+
+        # Jacobi preconditioner from the laplacian diagonal, unavailable for matrix-free laplacians
+        M = None
+        if not isinstance(L, scipy.sparse.linalg.LinearOperator):
+            diag = L.diagonal() if scipy.sparse.issparse(L) else np.diag(L)
+            inv  = np.ones(n, dtype=L.dtype)
+            np.divide(1, diag, out=inv, where=diag > 0)
+            M    = scipy.sparse.diags(inv)
+
+        # solver reports non-convergence as a warning, captured in the convergence report instead
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            eig_val, eig_vec, history = scipy.sparse.linalg.lobpcg(
+                L, X0, M=M, tol=tol, maxiter=max_iter,
+                largest=False, retResidualNormsHistory=True,
+            )
+
+        residuals = residual_norms(L, eig_val, eig_vec)
+        self.convergence_ = convergence_report(
+            L, eig_val, eig_vec, 'lobpcg', bool(np.all(residuals <= tol)), len(history), residuals
+        )
+        return eig_val, eig_vec
+
+# eigenpairs handed from decomposition to embedding: eigenvalues sorted ascending, eigenvectors left as the
+# solver returned them and only the requested columns are reordered, so the full matrix is never copied
+class SpectralDecomposition:
+    def __init__(self, eig_val, eig_vec, method, convergence = None):
+        ordering  = np.argsort(eig_val, kind='stable')
+        is_sorted = np.array_equal(ordering, np.arange(len(eig_val)))
+
+        self.eigenvalues = eig_val if is_sorted else eig_val[ordering]
+        self.method      = method
+        self.convergence = convergence
+        self._eig_vec    = eig_vec
+        self._ordering   = None if is_sorted else ordering
+
+    @property
+    def n_components(self):
+        return len(self.eigenvalues)
+
+    # shape of eigenvectors(), without building them
+    @property
+    def shape(self):
+        return (len(self._eig_vec), self.n_components)
+
+    # first k eigenvectors by ascending eigenvalue, a view when the solver already returned them in order
+    def eigenvectors(self, k = None):
+        k = self.n_components if k is None else k
+        if self._ordering is None:
+            return self._eig_vec[:, :k]
+        return self._eig_vec[:, self._ordering[:k]]
+
+# method for the 'auto' decomposition of L and the reason for it, from its size, density and symmetry and the
+# memory the solvers would need. Dense solves take every eigenpair at O(n^3) and are quickest for small or dense
+# laplacians; large sparse laplacians are factorised once for shift-invert Lanczos when the factor fits, and
+# otherwise (or when matrix-free) solved by LOBPCG, which only takes products with L
+def plan(L, memory_budget):
+    n        = L.shape[0]
+    itemsize = np.dtype(L.dtype).itemsize
+    explicit = not isinstance(L, scipy.sparse.linalg.LinearOperator)
+    nnz      = (L.nnz if scipy.sparse.issparse(L) else np.count_nonzero(L)) if explicit else None
+    density  = None if nnz is None else nnz / max(1, n * n)
+
+    # laplacians of the pipeline are symmetric, matrix-free ones are taken as built
+    symmetric = is_symmetric(L) if explicit else True
+
+    # the dense matrix and the copy LAPACK overwrites
+    dense_bytes = 2 * n * n * itemsize
+    dense_fits  = dense_bytes <= memory_budget
+
+    # e.g. directed k-NN graphs, only the general solvers apply
+    if not symmetric and dense_fits and n <= DecompositionTransformer.DENSE_MAX_N:
+        method = 'dense'
+        reason = f'laplacian is not symmetric, n = {n} within the dense threshold of {DecompositionTransformer.DENSE_MAX_N}'
+    elif not symmetric:
+        method = 'sparse'
+        reason = 'laplacian is not symmetric, too large for the dense general solver'
+    elif dense_fits and n <= DecompositionTransformer.DENSE_MAX_N:
+        method = 'dense_subset'
+        reason = f'n = {n} within the dense threshold of {DecompositionTransformer.DENSE_MAX_N}'
+    elif dense_fits and density is not None and density >= DecompositionTransformer.DENSE_MIN_DENSITY:
+        method = 'dense_subset'
+        reason = f'density {density:.3f} too high for sparse products to pay off'
+    elif not explicit:
+        method = 'lobpcg'
+        reason = 'matrix-free laplacian, only products with it are available'
+    elif nnz * DecompositionTransformer.LANCZOS_FILL * (itemsize + 4) <= memory_budget:
+        method = 'shift_invert'
+        reason = 'sparse laplacian, estimated factor fits the memory budget'
+    else:
+        method = 'lobpcg'
+        reason = 'sparse laplacian too large to factorise within the memory budget'
+
+    return {
+        'method'       : method,
+        'reason'       : reason,
+        'n'            : n,
+        'density'      : density,
+        'symmetric'    : symmetric,
+        'memory_budget': memory_budget,
+    }
+
+# symmetric up to rounding, dense arrays compared a block of rows against the same columns at a time so no n x n
+# temporaries are allocated
+def is_symmetric(L, block_bytes = 2**24):
+    if scipy.sparse.issparse(L):
+        return bool(abs(L - L.T).max() <= 1e3 * np.finfo(L.dtype).eps * max(1, abs(L).max()))
+
+    L     = np.asarray(L)
+    n     = L.shape[0]
+    tol   = 1e3 * np.finfo(L.dtype).eps * max(1, abs(L.max()), abs(L.min()))
+    block = max(1, block_bytes // max(1, n * L.itemsize))
+    for start in range(0, n, block):
+        rows = slice(start, start + block)
+        if abs(L[rows] - L[:, rows].T).max() > tol:
+            return False
+    return True
+
+# dense solvers need an explicit array, materialise sparse or matrix-free laplacians
+def to_dense(X):
+    if scipy.sparse.issparse(X):
+        return X.toarray()
+    if isinstance(X, scipy.sparse.linalg.LinearOperator):
+        return X @ np.eye(X.shape[0], dtype=X.dtype)
+    return X
+
+# norm of L v - lambda v for each eigenpair
+# bound on the eigenvalues of a laplacian, twice its largest diagonal entry (Gershgorin). Matrix-free laplacians
+# have no diagonal to read, the norm of their product with a random unit vector estimates the scale instead
+def spectral_scale(L, rng):
+    if isinstance(L, scipy.sparse.linalg.LinearOperator):
+        x = rng.standard_normal(L.shape[0])
+        return float(np.linalg.norm(L @ (x / np.linalg.norm(x))))
+    diag = L.diagonal() if scipy.sparse.issparse(L) else np.diag(L)
+    return 2 * float(np.abs(diag).max(initial=0))
+
+def residual_norms(L, eig_val, eig_vec):
+    return np.linalg.norm(L @ eig_vec - eig_vec * eig_val, axis=0)
+
+# summary of an iterative solve, stored on the transformer as `convergence_`
+def convergence_report(L, eig_val, eig_vec, method, converged, iterations, residuals = None):
+    if residuals is None:
+        residuals = residual_norms(L, eig_val, eig_vec)
+    if not converged:
+        print(f"Warning: {method} eigensolver did not converge")
+
+    return {
+        'method'        : method,
+        'n_components'  : len(eig_val),
+        'converged'     : converged,
+        'iterations'    : iterations,
+        'residual_norms': residuals.tolist(),
+    }
+
+# eigenpairs of a laplacian whose graph has several connected components, from the smaller eigenproblem of each
+# component's block solved in parallel threads. The spectrum of L is the union of the block spectra, each block
+# eigenvector zero outside its component. Blocks too small for the partial solvers are solved densely
+def decompose_components(decomposition, L, labels, n_jobs = None):
+    n       = L.shape[0]
+    members = np.split(np.argsort(labels, kind='stable'), np.cumsum(np.bincount(labels))[:-1])
+
+    def solve(idx):
+        block = L[idx][:, idx] if scipy.sparse.issparse(L) else L[np.ix_(idx, idx)]
+        if decomposition.method in DecompositionTransformer.PARTIAL_METHODS + ['sparse', 'sparse_eigh', 'auto'] and len(idx) <= decomposition.n_components + 2:
+            eig_val, eig_vec = scipy.linalg.eigh(to_dense(block))
+            return SpectralDecomposition(eig_val, eig_vec, 'dense_eigh')
+        return clone(decomposition).transform(block)
+
+    results = joblib.Parallel(n_jobs=n_jobs, prefer='threads')(joblib.delayed(solve)(idx) for idx in members)
+
+    eig_val = np.concatenate([r.eigenvalues for r in results])
+    eig_vec = np.zeros((n, len(eig_val)), dtype=results[0].eigenvectors().dtype)
+    col     = 0
+    for (idx, r) in zip(members, results):
+        eig_vec[idx, col:col + r.n_components] = r.eigenvectors()
+        col += r.n_components
+
+    convergence = [r.convergence for r in results if r.convergence is not None] or None
+    return SpectralDecomposition(eig_val, eig_vec, decomposition.method, convergence)
@@ -4,25 +4,102 @@ import numpy as np
 # TODO: add error checking
 
 class EmbeddingTransformer(BaseEstimator, TransformerMixin):
-    def __init__(self, method = 'single'):
-        if method != 'single':
+    SUPPORTED_METHODS = ['single', 'multi', 'auto']
+
+    def __init__(self, method = 'single', num_clusters = 2, normalize_rows = False, max_clusters = 10):
+        if method not in EmbeddingTransformer.SUPPORTED_METHODS:
             raise ValueError(f"Required module parameter has not yet been implemented")
-        self.method = method
+        self.method       = method
+        self.num_clusters = num_clusters
+
+        # scale each embedded point to unit length as Ng-Jordan-Weiss, before clustering
+        self.normalize_rows = normalize_rows
+
+        # largest cluster count the eigengap of 'auto' chooses from
+        self.max_clusters = max_clusters
+
+    # eigenpairs the decomposition must provide: the Fiedler pair, the first num_clusters, or enough to find the
+    # eigengap after the largest cluster count considered. An attribute like n_components of the decomposition
+    @property
+    def n_components(self):
+        if self.method == 'single':
+            return 2
+        if self.method == 'multi':
+            return self.num_clusters
+        return self.max_clusters + 1
     
     def fit(self, X, y=None):
         return self
 
     def transform(self, X, y=None):
-        # extract the last row as the eigenvalues, take rest as eigenvectors
-        eig_val = X[-1 , :]
-        eig_vec = X[:-1, :]
+        # X is the SpectralDecomposition from the decomposition stage, eigenvalues already sorted
+        eig_val = X.eigenvalues
+
+        if self.method == 'single':
+            if eig_val[1] <= 0:
+                print("Warning: fiedler vector does not indicate connectivity")
+            self.components_ = [1]
+        else:
+            self.num_clusters_ = self.num_clusters if self.method == 'multi' else eigengap_clusters(eig_val, self.max_clusters)
+            self.components_   = list(range(self.num_clusters_))
+
+        # keep the eigenpairs used, the embedding of unseen points is extended from them
+        self.eigenvalues_ = eig_val[self.components_]
+        z_eigvec = X.eigenvectors(max(self.components_) + 1)[:,self.components_]
+        self.embedding_   = z_eigvec
+
+        return self.scale_rows(z_eigvec)
+
+    # unit length rows for Ng-Jordan-Weiss normalisation, points embedded at the origin are left there
+    def scale_rows(self, Z):
+        if not self.normalize_rows:
+            return Z
+        norms = np.linalg.norm(Z, axis=1, keepdims=True)
+        res   = np.zeros_like(Z)
+        np.divide(Z, norms, out=res, where=norms > 0)
+        return res
+
+    # out-of-sample extension follows from a new point's row of L v = lambda v, given its edges W to the
+    # training points: unnormalised v(x) = W v / (d(x) - lambda), normalised scales by degrees and 1 - lambda
+    def fit_extension(self, degrees, normalize):
+        self.normalize_ = normalize
+        self.extension_ = self.extension_rows(self.embedding_, degrees)
+        return self
+
+    def extend(self, W):
+        return self.scale_rows(self._extend(W))
+
+    # append points embedded by extension from their edges W, so later extensions reach them as training points.
+    # degrees are their own in the graph they joined, returns their rows as extend would
+    def add_extension(self, W, degrees):
+        Z = self._extend(W)
+        self.embedding_ = np.vstack((self.embedding_, Z))
+        self.extension_ = np.vstack((self.extension_, self.extension_rows(Z, degrees)))
+        return self.scale_rows(Z)
+
+    def extension_rows(self, Z, degrees):
+        if not self.normalize_:
+            return Z
+        scale = np.zeros(len(degrees))
+        np.divide(1, np.sqrt(degrees), out=scale, where=degrees > 0)
+        return Z * scale[:, None]
 
-        ordering = eig_val.argsort()
-        eig_val = eig_val[ordering]
-        
-        if eig_val[1] <= 0:
-            print("Warning: fiedler vector does not indicate connectivity")
+    def _extend(self, W):
+        d = np.asarray(W.sum(axis=1), dtype=np.float64).reshape(-1, 1)
+        if self.normalize_:
+            denominator = np.sqrt(d) * (1 - self.eigenvalues_)
+        else:
+            denominator = d - self.eigenvalues_
 
-        z_eigvec = eig_vec[:,ordering][:,[1]]
+        # points with no edges to the training graph get a zero embedding
+        res = np.zeros(denominator.shape)
+        np.divide(W @ self.extension_, denominator, out=res, where=denominator != 0)
+        return res
 
-        return z_eigvec
\ No newline at end of file
+# cluster count at the largest gap between consecutive eigenvalues, with the gap after the first eigenvalue
+# excluded so at least two clusters are found
+def eigengap_clusters(eig_val, max_clusters):
+    gaps = np.diff(eig_val[:max_clusters + 1])
+    if len(gaps) < 2:
+        return 2
+    return int(np.argmax(gaps[1:])) + 2
\ No newline at end of file
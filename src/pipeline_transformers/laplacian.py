@@ -1,31 +1,78 @@
 from sklearn.base import BaseEstimator, TransformerMixin
 import numpy as np
+import scipy
 
 # TODO: add error checking
 
 class LaplacianTransformer(BaseEstimator, TransformerMixin):
-    def __init__(self, normalize=False):
+    def __init__(self, normalize=False, operator=False, dtype=np.float64):
         self.normalize = normalize
-    
+        self.operator  = operator
+        self.dtype     = dtype
+
     def fit(self, X, y=None):
         return self
 
     def transform(self, A, y=None):
-        n = len(A)
+        n = A.shape[0]
+
+        # degree of each node as its total edge weight, summed down columns as graphs hold neighbours of i in column i
+        d = np.asarray(A.sum(axis=0), dtype=self.dtype).ravel()
+        self.degrees_ = d
 
-        # calculate the degree matrix
-        D = np.zeros((n, n))
-        d = np.count_nonzero(A, axis = 0)
-        np.fill_diagonal(D, d)
+        # scaling for the symmetric normalisation D^-1/2 L D^-1/2, isolated nodes are left as zero rows
+        s = None
+        if self.normalize:
+            s = np.zeros(n, dtype=self.dtype)
+            np.divide(1, np.sqrt(d), out=s, where=d > 0)
 
-        # calculate simple unnormalised laplacian
-        L = D - A
+        # boolean adjacencies are only converted to the laplacian dtype where arithmetic needs it
+        if self.operator:
+            return laplacian_operator(A.astype(self.dtype, copy=False), d, s)
 
-        if not self.normalize:
+        if scipy.sparse.issparse(A):
+            # calculate simple unnormalised laplacian, O(nnz) for sparse graphs
+            L = (scipy.sparse.diags(d) - A.astype(self.dtype, copy=False)).tocsr()
+            if s is not None:
+                rows = np.repeat(np.arange(n), np.diff(L.indptr))
+                L.data *= s[rows] * s[L.indices]
             return L
 
-        # normalise the laplacian: 
-        d2 = 1 / np.sqrt(np.diag(D))
-        np.fill_diagonal(D, d2)
-        L = np.matmul(np.matmul(D, L), D)
-        return L
\ No newline at end of file
+        # calculate simple unnormalised laplacian, adding degrees straight onto the diagonal
+        L = np.negative(A, dtype=self.dtype)
+        L[np.diag_indices(n)] += d
+
+        # normalise the laplacian by scaling rows and columns in place
+        if s is not None:
+            L *= s[:, None]
+            L *= s[None, :]
+        return L
+
+    # dense laplacians of a stack of adjacencies, shape (batch, n, n), without keeping degrees
+    def transform_many(self, A):
+        n = A.shape[1]
+        d = np.asarray(A.sum(axis=1), dtype=self.dtype)
+
+        L = np.negative(A, dtype=self.dtype)
+        L[:, np.arange(n), np.arange(n)] += d
+        if self.normalize:
+            s = np.zeros(d.shape, dtype=self.dtype)
+            np.divide(1, np.sqrt(d), out=s, where=d > 0)
+            L *= s[:, :, None]
+            L *= s[:, None, :]
+        return L
+
+# matrix-free laplacian: products are computed from the adjacency without forming L itself
+def laplacian_operator(A, d, s = None):
+    def matmat(x):
+        x  = np.asarray(x)
+        dx = d if x.ndim == 1 else d[:, None]
+        if s is None:
+            return dx * x - A @ x
+
+        sx = s if x.ndim == 1 else s[:, None]
+        x  = sx * x
+        return sx * (dx * x - A @ x)
+
+    n = A.shape[0]
+    return scipy.sparse.linalg.LinearOperator((n, n), matvec=matmat, matmat=matmat, dtype=d.dtype)
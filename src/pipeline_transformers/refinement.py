@@ -1,37 +1,77 @@
 from sklearn.base import BaseEstimator, TransformerMixin
+from sklearn.neighbors import NearestNeighbors
 import numpy as np
+import scipy
+
+from src.pipeline_transformers.affinity import ChunkedDistances
 
 # TODO: add error checking
 
 class EpsilonNNTransformer(BaseEstimator, TransformerMixin):
-    def __init__(self, eps):
-        self.eps = eps
-        pass
+    def __init__(self, eps, dtype = np.float64):
+        self.eps   = eps
+        self.dtype = dtype
     
     def fit(self, X, y=None):
         return self
 
     def transform(self, X, y=None):
-        X = np.array(X < self.eps, dtype=np.float64)
+        if isinstance(X, NearestNeighbors):
+            return self._transform_index(X)
+        if isinstance(X, ChunkedDistances):
+            return eps_chunked_graph(X, self.eps, self.dtype)
+
+        X = np.asarray(X < self.eps, dtype=self.dtype)
         np.fill_diagonal(X,0)
     
         return X
 
+    # graphs of a stack of distance matrices, shape (batch, n, n)
+    def transform_many(self, X):
+        n   = X.shape[1]
+        res = np.asarray(X < self.eps, dtype=self.dtype)
+        res[:, np.arange(n), np.arange(n)] = 0
+        return res
+
+    def _transform_index(self, index):
+        # radius queries are inclusive and exclude each point itself, keep only strictly closer points
+        res = index.radius_neighbors_graph(radius=self.eps, mode='distance')
+        res.data = np.array(res.data < self.eps, dtype=self.dtype)
+        res.eliminate_zeros()
+
+        return res
+
+    def fit_extension(self, index):
+        return self
+
+    # edges from unseen points to the training points, one sparse row per point
+    def extend(self, index, X):
+        res = index.radius_neighbors_graph(X, radius=self.eps, mode='distance')
+        res.data = np.array(res.data < self.eps, dtype=np.float64)
+        res.eliminate_zeros()
+
+        return res
+
 class kNNTransformer(BaseEstimator, TransformerMixin):
-    def __init__(self, k):
-        self.k = k
-        pass
+    def __init__(self, k, dtype = np.float64):
+        self.k     = k
+        self.dtype = dtype
     
     def fit(self, X, y=None):
         return self
 
     def transform(self, X, y=None):
+        if isinstance(X, NearestNeighbors):
+            return knn_index_graph(X, self.k, self.dtype)
+        if isinstance(X, ChunkedDistances):
+            return knn_chunked_graph(X, self.k, self.dtype)
+
         n = len(X)
 
         idx = np.argpartition(X, self.k + 1, axis=0)
         idx = idx[:self.k+1, :]
         
-        res = np.zeros((n, n))
+        res = np.zeros((n, n), dtype=self.dtype)
         for i in range(n):
             idx_col = idx[:,i]
             res[idx_col,i] = 1
@@ -39,22 +79,40 @@ class kNNTransformer(BaseEstimator, TransformerMixin):
         np.fill_diagonal(res, 0)
         return res
 
+    # graphs of a stack of distance matrices, shape (batch, n, n)
+    def transform_many(self, X):
+        return knn_stack(X, self.k, self.dtype)
+
+    def fit_extension(self, index):
+        return self
+
+    # edges from unseen points to their k nearest training points, one sparse row per point
+    def extend(self, index, X):
+        if self.k == 0:
+            return scipy.sparse.csr_matrix((len(X), index.n_samples_fit_))
+        return index.kneighbors_graph(X, n_neighbors=self.k, mode='connectivity')
+
 class MutualKNNTransformer(BaseEstimator, TransformerMixin):
-    def __init__(self, k):
-        self.k = k
-        pass
+    def __init__(self, k, dtype = np.float64):
+        self.k     = k
+        self.dtype = dtype
     
     def fit(self, X, y=None):
         return self
 
     def transform(self, X, y=None):
+        if isinstance(X, (NearestNeighbors, ChunkedDistances)):
+            graph = knn_index_graph if isinstance(X, NearestNeighbors) else knn_chunked_graph
+            res   = graph(X, self.k, self.dtype)
+            return res.multiply(res.T).tocsr().astype(self.dtype, copy=False)
+
         n = len(X)
 
         # calculate k-NN edge matrix as usual
         idx = np.argpartition(X, self.k + 1, axis=0)
         idx = idx[:self.k+1, :]
         
-        res = np.zeros((n, n))
+        res = np.zeros((n, n), dtype=bool)
         for i in range(n):
             idx_col = idx[:,i]
             res[idx_col,i] = 1
@@ -62,23 +120,164 @@ class MutualKNNTransformer(BaseEstimator, TransformerMixin):
         np.fill_diagonal(res, 0)
 
         # use the transposition of A to enforce only mutual neighbours are taken
-        res = res + res.T
-        res = np.array(res == 2, dtype = np.float64)
+        res = np.asarray(res & res.T, dtype=self.dtype)
         np.fill_diagonal(res, 0)
 
         return res
 
+    # graphs of a stack of distance matrices, shape (batch, n, n)
+    def transform_many(self, X):
+        res = knn_stack(X, self.k, bool)
+        return np.asarray(res & res.transpose(0, 2, 1), dtype=self.dtype)
+
+    # distance of each training point to its k-th neighbour, an unseen point is among its k nearest if closer
+    def fit_extension(self, index):
+        self.kth_distances_ = np.zeros(index.n_samples_fit_)
+        if self.k > 0:
+            self.kth_distances_ = index.kneighbors(n_neighbors=self.k)[0][:, -1]
+        return self
+
+    # edges from unseen points to those of their k nearest training points that also have them as a neighbour
+    def extend(self, index, X):
+        if self.k == 0:
+            return scipy.sparse.csr_matrix((len(X), index.n_samples_fit_))
+
+        res = index.kneighbors_graph(X, n_neighbors=self.k, mode='distance')
+        res.data = np.array(res.data < self.kth_distances_[res.indices], dtype=np.float64)
+        res.eliminate_zeros()
+
+        return res
+
 class CompleteTransformer(BaseEstimator, TransformerMixin):
-    def __init__(self):
-        pass
+    def __init__(self, dtype = np.float64):
+        self.dtype = dtype
     
     def fit(self, X, y=None):
         return self
 
     def transform(self, X, y=None):
-        n = len(X)
+        n = X.n_samples_fit_ if isinstance(X, NearestNeighbors) else len(X)
 
-        res = np.ones((n, n))
+        res = np.ones((n, n), dtype=self.dtype)
         np.fill_diagonal(res, 0)
 
-        return res
\ No newline at end of file
+        return res
+
+    # graphs of a stack of distance matrices, shape (batch, n, n)
+    def transform_many(self, X):
+        res = np.ones(X.shape, dtype=self.dtype)
+        res[:, np.arange(X.shape[1]), np.arange(X.shape[1])] = 0
+        return res
+
+    def fit_extension(self, index):
+        return self
+
+    # unseen points connect to every training point
+    def extend(self, index, X):
+        return scipy.sparse.csr_matrix(np.ones((len(X), index.n_samples_fit_)))
+
+# dense k-NN graphs of a stack of distance matrices, each laid out as kNNTransformer: the k + 1 smallest
+# distances down each column marked, then each point itself dropped
+def knn_stack(D, k, dtype = np.float64):
+    n   = D.shape[1]
+    idx = np.argpartition(D, k + 1, axis=1)[:, :k + 1, :]
+
+    res = np.zeros(D.shape, dtype=dtype)
+    np.put_along_axis(res, idx, 1, axis=1)
+    res[:, np.arange(n), np.arange(n)] = 0
+    return res
+
+# sparse k-NN graph from a fitted neighbour index, laid out as the dense transformers: neighbours of i down column i
+def knn_index_graph(index, k, dtype = np.float64):
+    n = index.n_samples_fit_
+    if k == 0:
+        return scipy.sparse.csr_matrix((n, n), dtype=dtype)
+
+    # query excludes each point itself, row i holds the k nearest neighbours of i
+    res = index.kneighbors_graph(n_neighbors=k, mode='connectivity')
+    return res.T.tocsr().astype(dtype, copy=False)
+
+# sparse eps graph from blocks of distance rows, thresholded as each block is computed
+def eps_chunked_graph(distances, eps, dtype = np.float64):
+    def reduce_func(D, start):
+        within = D < eps
+        within[np.arange(len(D)), start + np.arange(len(D))] = False
+        return scipy.sparse.csr_matrix(within, dtype=dtype)
+
+    return distances.stack_rows(distances.reduce_rows(reduce_func, extra_bytes=1), dtype)
+
+# sparse k-NN graph from blocks of distance rows, laid out as the dense transformers: each block takes the k + 1
+# smallest distances of its rows as kNNTransformer does down its columns, dropping each point itself
+def knn_chunked_graph(distances, k, dtype = np.float64):
+    n = len(distances)
+    if k == 0:
+        return scipy.sparse.csr_matrix((n, n), dtype=dtype)
+
+    def reduce_func(D, start):
+        idx  = np.argpartition(D, k + 1, axis=1)[:, :k + 1]
+        rows = np.repeat(np.arange(len(D)), k + 1)
+        cols = idx.ravel()
+        keep = cols != rows + start
+        return scipy.sparse.csr_matrix(
+            (np.ones(keep.sum(), dtype=dtype), (rows[keep], cols[keep])), shape=(len(D), n)
+        )
+
+    res = distances.stack_rows(distances.reduce_rows(reduce_func, extra_bytes=8), dtype)
+
+    # the transpose of graph rows on disk is kept as a CSC view of the same files rather than copied to memory
+    if distances.scratch_dir is not None:
+        return res.T
+    return res.T.tocsr()
+
+# eps graphs for a sweep of increasing eps from one radius query at the largest value: edges are sorted by
+# length once and added to the graph as the threshold passes them, yields (eps, adjacency) in ascending eps
+def eps_path_graphs(index, eps_values):
+    n = index.n_samples_fit_
+    eps_values = np.sort(eps_values)
+
+    dist, ind = index.radius_neighbors(radius=max(eps_values[-1], 0))
+    rows  = np.repeat(np.arange(n), [len(i) for i in ind])
+    cols  = np.concatenate(ind).astype(np.int64) if n else np.zeros(0, dtype=np.int64)
+    dist  = np.concatenate(dist) if n else np.zeros(0)
+    order = np.argsort(dist, kind='stable')
+    rows, cols, dist = rows[order], cols[order], dist[order]
+
+    res   = scipy.sparse.csr_matrix((n, n))
+    added = 0
+    for eps in eps_values:
+        # strict threshold as EpsilonNNTransformer
+        upto = np.searchsorted(dist, eps, side='left')
+        if upto > added:
+            new_edges = scipy.sparse.csr_matrix(
+                (np.ones(upto - added), (rows[added:upto], cols[added:upto])), shape=(n, n)
+            )
+            res   = res + new_edges
+            added = upto
+        yield eps, res
+
+# k-NN (or mutual k-NN) graphs for a sweep of increasing k from one query at the largest k, each step adds
+# the next nearest neighbour of every point, yields (k, adjacency) in ascending k
+def knn_path_graphs(index, k_values, mutual = False):
+    n = index.n_samples_fit_
+    k_values = np.sort(k_values)
+
+    ind = np.zeros((n, 0), dtype=np.int64)
+    if k_values[-1] > 0:
+        ind = index.kneighbors(n_neighbors=k_values[-1], return_distance=False)
+
+    # rows hold the neighbours of each point, transposed to the column layout of the dense transformers
+    neighbours = scipy.sparse.csr_matrix((n, n))
+    added = 0
+    for k in k_values:
+        if k > added:
+            new_edges = scipy.sparse.csr_matrix(
+                (np.ones(n * (k - added)), (np.repeat(np.arange(n), k - added), ind[:, added:k].ravel())),
+                shape=(n, n),
+            )
+            neighbours = neighbours + new_edges
+            added      = k
+
+        res = neighbours.T.tocsr()
+        if mutual:
+            res = res.multiply(neighbours).tocsr()
+        yield k, res
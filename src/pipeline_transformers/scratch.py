@@ -0,0 +1,111 @@
+import os
+import mmap
+import tempfile
+
+import numpy as np
+import scipy
+
+# out-of-core storage for matrices handed between pipeline stages: dense arrays become np.memmaps
+# and sparse CSR/CSC matrices keep their data, indices and indptr components in memory-mapped files, all in a
+# scratch directory. Files are unlinked as soon as they are mapped, the operating system frees the space once
+# the last array using them is dropped, so nothing is left behind in the scratch directory after a fit
+
+
+# rows of a dense array written to disk at once
+CHUNK_BYTES = 2**24
+
+
+# new file in the directory mapped as an array, its directory entry removed once mapped
+def _create(directory, shape, dtype):
+    fd, path = tempfile.mkstemp(suffix='.npy', dir=directory)
+    os.close(fd)
+    res = np.lib.format.open_memmap(path, mode='w+', dtype=dtype, shape=shape)
+    try:
+        os.unlink(path)
+    except OSError:
+        # open files cannot be removed on some platforms, left for the caller to clean the directory
+        pass
+    return res
+
+
+# uninitialised dense array backed by a file in the directory, or in memory without one
+def empty(shape, dtype, directory = None):
+    if directory is None:
+        return np.empty(shape, dtype=dtype)
+    return _create(directory, shape, dtype)
+
+
+# whether an array, or the array it is a view of, is memory-mapped from a file
+def is_mapped(a):
+    while a is not None:
+        if isinstance(a, (np.memmap, mmap.mmap)):
+            return True
+        a = getattr(a, 'base', None)
+    return False
+
+
+# copy of X backed by files in the directory, other outputs (e.g. neighbour indexes or operators) pass through
+def spill(X, directory):
+    if isinstance(X, np.ndarray):
+        return X if is_mapped(X) else _spill_dense(X, directory)
+    if scipy.sparse.issparse(X) and X.format in ['csr', 'csc']:
+        if is_mapped(X.data) and is_mapped(X.indices):
+            return X
+        return _sparse(type(X), [_spill_dense(a, directory) for a in [X.data, X.indices, X.indptr]], X.shape)
+    if scipy.sparse.issparse(X):
+        return spill(X.tocsr(), directory)
+    return X
+
+
+def _spill_dense(X, directory):
+    out = _create(directory, X.shape, X.dtype)
+    if X.ndim == 2:
+        step = max(1, CHUNK_BYTES // max(1, X.shape[1] * X.itemsize))
+        for start in range(0, len(X), step):
+            out[start:start + step] = X[start:start + step]
+    else:
+        out[:] = X
+    out.flush()
+    return out
+
+
+# sparse matrix around existing component arrays, scipy keeps them without copying when their dtypes are valid
+def _sparse(fmt, components, shape):
+    data, indices, indptr = components
+    return fmt((data, indices, indptr), shape=shape, copy=False)
+
+
+# sparse matrix built up from blocks of CSR rows, appending each block to files in the directory as it arrives
+# so the whole matrix is never held in memory. Without a directory the blocks are stacked in memory
+def stack_rows(blocks, n_cols, dtype, directory = None):
+    if directory is None:
+        return scipy.sparse.vstack(list(blocks), format='csr').astype(dtype, copy=False)
+
+    index_dtype = np.int32 if n_cols < np.iinfo(np.int32).max else np.int64
+    files = {name: tempfile.TemporaryFile(dir=directory) for name in ['data', 'indices']}
+    counts, nnz = [], 0
+    for block in blocks:
+        block = block.tocsr()
+        files['data']   .write(np.ascontiguousarray(block.data, dtype=dtype).tobytes())
+        files['indices'].write(np.ascontiguousarray(block.indices, dtype=index_dtype).tobytes())
+        counts.append(np.diff(block.indptr))
+        nnz += block.nnz
+
+    # more entries than int32 can count makes scipy widen, and so copy, the indices as well
+    n_rows = sum(len(c) for c in counts)
+    indptr = np.zeros(n_rows + 1, dtype=np.int64 if nnz >= np.iinfo(np.int32).max else index_dtype)
+    if counts:
+        np.cumsum(np.concatenate(counts), out=indptr[1:])
+
+    # temporary files have no directory entry, the mapping keeps them alive
+    components = []
+    for (name, component_dtype) in [('data', dtype), ('indices', index_dtype)]:
+        files[name].flush()
+        if nnz:
+            components.append(np.memmap(files[name], dtype=component_dtype, mode='r', shape=(nnz,)))
+        else:
+            components.append(np.zeros(0, dtype=component_dtype))
+        files[name].close()
+    components.append(indptr)
+
+    return _sparse(scipy.sparse.csr_matrix, components, (n_rows, n_cols))
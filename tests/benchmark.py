@@ -0,0 +1,219 @@
+import os
+import sys
+import time
+import json
+import queue
+import signal
+import argparse
+import traceback
+import multiprocessing
+from datetime import datetime
+
+from experiments import MAX_TIMEOUT_SECS, experiment_grid, task_id, binary_moons_data, keep_affinity, result_entry
+from src.SpectralClustering import SpectralClustering
+
+# parallel, resumable runner for the experiment grid of test_time_correctness.
+# each worker process is pinned to its own set of CPUs with BLAS/OpenMP pools limited to match, and runs one
+# task at a time on its main thread so the hard timeout can be enforced with a timer signal in the worker.
+# A timer cannot interrupt long native calls, so the parent also kills any worker running past the timeout
+# plus a grace period and starts a replacement. Every finished task is appended to a JSONL results file and
+# flushed straight away, re-running with the same output file skips all tasks already recorded there
+
+
+# how long past the timeout the parent waits before killing a worker that ignored its timer
+KILL_GRACE_SECS = 10
+
+
+# ids of tasks already recorded in a results file, a line cut off by an interrupted write is ignored
+def completed_tasks(path):
+    done = set()
+    if not os.path.exists(path):
+        return done
+
+    with open(path) as f:
+        for line in f:
+            try:
+                done.add(json.loads(line)['task_id'])
+            except (json.JSONDecodeError, KeyError):
+                continue
+    return done
+
+
+def available_cpus():
+    return sorted(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else list(range(os.cpu_count()))
+
+
+# split the available CPUs into one disjoint set per worker, workers share CPUs only when outnumbering them
+def cpu_sets(n_workers):
+    cpus = available_cpus()
+    per_worker = max(1, len(cpus) // n_workers)
+    return [cpus[(i * per_worker) % len(cpus):][:per_worker] for i in range(n_workers)]
+
+
+# fit one task under a hard timeout, returns its results entry
+def run_task(task, timeout):
+    def handler(sig, frame):
+        raise TimeoutError()
+
+    X, y_true = binary_moons_data(task['n_points'], task['noise'])
+    model     = SpectralClustering(2, keep_affinity=keep_affinity(task['n_points']), **task['params'])
+
+    signal.signal(signal.SIGALRM, handler)
+    signal.setitimer(signal.ITIMER_REAL, timeout)
+    try:
+        start  = time.perf_counter()
+        y_pred = model.fit(X)
+        end    = time.perf_counter()
+    except TimeoutError:
+        return result_entry(task['n_points'], task['noise'], timeout, True, task['experiment'], task['variant'], profile=getattr(model, 'profile_', None))
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+
+    return result_entry(task['n_points'], task['noise'], end - start, False, task['experiment'], task['variant'], X, y_pred, y_true, model.profile_, model)
+
+
+def worker_main(cpus, tasks, results, timeout):
+    # pin before any work so BLAS and OpenMP pools are created on, and sized for, these CPUs only
+    if hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, cpus)
+    from threadpoolctl import threadpool_limits
+    threadpool_limits(limits=len(cpus))
+
+    # model output is noise from many processes at once
+    sys.stdout = open(os.devnull, 'w')
+
+    while True:
+        task = tasks.get()
+        if task is None:
+            return
+        results.put(('started', task['task_id'], None))
+        try:
+            entry = run_task(task, timeout)
+        except Exception:
+            entry = {'error': traceback.format_exc(limit=3)}
+        results.put(('finished', task['task_id'], entry))
+
+
+class Worker:
+    def __init__(self, context, cpus, results, timeout):
+        self.cpus    = cpus
+        self.tasks   = context.Queue()
+        self.process = context.Process(target=worker_main, args=(cpus, self.tasks, results, timeout), daemon=True)
+        self.process.start()
+        self.task    = None
+        self.started = None
+
+    def submit(self, task):
+        self.task    = task
+        self.started = None
+        self.tasks.put(task)
+
+    # the parent's deadline only runs once the task has started, not while a new worker is still importing
+    def overdue(self, timeout):
+        return self.started is not None and time.monotonic() - self.started > timeout + KILL_GRACE_SECS
+
+    def stop(self):
+        self.tasks.put(None)
+
+
+def write_entry(f, task, entry):
+    entry = {
+        **entry,
+        'task_id'   : task['task_id'],
+        'repeat'    : task['repeat'],
+        'n_points'  : task['n_points'],
+        'noise'     : task['noise'],
+        'experiment': task['experiment'],
+        'variant'   : task['variant'],
+    }
+    f.write(json.dumps(entry, sort_keys=True, default=str) + '\n')
+    f.flush()
+    os.fsync(f.fileno())
+
+
+def run(tasks, output, n_workers = None, timeout = MAX_TIMEOUT_SECS, log = print):
+    n_workers = n_workers or len(available_cpus())
+
+    done    = completed_tasks(output)
+    pending = [{**task, 'task_id': task_id(task)} for task in tasks]
+    pending = [task for task in pending if task['task_id'] not in done]
+    log(f'{len(tasks) - len(pending)} of {len(tasks)} tasks already complete, running {len(pending)} on {n_workers} workers')
+    if not pending:
+        return output
+
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    context = multiprocessing.get_context('spawn')
+    results = context.Queue()
+    workers = [Worker(context, cpus, results, timeout) for cpus in cpu_sets(n_workers)]
+    pending.reverse()
+    remaining = len(pending)
+
+    with open(output, 'a') as f:
+        try:
+            while remaining:
+                for worker in workers:
+                    if worker.task is None and pending:
+                        worker.submit(pending.pop())
+
+                try:
+                    status, message_id, entry = results.get(timeout=1)
+                    worker = next((w for w in workers if w.task is not None and w.task['task_id'] == message_id), None)
+                except queue.Empty:
+                    status, worker = None, None
+
+                # messages from a worker killed after sending them no longer match a running task
+                finished = False
+                if worker is not None and status == 'started':
+                    worker.started = time.monotonic()
+                elif worker is not None and status == 'finished':
+                    write_entry(f, worker.task, entry)
+                    worker.task = None
+                    remaining  -= 1
+                    finished    = True
+
+                # kill workers stuck past their timer, recording their task as timed out, and replace workers that
+                # died for any other reason (crash, OOM kill) recording their exit code
+                for (i, worker) in enumerate(workers):
+                    if worker.task is None:
+                        continue
+                    if worker.overdue(timeout):
+                        worker.process.kill()
+                        worker.process.join()
+                        entry = {'time': timeout, 'timed_out': 'True', 'killed': 'True', 'log_time': datetime.now()}
+                    elif not worker.process.is_alive():
+                        worker.process.join()
+                        entry = {'time': None, 'timed_out': 'False', 'killed': 'False', 'exit_code': worker.process.exitcode,
+                                 'error': f'worker exited with code {worker.process.exitcode}', 'log_time': datetime.now()}
+                    else:
+                        continue
+                    write_entry(f, worker.task, entry)
+                    remaining -= 1
+                    workers[i] = Worker(context, worker.cpus, results, timeout)
+
+                if finished and remaining % 100 == 0:
+                    log(f'{len(tasks) - remaining}/{len(tasks)} tasks complete')
+        finally:
+            for worker in workers:
+                worker.stop()
+            for worker in workers:
+                worker.process.join(timeout=5)
+                if worker.process.is_alive():
+                    worker.process.kill()
+
+    return output
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run the experiment grid in parallel, resuming from an existing results file')
+    parser.add_argument('--output' , default=f'./results/res_{datetime.now().strftime("%Y_%m_%d_T%H_%M_%S")}/results_dump.jsonl',
+                        help='results file, an existing file is resumed')
+    parser.add_argument('--workers', type=int  , default=None, help='worker processes, defaults to one per CPU')
+    parser.add_argument('--timeout', type=float, default=MAX_TIMEOUT_SECS, help='hard timeout of a single fit in seconds')
+    parser.add_argument('--experiment', action='append', help='only run the named experiment(s)')
+    args = parser.parse_args()
+
+    tasks = experiment_grid()
+    if args.experiment:
+        tasks = [task for task in tasks if task['experiment'] in args.experiment]
+
+    print(f'Results: {run(tasks, args.output, args.workers, args.timeout)}')
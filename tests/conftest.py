@@ -1,6 +1,5 @@
 import os
 import time
-import json
 import signal
 import numpy as np
 from datetime import datetime
@@ -12,33 +11,25 @@ from email.utils import formataddr
 from SECRETS import GMAIL_EMAIL, GMAIL_PASSWORD, EMAIL_RECIPIENTS
 
 import src
-from src.SpectralClustering import SpectralClustering
-from sklearn import metrics
-from sklearn.metrics import cluster
-from src.data_generation import sklearn_make_moons
-
-
-# environment vars for preventing long runtime and repeats
-NUM_REPEATS      = 3
-# NUM_REPEATS      = 5
-MAX_TIMEOUT_SECS = 90
-
-# input size/noise/num_clusters
-RAND_SEED            = None
-# INPUT_SIZES        = [x for x in range(100, 3001, 100)]
-INPUT_SIZES          = [x for x in range(100, 500, 100)]
-INPUT_NOISES         = [0.00, 0.05, 0.10, 0.15, 0.2]
-INPUT_NUM_MOONS      = [3, 4, 5, 6]
-REFINEMENT_K_TESTS   = np.linspace(0, 300, 100, dtype=int).tolist()
-REFINEMENT_EPS_TESTS = np.linspace(0, 1, 30).tolist()
+from experiments import (
+    NUM_REPEATS, MAX_TIMEOUT_SECS, RAND_SEED, INPUT_SIZES, INPUT_NOISES, INPUT_NUM_MOONS, REFINEMENT_K_TESTS, REFINEMENT_EPS_TESTS,
+    PIPELINE_METHODS, binary_moons_data, calc_correctness, keep_affinity, result_entry,
+)
+from results_sink import ResultsSink
+
 
 # where to store current run results
 RESULTS_DUMP_FOLDER = f'./results/res_{datetime.now().strftime("%Y_%m_%d_T%H_%M_%S")}'
 RESULTS_DUMP_DOC    = f'{RESULTS_DUMP_FOLDER}/results_dump.json'
 RESULTS_REPORT_DOC  = f'{RESULTS_DUMP_FOLDER}/report.html'
 
-# complete set of modules available to test for SpectralClustering
-PIPELINE_METHODS = {method : options.keys() for (method, options) in SpectralClustering.COMPONENT_OPTIONS.items()}
+# per-stage profile of the model last fitted through run_timeout_fn, dumped with its result, and the model itself
+# for its metrics to reuse the distances it kept
+LAST_PROFILE = None
+LAST_MODEL   = None
+
+# results are batched and written by a background thread, to the dump file and to columnar parts beside it
+RESULTS_SINK = None
 
 # setup before a testing session: make sure dump folders exist for results
 def pytest_configure(config):
@@ -49,6 +40,8 @@ def pytest_configure(config):
     os.makedirs(os.path.dirname(RESULTS_DUMP_DOC), exist_ok=True)
     with open(RESULTS_DUMP_DOC, 'w') as f:
         f.write('')
+    global RESULTS_SINK
+    RESULTS_SINK = ResultsSink(RESULTS_DUMP_DOC)
 
     # set creation of HTML report
     config.option.htmlpath = f'{RESULTS_DUMP_FOLDER}/report.html'
@@ -61,6 +54,9 @@ def pytest_sessionfinish(session, exitstatus):
     returning the exit status to the system.
     """
 
+    # write out any results still buffered
+    RESULTS_SINK.close()
+
     # send an email of results
     email = EmailMessage()
     email["From"   ] = formataddr(('PYTEST: Results generator', GMAIL_EMAIL))
@@ -87,6 +83,14 @@ def run_timeout_fn(fn, *args, **kwargs):
     signal.signal(signal.SIGALRM, handler)
     signal.alarm(MAX_TIMEOUT_SECS)
 
+    # fitting methods record a profile on their model, keep it and the model for dump_result
+    global LAST_PROFILE, LAST_MODEL
+    model = getattr(fn, '__self__', None)
+    LAST_PROFILE = None
+    LAST_MODEL   = model
+    if hasattr(model, 'keep_affinity') and args:
+        model.keep_affinity = keep_affinity(len(args[0]))
+
     # run the function with supplied arguments, capture result value
     try:
         start   = time.perf_counter()
@@ -94,50 +98,20 @@ def run_timeout_fn(fn, *args, **kwargs):
         end     = time.perf_counter()
         signal.alarm(0)
     except TimeoutError:
+        LAST_PROFILE = getattr(model, 'profile_', None)
         return (MAX_TIMEOUT_SECS, 'TIMEOUT')
+    LAST_PROFILE = getattr(model, 'profile_', None)
     
     exec_time = end - start
     return (exec_time, results)
 
 
-# generate the two moons problem
-def binary_moons_data(n_points, noise):
-    X, labels = sklearn_make_moons(n_points, noise, RAND_SEED)
-    return X, labels
-
-
-# calculate a set of metrics for correctness
-def calc_correctness(X, pred_labels, ground_truth):
-    # TODO: add more measures of correctness
-    return {
-        'adjusted_rand_score'         : cluster.adjusted_rand_score         (ground_truth, pred_labels),
-        'adjusted_mutual_info_score'  : cluster.adjusted_mutual_info_score  (ground_truth, pred_labels),
-        'normalized_mutual_info_score': cluster.normalized_mutual_info_score(ground_truth, pred_labels),
-        'homogeneity_score'           : cluster.homogeneity_score           (ground_truth, pred_labels),
-        'completeness_score'          : cluster.completeness_score          (ground_truth, pred_labels),
-        'v_measure_score'             : cluster.v_measure_score             (ground_truth, pred_labels),
-        'fowlkes_mallows_score'       : cluster.fowlkes_mallows_score       (ground_truth, pred_labels),
-        'silhouette_score'            : metrics.silhouette_score            (X           , pred_labels),
-        'calinski_harabasz_score'     : metrics.calinski_harabasz_score     (X           , pred_labels),
-        'davies_bouldin_score'        : metrics.davies_bouldin_score        (X           , pred_labels),
-    }
-
-def dump_result(n_points, noise, time, experiment = 'DEFAULT', variant = 'DEFAULT', X = None, pred_labels = None, ground_truth = None,):
+# the model defaults to the one last fitted through run_timeout_fn, released once its result is dumped
+def dump_result(n_points, noise, time, experiment = 'DEFAULT', variant = 'DEFAULT', X = None, pred_labels = None, ground_truth = None, model = None):
+    global LAST_MODEL
     timed_out = time == MAX_TIMEOUT_SECS
-    new_entry = {
-        'n_points'  : n_points,
-        'noise'     : noise,
-        'experiment': experiment,
-        'variant'   : variant,
-        'time'      : time,
-        'timed_out' : "True" if timed_out else "False",
-        'log_time'  : datetime.now()
-    }
-
-    if not timed_out:
-        metrics = calc_correctness(X, pred_labels, ground_truth)
-        new_entry.update(metrics)
-
-    with open(RESULTS_DUMP_DOC, 'a') as f:
-        entry_json = json.dumps(new_entry, sort_keys=True, default=str)
-        f.write(f'{entry_json}\n')
+    model     = LAST_MODEL if model is None else model
+    new_entry = result_entry(n_points, noise, time, timed_out, experiment, variant, X, pred_labels, ground_truth, LAST_PROFILE, model)
+    LAST_MODEL = None
+
+    RESULTS_SINK.write(new_entry)
@@ -0,0 +1,114 @@
+import json
+import hashlib
+import numpy as np
+from datetime import datetime
+
+from src.SpectralClustering import SpectralClustering
+from src import evaluation
+from src.data_generation import sklearn_make_moons
+
+# experiment configuration shared by the pytest harness (conftest) and the parallel benchmark runner,
+# kept free of the email/secrets setup so worker processes can import it
+
+
+# environment vars for preventing long runtime and repeats
+NUM_REPEATS      = 3
+# NUM_REPEATS      = 5
+MAX_TIMEOUT_SECS = 90
+
+# input size/noise/num_clusters
+RAND_SEED            = None
+# INPUT_SIZES        = [x for x in range(100, 3001, 100)]
+INPUT_SIZES          = [x for x in range(100, 500, 100)]
+INPUT_NOISES         = [0.00, 0.05, 0.10, 0.15, 0.2]
+INPUT_NUM_MOONS      = [3, 4, 5, 6]
+REFINEMENT_K_TESTS   = np.linspace(0, 300, 100, dtype=int).tolist()
+REFINEMENT_EPS_TESTS = np.linspace(0, 1, 30).tolist()
+
+# complete set of modules available to test for SpectralClustering
+PIPELINE_METHODS = {method : options.keys() for (method, options) in SpectralClustering.COMPONENT_OPTIONS.items()}
+
+# pipeline components compared one at a time against the default model, with their experiment names
+COMPONENT_EXPERIMENTS = {
+    'decomposition'  : 'Decomposition',
+    'laplacian'      : 'Laplacian',
+    'affinity'       : 'Affinity',
+    'refinement'     : 'Refinement',
+    'standardisation': 'Standardisation',
+}
+
+
+# generate the two moons problem
+def binary_moons_data(n_points, noise):
+    X, labels = sklearn_make_moons(n_points, noise, RAND_SEED)
+    return X, labels
+
+
+# models of the harnesses keep their distances for the exact silhouette, larger runs sample it from fresh rows
+def keep_affinity(n_points):
+    return n_points <= evaluation.SAMPLE_THRESHOLD
+
+
+# calculate a set of metrics for correctness, reusing the distances of the fitted model where it kept them
+def calc_correctness(X, pred_labels, ground_truth, model = None):
+    # TODO: add more measures of correctness
+    return evaluation.evaluate(model, X, ground_truth, labels = pred_labels)
+
+
+# a single line of the results dump, correctness metrics are only computed for runs that finished
+def result_entry(n_points, noise, time, timed_out, experiment = 'DEFAULT', variant = 'DEFAULT', X = None, pred_labels = None, ground_truth = None, profile = None, model = None):
+    new_entry = {
+        'n_points'  : n_points,
+        'noise'     : noise,
+        'experiment': experiment,
+        'variant'   : variant,
+        'time'      : time,
+        'timed_out' : "True" if timed_out else "False",
+        'log_time'  : datetime.now()
+    }
+
+    # per-stage profile of the fit, only the stages reached before a timeout
+    if profile is not None:
+        new_entry['profile'] = profile
+
+    if not timed_out:
+        metrics = calc_correctness(X, pred_labels, ground_truth, model)
+        new_entry.update(metrics)
+
+    return new_entry
+
+
+# the experiments of test_time_correctness as a flat list of tasks: data to generate and model parameters
+def experiment_grid():
+    tasks = []
+    def add(repeat, n_points, noise, experiment, variant, params):
+        tasks.append({
+            'repeat'    : repeat,
+            'n_points'  : n_points,
+            'noise'     : noise,
+            'experiment': experiment,
+            'variant'   : variant,
+            'params'    : params,
+        })
+
+    for repeat in range(NUM_REPEATS):
+        for noise in INPUT_NOISES:
+            for n_points in INPUT_SIZES:
+                add(repeat, n_points, noise, 'DEFAULT', 'DEFAULT', {})
+                for (component, experiment) in COMPONENT_EXPERIMENTS.items():
+                    for method in PIPELINE_METHODS[component]:
+                        add(repeat, n_points, noise, experiment, method, {component: method})
+
+            for eps in REFINEMENT_EPS_TESTS:
+                add(repeat, 1000, noise, 'Refinement EPS Impact', eps, {'refinement': 'eps', 'eps': eps})
+            for k in REFINEMENT_K_TESTS:
+                add(repeat, 1000, noise, 'Refinement k Impact KNN', k, {'refinement': 'knn', 'k': k})
+            for k in REFINEMENT_K_TESTS:
+                add(repeat, 1000, noise, 'Refinement k Impact MKNN', k, {'refinement': 'mutual_knn', 'k': k})
+
+    return tasks
+
+
+# stable identifier of a task, used to skip completed tasks when resuming
+def task_id(task):
+    return hashlib.sha1(json.dumps(task, sort_keys=True).encode()).hexdigest()[:16]
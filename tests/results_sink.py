@@ -0,0 +1,184 @@
+import os
+import json
+import glob
+import time
+import queue
+import threading
+import numpy as np
+
+# buffered sink for results entries: writes are queued and a background thread batches them, appending each
+# batch to the JSONL results file (as dumped before) and to a compressed columnar part next to it, one .npz file
+# holding an array per column. A batch is flushed once it reaches FLUSH_RECORDS entries or its oldest entry has
+# waited FLUSH_SECS, and on flush()/close(). load_columns reads back only the columns an analysis asks for
+
+
+FLUSH_RECORDS = 1000
+FLUSH_SECS    = 5.0
+
+
+class ResultsSink:
+    def __init__(self, path, columns_dir = None, flush_records = FLUSH_RECORDS, flush_secs = FLUSH_SECS):
+        self.path          = path
+        self.columns_dir   = columns_dir or columns_dir_of(path)
+        self.flush_records = flush_records
+        self.flush_secs    = flush_secs
+
+        os.makedirs(self.columns_dir, exist_ok=True)
+        parts        = sorted(glob.glob(os.path.join(self.columns_dir, 'part_*.npz')))
+        self.n_parts = len(parts)
+        # columns already written as text stay text in later parts, whatever the types of their new values
+        self.text = set()
+        for part in parts:
+            with np.load(part) as f:
+                self.text.update(name for name in f.files if not is_numeric(f[name].dtype))
+        self.error   = None
+        self.queue   = queue.Queue()
+        self.thread  = threading.Thread(target=self._run, name='results-sink', daemon=True)
+        self.thread.start()
+
+    # an entry written to a closed sink would sit in the queue and never reach disk, so that is raised
+    def write(self, entry):
+        self._check_open()
+        self.queue.put(entry)
+
+    # block until everything written so far is on disk. A closed sink, or one whose writer thread has exited,
+    # would never answer, so that is raised instead of waiting
+    def flush(self):
+        self._check_open()
+        done = threading.Event()
+        self.queue.put(done)
+        while not done.wait(timeout=1.0):
+            if not self.thread.is_alive():
+                self._check()
+                raise ValueError(f'Results sink for {self.path} stopped before flushing')
+        self._check()
+
+    def close(self):
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+        self._check()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    # errors of the writer thread are raised on the caller's next write, flush or close
+    def _check(self):
+        if self.error is not None:
+            raise self.error
+
+    def _check_open(self):
+        self._check()
+        if not self.thread.is_alive():
+            raise ValueError(f'Results sink for {self.path} is closed')
+
+    def _run(self):
+        batch, deadline = [], None
+        while True:
+            timeout = None if deadline is None else max(0, deadline - time.monotonic())
+            try:
+                item = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                item = False
+
+            if isinstance(item, dict):
+                batch.append(item)
+                deadline = deadline or time.monotonic() + self.flush_secs
+                if len(batch) < self.flush_records:
+                    continue
+
+            # batch full, oldest entry waited long enough, or flush/close requested
+            try:
+                if batch and self.error is None:
+                    self._write(batch)
+            except Exception as e:
+                self.error = e
+            batch, deadline = [], None
+
+            if isinstance(item, threading.Event):
+                item.set()
+            if item is None:
+                return
+
+    def _write(self, batch):
+        with open(self.path, 'a') as f:
+            f.write(''.join(json.dumps(entry, sort_keys=True, default=str) + '\n' for entry in batch))
+
+        names   = sorted(set().union(*batch))
+        part    = os.path.join(self.columns_dir, f'part_{self.n_parts:06d}.npz')
+        columns = {name: as_column([entry.get(name) for entry in batch], name in self.text) for name in names}
+        # written under a temporary name, readers only ever see complete parts
+        with open(part + '.tmp', 'wb') as f:
+            np.savez_compressed(f, **columns)
+        os.replace(part + '.tmp', part)
+        self.n_parts += 1
+        self.text.update(name for (name, column) in columns.items() if not is_numeric(column.dtype))
+
+
+# columnar parts of a JSONL results file are kept in a directory beside it
+def columns_dir_of(path):
+    return os.path.splitext(path)[0] + '_columns'
+
+
+# values of one column as an array: booleans, integers and floats as numeric arrays (missing floats as NaN),
+# everything else (or everything, for text columns) as strings with nested values (e.g. profiles) JSON encoded
+# and missing values empty
+def as_column(values, text = False):
+    present = [] if text else [v for v in values if v is not None]
+    if present and all(isinstance(v, (bool, np.bool_)) for v in present) and len(present) == len(values):
+        return np.array(values, dtype=bool)
+    if present and all(isinstance(v, (int, float, np.integer, np.floating)) and not isinstance(v, (bool, np.bool_)) for v in present):
+        if len(present) == len(values) and all(isinstance(v, (int, np.integer)) for v in present):
+            return np.array(values, dtype=np.int64)
+        return np.array([np.nan if v is None else v for v in values], dtype=np.float64)
+    return np.array([as_text(v) for v in values], dtype=str)
+
+
+def as_text(value):
+    if value is None:
+        return ''
+    if isinstance(value, (dict, list, tuple)):
+        return json.dumps(value, sort_keys=True, default=str)
+    return str(value)
+
+
+# the named columns (all by default) of the results written by a ResultsSink, concatenated over its parts. Only
+# the requested columns are decompressed; parts without a column fill it with NaN (numeric) or '' (strings).
+# A sink keeps a column text once it has written it as text, a column numeric in earlier parts and text in later
+# ones is raised rather than silently read back as strings
+def load_columns(path, columns = None):
+    parts = sorted(glob.glob(os.path.join(columns_dir_of(path), 'part_*.npz')))
+    files = [np.load(part) for part in parts]
+    try:
+        if columns is None:
+            columns = sorted(set().union(*[f.files for f in files]))
+
+        res = {}
+        for name in columns:
+            arrays = [f[name] if name in f.files else None for f in files]
+            found  = [a for a in arrays if a is not None]
+            if not found:
+                raise KeyError(f'No column {name!r} in results {path}')
+            if len({is_numeric(a.dtype) for a in found}) > 1:
+                raise ValueError(f'Column {name!r} of results {path} is numeric in some parts and text in others')
+            # the length of a part without the column is read from another of its columns
+            res[name] = np.concatenate([
+                a if a is not None else missing(found[0].dtype, len(f[f.files[0]])) for (a, f) in zip(arrays, files)
+            ])
+        return res
+    finally:
+        for f in files:
+            f.close()
+
+
+def is_numeric(dtype):
+    return dtype.kind in 'biuf'
+
+
+def missing(dtype, n):
+    if is_numeric(dtype):
+        return np.full(n, np.nan)
+    return np.full(n, '', dtype=str)
@@ -0,0 +1,213 @@
+import os
+import io
+import sys
+import json
+import inspect
+import argparse
+import contextlib
+import numpy as np
+from datetime import datetime
+
+from experiments import PIPELINE_METHODS
+from src.SpectralClustering import SpectralClustering
+from src.data_generation import sklearn_make_moons
+
+# scaling benchmark: times every pipeline stage of each configuration over a geometric range of input sizes on
+# fixed-seed data, fits an empirical complexity exponent per stage (the slope of log time against log n) and
+# compares the times against a baseline kept in the repo, failing when a stage has slowed down beyond a threshold.
+# Each configuration swaps one component option into a base that scales to large n (tree affinity, mutual k-NN
+# graph, LOBPCG), and grows n until the next size is predicted to exceed the time or memory budget
+
+
+SCALING_SEED     = 0
+SCALING_NOISE    = 0.05
+SCALING_SIZES    = np.geomspace(250, 100000, 9).round().astype(int).tolist()
+SCALING_BASE     = {'affinity': 'euclidean_tree', 'refinement': 'mutual_knn', 'decomposition': 'lobpcg'}
+MAX_FIT_SECS     = 30
+
+# budget for the largest graph matrix of a fit, dense stages hold several copies of it at once
+MAX_MEMORY_BYTES = 2**29
+
+# fits quicker than this are repeated, keeping the fastest of the repeats
+REPEAT_BELOW_SECS = 1
+NUM_REPEATS       = 3
+
+# times below this are dominated by noise, they are not fitted or compared
+MIN_FIT_SECS      = 1e-3
+MIN_COMPARE_SECS  = 0.05
+DEFAULT_THRESHOLD = 1.5
+
+BASELINE_DOC = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baselines', 'scaling.json')
+
+
+# the library defaults, then each option of each component swapped into the scalable base
+def configurations():
+    defaults = {name: p.default for (name, p) in inspect.signature(SpectralClustering).parameters.items()}
+    configs  = {'DEFAULT': {}, 'BASE': dict(SCALING_BASE)}
+    for (component, options) in PIPELINE_METHODS.items():
+        for option in options:
+            if option == SCALING_BASE.get(component, defaults[component]):
+                continue
+            params = {**SCALING_BASE, component: option}
+            # nystrom replaces the graph with a gaussian kernel of width eps and solves its own eigenproblem
+            if component == 'approximation' and option == 'nystrom':
+                params.update(refinement='eps', laplacian='normalised', decomposition='dense')
+            # directed k-NN graphs give non-symmetric laplacians, which LOBPCG cannot solve
+            if component == 'refinement' and option == 'knn':
+                params.update(decomposition='auto')
+            configs[f'{component}={option}'] = params
+    return configs
+
+
+# per-stage wall times of one fit, the fastest of a few repeats for quick fits
+def measure(params, n_points):
+    X, _ = sklearn_make_moons(n_points, SCALING_NOISE, SCALING_SEED)
+
+    best = None
+    for _ in range(NUM_REPEATS):
+        model = SpectralClustering(2, random_state=SCALING_SEED, **params)
+        with contextlib.redirect_stdout(io.StringIO()):
+            model.fit(X)
+
+        times = {record['stage']: record['wall_time'] for record in model.profile_}
+        best  = times if best is None else {stage: min(t, times[stage]) for (stage, t) in best.items()}
+        if sum(times.values()) > REPEAT_BELOW_SECS:
+            break
+
+    # graph sizes are kept for the memory prediction
+    sizes = {record['stage']: graph_bytes(record) for record in model.profile_ if 'nnz' in record}
+    return best, sizes
+
+
+# approximate bytes held by a square graph matrix from its profile record
+def graph_bytes(record):
+    if record['output_type'] == 'ndarray':
+        return record['shape'][0] * record['shape'][1] * 8
+    return record['nnz'] * 16
+
+
+# slope of log(value) against log(n), None without at least two usable points
+def fit_exponent(sizes, values, min_value = MIN_FIT_SECS):
+    points = [(n, v) for (n, v) in zip(sizes, values) if v is not None and v >= min_value]
+    if len(points) < 2:
+        return None
+    log_n, log_v = np.log([n for (n, _) in points]), np.log([v for (_, v) in points])
+    return float(np.polyfit(log_n, log_v, 1)[0])
+
+
+# extrapolate the last measured value to n, growing at least as fast as the exponent floor
+def predict(sizes, values, n, floor):
+    if values[-1] <= 0:
+        return 0
+    exponent = fit_exponent(sizes[-2:], values[-2:], min_value=0) if len(sizes) > 1 else None
+    exponent = floor if exponent is None else max(exponent, floor)
+    return values[-1] * (n / sizes[-1]) ** exponent
+
+
+def scale(params, max_fit_secs = MAX_FIT_SECS, max_memory_bytes = MAX_MEMORY_BYTES, log = print):
+    sizes, totals, memory, stages = [], [], [], {}
+    for n in SCALING_SIZES:
+        # stop once the next size is predicted to run too long or need too much memory
+        if sizes and predict(sizes, totals, n, 1) > max_fit_secs:
+            break
+        if memory and predict(sizes, memory, n, 1) > max_memory_bytes:
+            break
+
+        times, graphs = measure(params, n)
+        sizes .append(n)
+        totals.append(sum(times.values()))
+        memory.append(max(graphs.values(), default=0))
+        for (stage, t) in times.items():
+            stages.setdefault(stage, []).append(t)
+        log(f'  n = {n:>6}: {totals[-1]:.3f}s')
+
+    return {
+        'params': params,
+        'sizes' : sizes,
+        'total' : {'times': totals, 'exponent': fit_exponent(sizes, totals)},
+        'stages': {stage: {'times': t, 'exponent': fit_exponent(sizes, t)} for (stage, t) in stages.items()},
+    }
+
+
+# stages of each configuration slower than the baseline by more than threshold times, at any shared size.
+# Configurations and stages the baseline has no times for cannot be compared, see unbaselined
+def regressions(results, baseline, threshold = DEFAULT_THRESHOLD):
+    found = []
+    for (config, result) in results.items():
+        if config not in baseline:
+            continue
+        base_sizes = baseline[config]['sizes']
+
+        for (stage, current) in result['stages'].items():
+            if stage not in baseline[config]['stages']:
+                continue
+            base_times = baseline[config]['stages'][stage]['times']
+
+            for (n, t) in zip(result['sizes'], current['times']):
+                if n not in base_sizes:
+                    continue
+                base = base_times[base_sizes.index(n)]
+                if base >= MIN_COMPARE_SECS and t > threshold * base:
+                    found.append({'config': config, 'stage': stage, 'n_points': n, 'time': t, 'baseline': base, 'ratio': t / base})
+
+    return found
+
+
+# configurations (stage None) and stages of the results missing from the baseline, each one a failure of the gate:
+# a new option or stage has to be recorded with --update-baseline before it is checked
+def unbaselined(results, baseline):
+    missing = []
+    for (config, result) in results.items():
+        if config not in baseline:
+            missing.append({'config': config, 'stage': None})
+            continue
+        missing += [{'config': config, 'stage': stage} for stage in result['stages'] if stage not in baseline[config]['stages']]
+    return missing
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Time each pipeline stage over growing inputs and compare against the stored baseline')
+    parser.add_argument('--config'   , action='append', help='only run the named configuration(s)')
+    parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD, help='slowdown ratio counted as a regression')
+    parser.add_argument('--max-fit-secs', type=float, default=MAX_FIT_SECS, help='largest predicted fit time to run')
+    parser.add_argument('--baseline' , default=BASELINE_DOC, help='baseline results file')
+    parser.add_argument('--update-baseline', action='store_true', help='write these results as the new baseline')
+    parser.add_argument('--output'   , default=f'./results/scaling_{datetime.now().strftime("%Y_%m_%d_T%H_%M_%S")}.json')
+    args = parser.parse_args()
+
+    configs = configurations()
+    if args.config:
+        configs = {name: params for (name, params) in configs.items() if name in args.config}
+
+    results = {}
+    for (name, params) in configs.items():
+        print(f'{name}: {params}')
+        results[name] = scale(params, args.max_fit_secs)
+        exponents = {stage: s['exponent'] for (stage, s) in results[name]['stages'].items() if s['exponent'] is not None}
+        print('  exponents: ' + ', '.join(f'{stage} {e:.2f}' for (stage, e) in exponents.items()))
+
+    path = args.baseline if args.update_baseline else args.output
+    if args.update_baseline and os.path.exists(path):
+        # keep configurations not re-run this time
+        with open(path) as f:
+            results = {**json.load(f), **results}
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, 'w') as f:
+        json.dump(results, f, indent=1, sort_keys=True)
+    print(f'Results: {path}')
+
+    if args.update_baseline:
+        sys.exit(0)
+    if not os.path.exists(args.baseline):
+        print('No baseline to compare against')
+        sys.exit(0)
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    found   = regressions(results, baseline, args.threshold)
+    missing = unbaselined(results, baseline)
+    for r in found:
+        print(f"REGRESSION {r['config']} / {r['stage']} at n = {r['n_points']}: {r['time']:.3f}s against {r['baseline']:.3f}s ({r['ratio']:.2f}x)")
+    for r in missing:
+        print(f"MISSING {r['config']}" + (f" / {r['stage']}" if r['stage'] else '') + ' from the baseline, record it with --update-baseline')
+    sys.exit(1 if found or missing else 0)
@@ -0,0 +1,951 @@
+import os
+import sys
+import json
+import time
+import itertools
+import subprocess
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor
+import pytest
+import numpy as np
+import scipy
+from sklearn import datasets
+from sklearn import metrics
+from sklearn.metrics import cluster
+from src.SpectralClustering import SpectralClustering
+from src.ComponentRegistry import ComponentRegistry
+from src import evaluation
+from src.StageCache import StageCache
+from src.StageProfiler import describe_output
+from src.IncrementalGraph import IncrementalGraph
+from src.pipeline_transformers import affinity, refinement, laplacian, decomposition, embedding, clustering, confidence, scratch, approximation
+import conftest
+import experiments
+from conftest import binary_moons_data
+from src.data_generation import sklearn_make_moons, make_many_moons, iter_many_moons, write_many_moons
+import benchmark
+import scaling
+import results_sink
+
+def as_dense(A):
+    return A.toarray() if scipy.sparse.issparse(A) else A
+
+@pytest.mark.parametrize('metric', affinity.AffinityTransformer.SUPPORTED_DISTANCE_METRICS)
+class TestNeighbourIndexGraphs:
+
+    @pytest.mark.parametrize('transformer', [
+        refinement.EpsilonNNTransformer(0.0),
+        refinement.EpsilonNNTransformer(0.3),
+        refinement.kNNTransformer(0),
+        refinement.kNNTransformer(10),
+        refinement.MutualKNNTransformer(10),
+        refinement.CompleteTransformer(),
+    ])
+    def test_tree_matches_dense(self, metric, transformer):
+        # graphs from a neighbour index must be identical to those from the full distance matrix
+        X, _  = binary_moons_data(200, 0.05)
+        dense = affinity.AffinityTransformer(metric).transform(X)
+        index = affinity.AffinityTransformer(metric, algorithm='kd_tree').transform(X)
+
+        np.testing.assert_array_equal(transformer.transform(dense), as_dense(transformer.transform(index)))
+
+    @pytest.mark.parametrize('n_features', [2, 40])
+    @pytest.mark.parametrize('transformer', [
+        refinement.EpsilonNNTransformer(0.0),
+        refinement.EpsilonNNTransformer(0.3),
+        refinement.kNNTransformer(0),
+        refinement.kNNTransformer(10),
+        refinement.MutualKNNTransformer(10),
+        refinement.CompleteTransformer(),
+    ])
+    def test_chunked_matches_dense(self, metric, transformer, n_features):
+        # graphs reduced from small blocks of distance rows must be identical to those from the full matrix
+        X     = np.random.default_rng(0).random((200, n_features)) / np.sqrt(n_features)
+        dense = affinity.AffinityTransformer(metric).transform(X)
+        rows  = affinity.AffinityTransformer(metric, algorithm='chunked', working_memory=0.01).transform(X)
+
+        np.testing.assert_array_equal(transformer.transform(dense), as_dense(transformer.transform(rows)))
+
+@pytest.mark.parametrize('normalize', [False, True])
+class TestLaplacianRepresentations:
+
+    def test_sparse_and_operator_match_dense(self, normalize):
+        X, _  = binary_moons_data(200, 0.05)
+        A     = refinement.EpsilonNNTransformer(0.3).transform(affinity.AffinityTransformer().transform(X))
+        dense = laplacian.LaplacianTransformer(normalize).transform(A)
+
+        sparse = laplacian.LaplacianTransformer(normalize).transform(scipy.sparse.csr_matrix(A))
+        op     = laplacian.LaplacianTransformer(normalize, operator=True).transform(scipy.sparse.csr_matrix(A))
+        np.testing.assert_allclose(sparse.toarray(), dense)
+        np.testing.assert_allclose(op @ np.eye(len(A)), dense)
+
+    def test_weighted_degree(self, normalize):
+        # degree is the total edge weight, not the number of edges
+        A = np.array([[0, 2, 0], [2, 0, 0.5], [0, 0.5, 0]])
+        L = laplacian.LaplacianTransformer(normalize).transform(scipy.sparse.csr_matrix(A)).toarray()
+
+        expected = np.diag(A.sum(axis=0)) - A
+        if normalize:
+            s        = 1 / np.sqrt(A.sum(axis=0))
+            expected = expected * np.outer(s, s)
+        np.testing.assert_allclose(L, expected)
+
+@pytest.mark.parametrize('method', decomposition.DecompositionTransformer.PARTIAL_METHODS)
+class TestPartialDecomposition:
+
+    def test_smallest_eigenvalues_match_dense(self, method):
+        X, _ = binary_moons_data(300, 0.05)
+        A    = refinement.EpsilonNNTransformer(0.3).transform(affinity.AffinityTransformer().transform(X))
+        L    = laplacian.LaplacianTransformer(True).transform(scipy.sparse.csr_matrix(A))
+
+        transformer = decomposition.DecompositionTransformer(method, n_components=4, random_state=0)
+        res         = transformer.transform(L)
+        expected    = np.linalg.eigvalsh(L.toarray())[:4]
+
+        assert res.eigenvectors().shape == (300, 4)
+        assert res.convergence['converged']
+        np.testing.assert_allclose(res.eigenvalues, expected, atol=1e-6)
+
+class TestNystrom:
+
+    @pytest.mark.parametrize('sampling', approximation.NystromTransformer.SUPPORTED_SAMPLING)
+    def test_landmark_sampling(self, sampling):
+        X, _ = binary_moons_data(300, 0.05)
+        sample = lambda seed, m: approximation.NystromTransformer(m, sampling, random_state=seed)._sample_landmarks(X, m)
+
+        # distinct training points, the same ones for the same seed
+        landmarks = sample(0, 50)
+        assert len(np.unique(landmarks)) == 50 and landmarks.max() < len(X)
+        np.testing.assert_array_equal(sample(0, 50), landmarks)
+        assert not np.array_equal(sample(1, 50), landmarks)
+
+        # never more landmarks than points
+        transformer = approximation.NystromTransformer(500, sampling, random_state=0)
+        transformer.transform(X)
+        assert len(transformer.landmarks_) == len(X)
+
+    def test_matches_exact_embedding(self):
+        X, _ = datasets.make_moons(300, noise=0.05, random_state=0)
+        W    = np.exp(-2 * (metrics.pairwise_distances(X) / 0.3) ** 2)
+        s    = 1 / np.sqrt(W.sum(axis=0))
+        eigenvalues, eigenvectors = np.linalg.eigh(np.eye(len(X)) - W * np.outer(s, s))
+
+        # every point a landmark is the exact normalised decomposition of the kernel, fewer approximate it
+        for (n_landmarks, tol) in [(300, 1e-5), (100, 1e-3)]:
+            res = approximation.NystromTransformer(n_landmarks, eps=0.3, n_components=4, random_state=0).transform(X)
+            np.testing.assert_allclose(res.eigenvalues, eigenvalues[:4], atol=tol)
+
+            V = res.eigenvectors() / np.linalg.norm(res.eigenvectors(), axis=0)
+            np.testing.assert_allclose(np.abs((V * eigenvectors[:, :4]).sum(axis=0)), 1, atol=tol)
+
+    def test_requires_eps_refinement(self):
+        # the kernel is scaled by eps, the k-NN refinements have no counterpart
+        with pytest.raises(ValueError):
+            SpectralClustering(2, approximation='nystrom', refinement='knn')
+
+    @pytest.mark.parametrize('params', [{}, {'laplacian': 'normalised', 'decomposition': 'lobpcg'}])
+    def test_rejects_settings_it_ignores(self, params):
+        with pytest.raises(ValueError):
+            SpectralClustering(2, approximation='nystrom', **params)
+
+@pytest.mark.parametrize('params', [
+    {},
+    {'laplacian': 'normalised'},
+    {'affinity': 'euclidean_tree', 'decomposition': 'lobpcg', 'standardisation': 'standard'},
+    {'affinity': 'manhattan_chunked', 'refinement': 'mutual_knn', 'decomposition': 'lobpcg', 'working_memory': 0.1},
+    {'approximation': 'nystrom', 'laplacian': 'normalised', 'eps': 0.3},
+])
+class TestPredict:
+
+    def test_predict_matches_fit(self, params):
+        # extending the embedding to the training points themselves should reproduce their labels
+        X, _  = binary_moons_data(500, 0.05)
+        model = SpectralClustering(2, **params)
+        model.fit(X)
+
+        assert cluster.adjusted_rand_score(model.labels_, model.predict(X)) > 0.95
+
+    def test_predict_unseen(self, params):
+        X, _         = binary_moons_data(500, 0.05)
+        X_new, y_new = binary_moons_data(100, 0.05)
+        model = SpectralClustering(2, **params)
+        model.fit(X)
+
+        assert cluster.adjusted_rand_score(y_new, model.predict(X_new)) > 0.9
+
+    def test_index_built_on_predict(self, params):
+        # fitting alone builds no neighbour index for predict
+        X, _  = binary_moons_data(300, 0.05)
+        model = SpectralClustering(2, **params)
+        model.fit(X)
+        assert model.index_ is None
+
+        model.predict(X[:10])
+        assert (model.index_ is None) == (model.approximation == 'nystrom')
+
+class TestStageCache:
+
+    def test_sweep_reuses_upstream_stages(self, tmp_path):
+        X, _  = binary_moons_data(300, 0.05)
+        cache = StageCache(max_memory_items=0, directory=tmp_path)
+
+        # second eps value can reuse only standardisation and affinity, a repeat fit reuses every cached stage
+        labels = SpectralClustering(2, eps=0.3, cache=cache).fit(X)
+        SpectralClustering(2, eps=0.4, cache=cache).fit(X)
+        assert cache.hits == 2
+        repeat = SpectralClustering(2, eps=0.3, cache=cache).fit(X)
+        assert cache.hits == 2 + len(StageCache.CACHED_STEPS) - 1
+        assert cluster.adjusted_rand_score(labels, repeat) == pytest.approx(1)
+
+    def test_disk_eviction(self, tmp_path):
+        X, _  = binary_moons_data(300, 0.05)
+        cache = StageCache(directory=tmp_path, max_disk_bytes=2**20)
+        SpectralClustering(2, cache=cache).fit(X)
+
+        assert sum(f.stat().st_size for f in tmp_path.iterdir()) <= 2**20
+
+    def test_memory_bytes_bound(self):
+        X, _  = binary_moons_data(300, 0.05)
+        cache = StageCache(max_memory_bytes=10**6)
+        model = SpectralClustering(2, cache=cache)
+        model.fit(X)
+
+        # the 300 x 300 float64 stage outputs fit in the budget one at a time, only the latest is kept
+        assert 0 < cache.memory_bytes <= 10**6
+        assert cache.get(model.cache_keys_['affinity']) is None
+        assert cache.get(model.cache_keys_['embedding']) is not None
+
+class TestFitPath:
+
+    @pytest.mark.parametrize('transformer, values', [
+        (refinement.EpsilonNNTransformer, [0.5, 0.0, 0.3]),
+        (refinement.kNNTransformer      , [20, 0, 5]),
+        (refinement.MutualKNNTransformer, [20, 0, 5]),
+    ])
+    def test_path_graphs_match_transformers(self, transformer, values):
+        X, _  = binary_moons_data(300, 0.05)
+        index = affinity.AffinityTransformer(algorithm='kd_tree').transform(X)
+        if transformer is refinement.EpsilonNNTransformer:
+            graphs = refinement.eps_path_graphs(index, values)
+        else:
+            graphs = refinement.knn_path_graphs(index, values, mutual = transformer is refinement.MutualKNNTransformer)
+
+        for (value, A) in graphs:
+            np.testing.assert_array_equal(A.toarray(), as_dense(transformer(value).transform(index)))
+
+    def test_path_matches_individual_fits(self):
+        # seeded data and k-means, small eps leave the graph disconnected and the clustering sensitive to its start
+        X, _   = sklearn_make_moons(400, 0.05, 0)
+        values = [0.5, 0.3, 0.4]
+        labels, diagnostics = SpectralClustering(2, decomposition='dense_eigh', random_state=0).fit_path(X, eps=values)
+
+        assert [d['value'] for d in diagnostics] == values
+        for (eps, path_labels) in zip(values, labels):
+            expected = SpectralClustering(2, decomposition='dense_eigh', eps=eps, random_state=0).fit(X)
+            assert cluster.adjusted_rand_score(expected, path_labels) == pytest.approx(1)
+
+class TestPartialFit:
+
+    @pytest.mark.parametrize('graph, transformer', [
+        (IncrementalGraph('eps', eps=0.3)      , refinement.EpsilonNNTransformer(0.3)),
+        (IncrementalGraph('knn', k=10)         , refinement.kNNTransformer(10)),
+        (IncrementalGraph('mutual_knn', k=10)  , refinement.MutualKNNTransformer(10)),
+    ])
+    def test_incremental_graph_matches_transformers(self, graph, transformer):
+        # graph grown over uneven batches must equal the one built from all points at once
+        X, _ = binary_moons_data(300, 0.05)
+        for batch in np.split(np.arange(len(X)), [50, 55, 130, 290]):
+            graph.add(X[batch])
+
+        A = transformer.transform(affinity.AffinityTransformer().transform(X))
+        np.testing.assert_array_equal(graph.adjacency().toarray(), A)
+
+        # degrees kept up to date batch by batch, and the edges of the last batch into the points before it
+        np.testing.assert_array_equal(graph.degrees, A.sum(axis=0))
+        np.testing.assert_array_equal(graph.batch_edges.toarray(), A[:290, 290:].T)
+
+    def test_partial_fit_clusters_moons(self):
+        X, y  = binary_moons_data(2000, 0.05)
+        model = SpectralClustering(2, affinity='euclidean_tree', eps=0.3, decomposition='lobpcg', laplacian='normalised', random_state=0)
+        for batch in np.array_split(np.arange(len(X)), 5):
+            model.partial_fit(X[batch])
+
+        assert len(model.labels_) == len(X)
+        assert cluster.adjusted_rand_score(y, model.labels_) > 0.9
+
+    def test_batches_extend_without_resolving(self, monkeypatch):
+        X, y  = sklearn_make_moons(1200, 0.05, 0)
+        model = SpectralClustering(2, affinity='euclidean_tree', eps=0.3, decomposition='lobpcg', laplacian='normalised', random_state=0)
+        model.partial_fit(X[:1000])
+        labels = model.labels_.copy()
+
+        # a small batch is labelled by extension, nothing is re-solved or re-clustered
+        monkeypatch.setattr(model._partial_decomposition, 'transform', lambda L: pytest.fail('re-solved'))
+        monkeypatch.setattr(model.pipeline.named_steps['clustering'], 'fit_transform', lambda Z: pytest.fail('re-clustered'))
+        model.partial_fit(X[1000:1100])
+        assert model.n_refreshed_ == 1000
+        np.testing.assert_array_equal(model.labels_[:1000], labels)
+        assert cluster.adjusted_rand_score(y[:1100], model.labels_) > 0.9
+
+        # extended points are training points for predict too
+        assert cluster.adjusted_rand_score(model.labels_, model.predict(X[:1100])) > 0.95
+
+        monkeypatch.undo()
+        model.partial_fit(X[1100:], refresh=True)
+        assert model.n_refreshed_ == 1200
+        assert cluster.adjusted_rand_score(y, model.labels_) > 0.9
+
+class TestBenchmarkRunner:
+
+    def test_timeout_and_resume(self, tmp_path):
+        output = str(tmp_path / 'results.jsonl')
+        tasks  = [
+            {'repeat': 0, 'n_points': 200 , 'noise': 0.05, 'experiment': 'DEFAULT', 'variant': 'DEFAULT', 'params': {}},
+            {'repeat': 1, 'n_points': 200 , 'noise': 0.05, 'experiment': 'DEFAULT', 'variant': 'DEFAULT', 'params': {}},
+            {'repeat': 0, 'n_points': 3000, 'noise': 0.05, 'experiment': 'Decomposition', 'variant': 'dense', 'params': {'decomposition': 'dense'}},
+        ]
+        benchmark.run(tasks[:2], output, n_workers=1, timeout=0.5, log=lambda message: None)
+        benchmark.run(tasks    , output, n_workers=1, timeout=0.5, log=lambda message: None)
+
+        # only the new task runs on resume, and hits its timeout
+        with open(output) as f:
+            entries = [json.loads(line) for line in f]
+        assert [e['repeat'] for e in entries] == [0, 1, 0]
+        assert [e['timed_out'] for e in entries] == ['False', 'False', 'True']
+        assert all('adjusted_rand_score' in e for e in entries[:2])
+
+    def test_dead_worker_not_timed_out(self, tmp_path):
+        output = str(tmp_path / 'results.jsonl')
+        tasks  = [{'repeat': 0, 'n_points': 3000, 'noise': 0.05, 'experiment': 'Decomposition', 'variant': 'dense', 'params': {'decomposition': 'dense'}}]
+
+        # a worker killed from outside well within its timeout is recorded with its exit code, not as timed out
+        with ThreadPoolExecutor(1) as executor:
+            future = executor.submit(benchmark.run, tasks, output, n_workers=1, timeout=600, log=lambda message: None)
+            while not multiprocessing.active_children():
+                time.sleep(0.05)
+            time.sleep(1)
+            for process in multiprocessing.active_children():
+                process.kill()
+            future.result(timeout=60)
+
+        with open(output) as f:
+            entries = [json.loads(line) for line in f]
+        assert len(entries) == 1
+        assert entries[0]['timed_out'] == 'False' and entries[0]['exit_code'] == -9
+
+class TestProfile:
+
+    def test_records_every_stage(self):
+        X, _     = binary_moons_data(300, 0.05)
+        received = []
+        model    = SpectralClustering(2, profile_memory=True, profile_callback=received.append)
+        model.fit(X)
+
+        assert [r['stage'] for r in model.profile_] == [name for (name, _) in model.pipeline.steps]
+        assert received == model.profile_
+
+        records = {r['stage']: r for r in model.profile_}
+        assert records['affinity']['shape'] == [300, 300]
+        assert records['affinity']['peak_memory'] >= 300 * 300 * 8
+        A = refinement.EpsilonNNTransformer(SpectralClustering.DEFAULT_EPS).transform(affinity.AffinityTransformer().transform(X))
+        assert records['refinement']['nnz'] == np.count_nonzero(A)
+        assert records['decomposition']['output_type'] == 'SpectralDecomposition'
+
+    def test_decomposition_shape(self):
+        # the recorded shape is read without reordering the eigenvectors of an unsorted solve
+        res = decomposition.SpectralDecomposition(np.array([3.0, 1.0, 2.0]), np.eye(5, 3), 'dense')
+        assert res.shape == res.eigenvectors().shape == (5, 3)
+        assert describe_output(res)['shape'] == [5, 3]
+
+    def test_cached_stages_flagged(self):
+        X, _  = binary_moons_data(300, 0.05)
+        cache = StageCache()
+        SpectralClustering(2, cache=cache).fit(X)
+        model = SpectralClustering(2, cache=cache, laplacian='normalised')
+        model.fit(X)
+
+        cached = [r['stage'] for r in model.profile_ if r['cached']]
+        assert cached == ['standardisation', 'affinity', 'refinement']
+
+class TestScalingBenchmark:
+
+    def test_fit_exponent(self):
+        sizes = [1000, 2000, 4000, 8000]
+        assert scaling.fit_exponent(sizes, [1e-3 * (n / 1000) ** 2 for n in sizes]) == pytest.approx(2)
+        # times under the noise floor are left out of the fit
+        assert scaling.fit_exponent(sizes, [1e-6, 1e-6, 0.1, 0.3]) == pytest.approx(np.log2(3))
+        assert scaling.fit_exponent(sizes, [1e-6, 1e-6, 1e-6, 0.3]) is None
+
+    def test_regressions(self):
+        baseline = {'BASE': {'sizes': [1000, 2000], 'stages': {'affinity': {'times': [0.1, 0.2]}, 'clustering': {'times': [0.001, 0.002]}}}}
+        results  = {'BASE': {'sizes': [1000, 2000, 4000], 'stages': {'affinity': {'times': [0.1, 0.5, 1.0]}, 'clustering': {'times': [0.01, 0.02, 0.04]}}}}
+
+        found = scaling.regressions(results, baseline, threshold=1.5)
+        assert [(r['stage'], r['n_points']) for r in found] == [('affinity', 2000)]
+
+    def test_unbaselined(self):
+        baseline = {'BASE': {'sizes': [1000], 'stages': {'affinity': {'times': [0.1]}}}}
+        results  = {
+            'BASE'          : {'sizes': [1000], 'stages': {'affinity': {'times': [0.1]}, 'confidence': {'times': [0.1]}}},
+            'clustering=gap': {'sizes': [1000], 'stages': {'affinity': {'times': [10.0]}}},
+        }
+
+        # stages and configurations without baseline times are reported, not passed as unchanged
+        assert scaling.regressions(results, baseline) == []
+        assert scaling.unbaselined(results, baseline) == [
+            {'config': 'BASE', 'stage': 'confidence'}, {'config': 'clustering=gap', 'stage': None},
+        ]
+
+    def test_baseline_covers_configurations(self):
+        with open(scaling.BASELINE_DOC) as f:
+            baseline = json.load(f)
+        assert sorted(set(scaling.configurations()) - set(baseline)) == []
+
+    def test_symmetric_solvers_get_symmetric_graphs(self):
+        # the solvers for symmetric matrices are never handed the laplacian of a directed k-NN graph
+        symmetric_only = ['dense_eigh', 'dense_subset', 'sparse_eigh', 'shift_invert', 'lobpcg']
+        for (name, params) in scaling.configurations().items():
+            if params.get('decomposition') in symmetric_only:
+                assert params.get('refinement') != 'knn', name
+
+class TestReducedPrecision:
+
+    @pytest.mark.parametrize('params', [
+        {'decomposition': 'dense_eigh'},
+        {'laplacian': 'normalised', 'decomposition': 'dense'},
+        {'refinement': 'mutual_knn', 'affinity': 'manhattan', 'decomposition': 'dense_eigh'},
+        {'refinement': 'knn', 'k': 30, 'decomposition': 'dense'},
+        {'affinity': 'euclidean_tree', 'decomposition': 'lobpcg', 'random_state': 0},
+        {'affinity': 'euclidean_tree', 'decomposition': 'shift_invert'},
+    ])
+    def test_float32_matches_float64(self, params):
+        X, _ = sklearn_make_moons(400, 0.05, 0)
+        labels, eigenvalues, dtypes = {}, {}, {}
+        for dtype in SpectralClustering.SUPPORTED_DTYPES:
+            model = SpectralClustering(2, dtype=dtype, **params)
+            labels     [dtype] = model.fit(X)
+            eigenvalues[dtype] = model.pipeline.named_steps['embedding'].eigenvalues_
+            dtypes     [dtype] = {r['stage']: r['dtype'] for r in model.profile_}
+
+        assert cluster.adjusted_rand_score(labels['float64'], labels['float32']) == pytest.approx(1)
+        np.testing.assert_allclose(eigenvalues['float32'], eigenvalues['float64'], rtol=1e-3, atol=1e-4)
+
+        # graphs held as booleans, laplacian in single precision
+        assert dtypes['float32']['refinement'] == 'bool'
+        assert dtypes['float32']['laplacian' ] == 'float32'
+
+    def test_float32_lobpcg_converges(self):
+        # a converged solve has residuals well below the Fiedler eigenvalue it reports
+        X, _  = sklearn_make_moons(400, 0.05, 0)
+        model = SpectralClustering(2, affinity='euclidean_tree', decomposition='lobpcg', dtype='float32', random_state=0)
+        model.fit(X)
+
+        report = model.pipeline.named_steps['decomposition'].convergence_
+        assert report['converged']
+        assert max(report['residual_norms']) < 1e-2 * model.pipeline.named_steps['embedding'].eigenvalues_[-1]
+
+    def test_float32_lowers_peak_memory(self):
+        # the n x n stages: distances, graph and laplacian
+        X, _  = binary_moons_data(2000, 0.05)
+        peaks = {}
+        for dtype in SpectralClustering.SUPPORTED_DTYPES:
+            model = SpectralClustering(2, decomposition='lobpcg', profile_memory=True, dtype=dtype)
+            model.fit(X)
+            peaks[dtype] = max(r['peak_memory'] for r in model.profile_ if r['stage'] in ['affinity', 'refinement', 'laplacian'])
+
+        assert peaks['float64'] >= 1.8 * peaks['float32']
+
+class TestOutOfCore:
+
+    def test_chunked_graph_written_to_scratch(self, tmp_path):
+        # graph rows appended to files block by block, identical to the graph from the full distance matrix
+        X, _  = binary_moons_data(300, 0.05)
+        dense = affinity.AffinityTransformer('euclidean').transform(X)
+        rows  = affinity.AffinityTransformer('euclidean', algorithm='chunked', working_memory=0.01, scratch_dir=tmp_path).transform(X)
+        for transformer in [refinement.EpsilonNNTransformer(0.3), refinement.kNNTransformer(10)]:
+            A = transformer.transform(rows)
+            assert scratch.is_mapped(A.data) and scratch.is_mapped(A.indices)
+            np.testing.assert_array_equal(transformer.transform(dense), A.toarray())
+
+    @pytest.mark.parametrize('params', [
+        {'affinity': 'euclidean_chunked', 'refinement': 'mutual_knn', 'decomposition': 'sparse_eigh'},
+        {'affinity': 'euclidean_tree', 'laplacian': 'normalised', 'decomposition': 'lobpcg', 'random_state': 0},
+        {'affinity': 'manhattan_chunked', 'decomposition': 'sparse_eigh'},
+    ])
+    def test_scratch_matches_in_memory(self, params, tmp_path):
+        X, _  = binary_moons_data(500, 0.05)
+        model = SpectralClustering(2, scratch_dir=tmp_path, **params)
+        labels = model.fit(X)
+
+        # graph mapped from disk, laplacian left matrix-free, files gone from the directory once mapped
+        outputs = {r['stage']: r['output_type'] for r in model.profile_}
+        assert outputs['laplacian'] == '_CustomLinearOperator'
+        assert list(tmp_path.iterdir()) == []
+        assert cluster.adjusted_rand_score(model.predict(X), labels) > 0.9
+
+        expected = SpectralClustering(2, **params).fit(X)
+        assert cluster.adjusted_rand_score(labels, expected) == pytest.approx(1)
+
+    def test_requires_matrix_free_solver(self, tmp_path):
+        with pytest.raises(ValueError):
+            SpectralClustering(2, decomposition='dense', scratch_dir=tmp_path)
+
+    def test_rejects_full_distance_matrix(self, tmp_path):
+        # the dense graph of a full distance matrix would be built in memory before reaching the scratch directory
+        with pytest.raises(ValueError):
+            SpectralClustering(2, affinity='euclidean', decomposition='sparse_eigh', scratch_dir=tmp_path)
+
+class TestMultiVectorEmbedding:
+
+    def test_eigengap_clusters(self):
+        assert embedding.eigengap_clusters(np.array([0, 0, 0, 0.9, 1.0, 1.1]), 10) == 3
+        assert embedding.eigengap_clusters(np.array([0, 0.5, 0.6, 0.7]), 10) == 2
+        # gaps past the largest cluster count are not considered
+        assert embedding.eigengap_clusters(np.array([0, 0, 0.1, 0.2, 0.3, 5.0]), 3) == 2
+
+    @pytest.mark.parametrize('embedding_method', ['multi', 'njw'])
+    def test_multi_vector_separates_blobs(self, embedding_method):
+        X, y  = datasets.make_blobs(450, centers=3, cluster_std=0.3, center_box=(-15, 15), random_state=3)
+        model = SpectralClustering(3, embedding=embedding_method, eps=1.0, laplacian='normalised')
+        labels = model.fit(X)
+
+        assert model.num_clusters_ == 3
+        assert cluster.adjusted_rand_score(y, labels) == pytest.approx(1)
+        assert cluster.adjusted_rand_score(model.predict(X), labels) == pytest.approx(1)
+
+    @pytest.mark.parametrize('centers', [3, 4, 6])
+    def test_auto_finds_cluster_count(self, centers):
+        # one partial decomposition picks the count, num_clusters is not needed
+        X, y  = datasets.make_blobs(150 * centers, centers=centers, cluster_std=0.3, center_box=(-15, 15), random_state=centers)
+        model = SpectralClustering(
+            None, embedding='auto', eps=1.0, laplacian='normalised', affinity='euclidean_tree', decomposition='lobpcg', random_state=0,
+        )
+        labels = model.fit(X)
+
+        assert model.num_clusters_ == centers
+        assert cluster.adjusted_rand_score(y, labels) == pytest.approx(1)
+
+class TestOneDimensionalClustering:
+
+    @pytest.mark.parametrize('k', [1, 2, 3, 4])
+    def test_kmeans_1d_is_optimal(self, k):
+        # against every way of cutting the sorted values into k contiguous runs
+        rng = np.random.default_rng(k)
+        for _ in range(20):
+            values = np.sort(rng.normal(size=10) * rng.choice([1, 100]))
+            labels = np.searchsorted(clustering.kmeans_1d_boundaries(values, k), values)
+            best   = min(
+                sum(((run - run.mean()) ** 2).sum() for run in np.split(values, cuts))
+                for cuts in itertools.combinations(range(1, len(values)), k - 1)
+            )
+            found  = sum(((values[labels == l] - values[labels == l].mean()) ** 2).sum() for l in range(k))
+            assert found == pytest.approx(best, abs=1e-9)
+
+    def test_gap_boundaries(self):
+        values = np.array([0.0, 0.1, 5.0, 5.2, 9.0, 9.1])
+        np.testing.assert_allclose(clustering.gap_boundaries(values, 3), [2.55, 7.1])
+
+    @pytest.mark.parametrize('params', [
+        {'clustering': 'k-means'},
+        {'clustering': 'gap'},
+        {'clustering': 'minibatch', 'embedding': 'njw', 'random_state': 0},
+    ])
+    def test_deterministic_and_predicts(self, params):
+        X, _   = binary_moons_data(400, 0.05)
+        labels = [SpectralClustering(2, decomposition='dense_eigh', **params).fit(X) for _ in range(2)]
+        np.testing.assert_array_equal(labels[0], labels[1])
+
+        model = SpectralClustering(2, decomposition='dense_eigh', **params)
+        model.fit(X)
+        assert cluster.adjusted_rand_score(model.predict(X), model.labels_) > 0.9
+
+class TestFitMany:
+
+    @pytest.mark.parametrize('params', [
+        {},
+        {'decomposition': 'dense_eigh', 'standardisation': 'standard'},
+        {'refinement': 'knn', 'k': 10, 'decomposition': 'dense_eigh'},
+        {'refinement': 'mutual_knn', 'k': 10, 'affinity': 'manhattan', 'laplacian': 'normalised'},
+        {'refinement': 'none', 'embedding': 'njw', 'decomposition': 'dense_eigh', 'random_state': 0},
+        # no batched stages, falls back to fitting each input
+        {'affinity': 'euclidean_tree', 'decomposition': 'lobpcg', 'random_state': 0},
+    ])
+    def test_matches_individual_fits(self, params):
+        Xs = [binary_moons_data(n_points, 0.05)[0] for n_points in [100, 200, 100, 300, 200, 100]]
+        labels = SpectralClustering(2, **params).fit_many(Xs)
+
+        # iterative solvers start from random vectors, labels may only match up to their naming
+        assert len(labels) == len(Xs)
+        for (X, many) in zip(Xs, labels):
+            assert cluster.adjusted_rand_score(many, SpectralClustering(2, **params).fit(X)) == pytest.approx(1)
+
+class TestSplitComponents:
+
+    def test_components_are_clusters(self):
+        # two well separated moons under a small eps form their own components, no eigensolve runs
+        X, y  = binary_moons_data(400, 0.0)
+        model = SpectralClustering(2, eps=0.3, split_components=True)
+        labels = model.fit(X)
+
+        assert model.from_components_ and model.n_components_ == 2
+        assert 'decomposition' not in [r['stage'] for r in model.profile_]
+        assert cluster.adjusted_rand_score(y, labels) == pytest.approx(1)
+        assert cluster.adjusted_rand_score(model.predict(X), labels) == pytest.approx(1)
+
+    def test_components_confidence(self):
+        # labels of the components are certain, the bootstrap has nothing to resample
+        X, _  = binary_moons_data(400, 0.0)
+        model = SpectralClustering(2, eps=0.3, split_components=True, confidence='bootstrap')
+        model.fit(X)
+
+        assert model.from_components_
+        np.testing.assert_array_equal(model.confidence_, np.ones(len(X)))
+        np.testing.assert_array_equal(model.coassociation_, np.eye(2))
+
+    @pytest.mark.parametrize('method', ['dense_eigh', 'sparse_eigh', 'lobpcg'])
+    def test_block_spectrum_matches_full(self, method):
+        # three components of a random graph, the union of block spectra is the full spectrum
+        rng    = np.random.default_rng(0)
+        labels = np.repeat([0, 1, 2], [40, 30, 3])
+        A      = rng.random((len(labels), len(labels))) < 0.3
+        A      = np.triu(A & (labels[:, None] == labels[None, :]), 1)
+        L      = laplacian.LaplacianTransformer().transform(scipy.sparse.csr_matrix((A | A.T).astype(float)))
+
+        result = decomposition.decompose_components(decomposition.DecompositionTransformer(method, random_state=0), L, labels, n_jobs=2)
+        np.testing.assert_allclose(result.eigenvalues[:6], np.linalg.eigvalsh(L.toarray())[:6], atol=1e-6)
+        np.testing.assert_allclose(L @ result.eigenvectors(6), result.eigenvectors(6) * result.eigenvalues[:6], atol=1e-5)
+
+    def test_fewer_components_than_clusters(self):
+        X, y = datasets.make_blobs(600, centers=[[0, 0], [1.6, 0], [10, 0]], cluster_std=0.3, random_state=0)
+        params = {'embedding': 'njw', 'eps': 0.5, 'affinity': 'euclidean_tree', 'decomposition': 'dense_eigh'}
+        model  = SpectralClustering(3, split_components=True, **params)
+        labels = model.fit(X)
+
+        assert model.n_components_ == 2 and not model.from_components_
+        assert cluster.adjusted_rand_score(labels, SpectralClustering(3, **params).fit(X)) == pytest.approx(1)
+
+class TestBootstrapConfidence:
+
+    def test_align(self):
+        # replicate labels 2, 0, 1 overlap most with fitted labels 0, 1, 2
+        counts = np.array([[1, 0, 9], [8, 2, 0], [0, 7, 1]])
+        np.testing.assert_array_equal(confidence.align(counts), [1, 2, 0])
+
+    def test_confidence_and_coassociation(self):
+        X, _  = sklearn_make_moons(400, 0.15, 0)
+        model = SpectralClustering(2, confidence='bootstrap', decomposition='dense_eigh', random_state=0)
+        labels = model.fit(X)
+
+        assert model.confidence_.shape == (len(X),) and model.coassociation_.shape == (2, 2)
+        assert np.all((model.confidence_ >= 0) & (model.confidence_ <= 1))
+        np.testing.assert_allclose(model.coassociation_, model.coassociation_.T)
+        assert np.all(np.diag(model.coassociation_) > model.coassociation_[0, 1])
+
+        # subsamples move the split of the 1-D embedding, only points near it change cluster
+        steps    = model.pipeline.named_steps
+        distance = np.abs(steps['embedding'].embedding_[:, 0] - steps['clustering'].boundaries_[0])
+        unsure   = model.confidence_ < 1
+        assert unsure.any() and not unsure.all()
+        assert distance[unsure].mean() < distance[~unsure].mean()
+
+    def test_same_result_across_jobs(self):
+        # replicates are seeded up front, threads only change where they run
+        X, _ = binary_moons_data(300, 0.1)
+        confidences = []
+        for n_jobs in [1, 2]:
+            model = SpectralClustering(2, confidence='bootstrap', decomposition='dense_eigh', random_state=0, n_jobs=n_jobs)
+            model.fit(X)
+            confidences.append(model.confidence_)
+        np.testing.assert_array_equal(confidences[0], confidences[1])
+
+class TestComponentRegistry:
+
+    def test_import_is_lazy(self):
+        code = "import sys, src.SpectralClustering; print(sorted({m.split('.')[0] for m in sys.modules} & {'sklearn', 'scipy'}))"
+        out  = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, check=True, cwd='..')
+        assert out.stdout.strip() == '[]'
+
+    def test_instances_do_not_share_steps(self):
+        a = SpectralClustering(2, refinement='knn', embedding='multi', k=5)
+        b = SpectralClustering(4, refinement='knn', embedding='multi', k=15)
+        for name in ['refinement', 'embedding', 'clustering']:
+            assert a.pipeline.named_steps[name] is not b.pipeline.named_steps[name]
+        assert a.pipeline.named_steps['refinement'].k == 5 and b.pipeline.named_steps['refinement'].k == 15
+        assert a.pipeline.named_steps['clustering'].num_clusters == 2
+
+    def test_concurrent_fits(self):
+        X, _    = datasets.make_blobs(300, centers=[[0, 0], [4, 0], [0, 4], [4, 4]], cluster_std=0.4, random_state=0)
+        configs = [
+            {'num_clusters': c, 'eps': eps, 'embedding': 'njw', 'decomposition': 'dense_eigh', 'random_state': 0}
+            for (c, eps) in [(2, 1.0), (3, 1.5), (4, 1.0), (4, 2.0)]
+        ]
+        expected = [SpectralClustering(**config).fit(X) for config in configs]
+        with ThreadPoolExecutor(4) as pool:
+            results = list(pool.map(lambda config: SpectralClustering(**config).fit(X), configs))
+        for (labels, config, exp) in zip(results, configs, expected):
+            assert len(np.unique(labels)) == config['num_clusters']
+            np.testing.assert_array_equal(labels, exp)
+
+    def test_register_component(self, monkeypatch):
+        monkeypatch.setattr(SpectralClustering, 'COMPONENT_OPTIONS', ComponentRegistry(SpectralClustering.COMPONENT_OPTIONS))
+        built = []
+        def factory(settings):
+            built.append(settings['num_clusters'])
+            return clustering.ClusteringTransformer('gap', settings['num_clusters'])
+        SpectralClustering.register_component('clustering', 'custom', factory)
+
+        X, y   = binary_moons_data(200, 0.05)
+        labels = SpectralClustering(2, clustering='custom').fit(X)
+        assert built == [2]
+        assert cluster.adjusted_rand_score(labels, SpectralClustering(2, clustering='gap').fit(X)) == pytest.approx(1)
+
+        with pytest.raises(ValueError):
+            SpectralClustering(2, clustering='unknown')
+        with pytest.raises(ValueError):
+            SpectralClustering.register_component('clustering', 'broken', None)
+
+    def test_n_components_attributes(self, monkeypatch):
+        # a registered embedding asks for its eigenpairs through its n_components attribute
+        monkeypatch.setattr(SpectralClustering, 'COMPONENT_OPTIONS', ComponentRegistry(SpectralClustering.COMPONENT_OPTIONS))
+        SpectralClustering.register_component('embedding', 'wide', lambda settings: embedding.EmbeddingTransformer('multi', 8))
+
+        steps = dict(SpectralClustering(2, embedding='wide', decomposition='lobpcg').pipeline.steps)
+        assert steps['embedding'].n_components == 8
+        assert steps['decomposition'].n_components == 8
+
+class TestManyMoons:
+
+    def test_make_many_moons(self):
+        X, labels = make_many_moons(10001, 4, 0.05, rand_state=0)
+        assert X.shape == (10001, 2) and labels.shape == (10001,)
+        assert np.bincount(labels).tolist() == [2501, 2500, 2500, 2500]
+
+        # moons are side by side, odd moons flipped and shifted up
+        for moon in range(4):
+            mean = X[labels == moon].mean(axis=0)
+            assert mean[0] == pytest.approx(1.3 * moon, abs=0.05)
+            assert mean[1] == pytest.approx(-2 / np.pi + 0.5 if moon % 2 else 2 / np.pi, abs=0.05)
+
+        X_again, labels_again = make_many_moons(10001, 4, 0.05, rand_state=0)
+        np.testing.assert_array_equal(X, X_again)
+        np.testing.assert_array_equal(labels, labels_again)
+
+    def test_chunks_seeded_independently(self):
+        chunks = list(iter_many_moons(2500, 3, 0.1, rand_state=1, chunk_size=1000))
+        assert [len(X) for (X, _) in chunks] == [1000, 1000, 500]
+        assert np.bincount(np.concatenate([labels for (_, labels) in chunks])).tolist() == [834, 833, 833]
+
+        # the first chunks do not depend on how many points follow them
+        shorter = list(iter_many_moons(2000, 3, 0.1, rand_state=1, chunk_size=1000))
+        for ((X, labels), (X_short, labels_short)) in zip(chunks, shorter):
+            np.testing.assert_array_equal(X, X_short)
+            np.testing.assert_array_equal(labels, labels_short)
+        assert not np.array_equal(chunks[0][0], chunks[1][0])
+
+    def test_write_many_moons(self, tmp_path):
+        X, labels = write_many_moons(
+            str(tmp_path / 'X.npy'), 2500, 3, 0.1, rand_state=1, chunk_size=1000, labels_path=str(tmp_path / 'y.npy'), dtype='float32',
+        )
+        chunks = list(iter_many_moons(2500, 3, 0.1, rand_state=1, chunk_size=1000))
+        assert scratch.is_mapped(X) and X.dtype == np.float32
+        np.testing.assert_array_equal(X, np.concatenate([X for (X, _) in chunks]).astype(np.float32))
+        np.testing.assert_array_equal(labels, np.concatenate([labels for (_, labels) in chunks]))
+
+class TestResultsSink:
+
+    def test_batches_and_columns(self, tmp_path):
+        path    = str(tmp_path / 'results_dump.json')
+        entries = [
+            {'n_points': 100 * i, 'time': 0.5 * i, 'variant': f'v{i}', 'profile': [{'stage': 'affinity', 'wall_time': i}]}
+            for i in range(25)
+        ]
+        # a later entry with a column the earlier ones do not have
+        entries.append({'n_points': 5, 'time': None, 'variant': 'last', 'adjusted_rand_score': 0.9})
+
+        with results_sink.ResultsSink(path, flush_records=10, flush_secs=60) as sink:
+            for entry in entries:
+                sink.write(entry)
+        assert len(os.listdir(results_sink.columns_dir_of(path))) == 3
+
+        # the dump file keeps the JSON lines format
+        with open(path) as f:
+            assert [json.loads(line) for line in f] == entries
+
+        columns = results_sink.load_columns(path, ['n_points', 'time', 'adjusted_rand_score'])
+        assert sorted(columns) == ['adjusted_rand_score', 'n_points', 'time']
+        np.testing.assert_array_equal(columns['n_points'], [e['n_points'] for e in entries])
+        np.testing.assert_array_equal(columns['time'], [np.nan if e['time'] is None else e['time'] for e in entries])
+        np.testing.assert_array_equal(columns['adjusted_rand_score'], [np.nan] * 25 + [0.9])
+
+        profiles = results_sink.load_columns(path, ['profile'])['profile']
+        assert json.loads(profiles[3]) == entries[3]['profile'] and profiles[-1] == ''
+
+    def test_flushes_on_time(self, tmp_path):
+        path = str(tmp_path / 'results_dump.json')
+        sink = results_sink.ResultsSink(path, flush_records=100, flush_secs=0.05)
+        sink.write({'n_points': 1})
+        for _ in range(100):
+            columns = results_sink.load_columns(path)
+            if columns:
+                break
+            time.sleep(0.05)
+        assert columns['n_points'].tolist() == [1]
+
+        sink.write({'n_points': 2})
+        sink.flush()
+        assert results_sink.load_columns(path)['n_points'].tolist() == [1, 2]
+        sink.close()
+
+        # flushing a closed sink raises instead of waiting on the stopped writer
+        with pytest.raises(ValueError):
+            sink.flush()
+
+    def test_write_after_close(self, tmp_path):
+        path = str(tmp_path / 'results_dump.json')
+        with results_sink.ResultsSink(path, flush_records=10, flush_secs=60) as sink:
+            sink.write({'n_points': 1})
+
+        # the entry would never reach disk, so it is raised rather than dropped
+        with pytest.raises(ValueError):
+            sink.write({'n_points': 2})
+        assert results_sink.load_columns(path)['n_points'].tolist() == [1]
+
+    def test_mixed_column_types(self, tmp_path):
+        path = str(tmp_path / 'results_dump.json')
+        with results_sink.ResultsSink(path, flush_records=2, flush_secs=60) as sink:
+            for variant in ['DEFAULT', 'eps', 0.1, 0.2]:
+                sink.write({'n_points': 1, 'variant': variant})
+        # a column written as text stays text in later parts
+        assert results_sink.load_columns(path)['variant'].tolist() == ['DEFAULT', 'eps', '0.1', '0.2']
+
+        # numeric in one part and text in a later one is not silently read back as strings
+        with results_sink.ResultsSink(path, flush_records=2, flush_secs=60) as sink:
+            for variant in [0.3, 0.4, 'knn', 'mutual']:
+                sink.write({'n_points': 1, 'weight': variant})
+        assert results_sink.load_columns(path, ['n_points'])['n_points'].tolist() == [1] * 8
+        with pytest.raises(ValueError):
+            results_sink.load_columns(path, ['weight'])
+
+class TestEvaluation:
+
+    @pytest.mark.parametrize('labels_true, labels_pred', [
+        ([0, 0, 1, 1, 2, 2, 2], [1, 1, 0, 0, 2, 2, 2]),
+        ([0, 0, 1, 1, 2, 2, 2], [0, 1, 0, 1, 0, 1, 3]),
+        ([0, 0, 0, 0], [0, 1, 2, 3]),
+        ([0, 0, 0, 0], [0, 0, 0, 0]),
+        ([0, 1, 0, 1], [5, 5, 5, 5]),
+        (np.random.default_rng(0).integers(4, size=500), np.random.default_rng(1).integers(6, size=500)),
+        (np.random.default_rng(2).integers(3, size=20000), np.random.default_rng(3).integers(25, size=20000)),
+    ])
+    def test_label_scores_match_sklearn(self, labels_true, labels_pred):
+        scores = evaluation.label_scores(labels_true, labels_pred)
+        for (name, score) in scores.items():
+            assert score == pytest.approx(getattr(cluster, name)(labels_true, labels_pred), abs=1e-10), name
+
+    def test_silhouette(self):
+        X, labels = datasets.make_blobs(600, centers=3, random_state=0)
+        exact     = metrics.silhouette_score(X, labels)
+
+        assert evaluation.silhouette(labels, X) == pytest.approx((exact, 0))
+        D = metrics.pairwise_distances(X)
+        assert evaluation.silhouette(labels, distances=D) == pytest.approx((exact, 0))
+
+        # the sampled estimate is within a few standard errors of the exact value
+        estimate, stderr = evaluation.silhouette(labels, X, sample_size=200, random_state=0)
+        assert 0 < stderr < 0.05
+        assert abs(estimate - exact) < 4 * stderr
+
+    def test_reuses_cached_distances(self, monkeypatch):
+        X, y  = binary_moons_data(300, 0.05)
+        cache = StageCache()
+        model = SpectralClustering(2, cache=cache)
+        model.fit(X)
+
+        # the silhouette is taken from the cached affinity output, without computing distances again
+        monkeypatch.setattr(evaluation, 'pairwise_distances', None)
+        scores = evaluation.evaluate(model, X, y)
+        assert scores['silhouette_score'] == pytest.approx(metrics.silhouette_score(X, model.labels_))
+        assert scores['adjusted_rand_score'] == pytest.approx(cluster.adjusted_rand_score(y, model.labels_))
+
+        # standardised inputs are not the points the silhouette is measured on
+        assert evaluation.model_distances(SpectralClustering(2, standardisation='standard', cache=cache), X) is None
+        assert evaluation.model_distances(SpectralClustering(2), X) is None
+
+    def test_harnesses_reuse_distances(self, monkeypatch):
+        # results entries of both harnesses take the silhouette from the distances their models kept
+        monkeypatch.setattr(evaluation, 'pairwise_distances', None)
+        task  = {'n_points': 300, 'noise': 0.05, 'experiment': 'DEFAULT', 'variant': 'DEFAULT', 'params': {}}
+        entry = benchmark.run_task(task, 60)
+        assert entry['timed_out'] == 'False' and entry['silhouette_stderr'] == 0
+
+        X, y  = binary_moons_data(300, 0.05)
+        model = SpectralClustering(2)
+        t, labels = conftest.run_timeout_fn(model.fit, X)
+        assert conftest.LAST_MODEL is model and model.affinity_ is not None
+        entry = experiments.result_entry(300, 0.05, t, False, X=X, pred_labels=labels, ground_truth=y, model=conftest.LAST_MODEL)
+        assert entry['silhouette_score'] == pytest.approx(metrics.silhouette_score(X, labels))
+
+    def test_samples_above_threshold(self):
+        X, y   = binary_moons_data(400, 0.05)
+        model  = SpectralClustering(2)
+        model.fit(X)
+        scores = evaluation.evaluate(model, X, sample_threshold=300, sample_size=100, random_state=0)
+        assert 'adjusted_rand_score' not in scores and scores['silhouette_stderr'] > 0
+
+class TestAutoDecomposition:
+
+    def laplacian(self, n, refinement_transformer):
+        X, _ = binary_moons_data(n, 0.05)
+        A    = refinement_transformer.transform(affinity.AffinityTransformer().transform(X))
+        return laplacian.LaplacianTransformer(True).transform(scipy.sparse.csr_matrix(A))
+
+    def test_dense_subset(self):
+        L   = self.laplacian(300, refinement.EpsilonNNTransformer(0.3))
+        res = decomposition.DecompositionTransformer('dense_subset', n_components=4).transform(L)
+        assert res.eigenvectors().shape == (300, 4)
+        np.testing.assert_allclose(res.eigenvalues, np.linalg.eigvalsh(L.toarray())[:4], atol=1e-8)
+
+    def test_plan(self, monkeypatch):
+        monkeypatch.setattr(decomposition.DecompositionTransformer, 'DENSE_MAX_N', 100)
+        L        = self.laplacian(300, refinement.EpsilonNNTransformer(0.3))
+        directed = self.laplacian(300, refinement.kNNTransformer(5))
+        budget   = decomposition.DecompositionTransformer.DEFAULT_MEMORY_BUDGET
+
+        assert decomposition.plan(L[:100, :100], budget)['method'] == 'dense_subset'
+        assert decomposition.plan(L, budget)['method'] == 'shift_invert'
+        assert decomposition.plan(L, L.nnz)['method'] == 'lobpcg'
+        assert decomposition.plan(scipy.sparse.linalg.aslinearoperator(L), budget)['method'] == 'lobpcg'
+        assert decomposition.plan(L.toarray() + 1, budget)['method'] == 'dense_subset'
+
+        # directed k-NN graphs give laplacians only the general solvers apply to
+        assert not decomposition.plan(directed, budget)['symmetric']
+        assert decomposition.plan(directed, budget)['method'] == 'sparse'
+        assert decomposition.plan(directed[:100, :100], budget)['method'] == 'dense'
+
+        # dense laplacians are checked a few rows at a time
+        for block_bytes in [8, 2**24]:
+            assert decomposition.is_symmetric(L.toarray(), block_bytes)
+            assert not decomposition.is_symmetric(directed.toarray(), block_bytes)
+
+    @pytest.mark.parametrize('params', [
+        {'eps': 0.3},
+        {'affinity': 'euclidean_tree', 'refinement': 'mutual_knn', 'k': 20},
+    ])
+    def test_fit_records_plan(self, params, monkeypatch):
+        X, y  = datasets.make_moons(400, noise=0.05, random_state=2)
+        model = SpectralClustering(2, decomposition='auto', laplacian='normalised', random_state=0, **params)
+        labels = model.fit(X)
+        assert model.decomposition_plan_['method'] == 'dense_subset' and model.decomposition_plan_['reason']
+        assert cluster.adjusted_rand_score(y, labels) > 0.95
+
+        # past the dense threshold a sparse laplacian is factorised for shift-invert Lanczos
+        monkeypatch.setattr(decomposition.DecompositionTransformer, 'DENSE_MAX_N', 100)
+        model = SpectralClustering(2, decomposition='auto', laplacian='normalised', random_state=0, **params)
+        assert cluster.adjusted_rand_score(labels, model.fit(X)) > 0.95
+        assert model.decomposition_plan_['method'] == 'shift_invert'
+
+        # a memory budget given to the model reaches the planner
+        model = SpectralClustering(2, decomposition='auto', laplacian='normalised', random_state=0, memory_budget=2**10, **params)
+        assert cluster.adjusted_rand_score(labels, model.fit(X)) > 0.95
+        assert model.decomposition_plan_['memory_budget'] == 2**10
+        assert model.decomposition_plan_['method'] == 'lobpcg'